@@ -0,0 +1,30 @@
+"""
+Benchmarks of the bot's hot paths, run from the repository root, e.g.
+
+    python -m benchmarks.token_counting
+
+Like the tests, they import the bot's modules with the example config.
+"""
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).parent.parent.resolve()
+
+sys.path.insert(0, str(ROOT_DIR / 'bot'))
+
+if 'BOT_CONFIG_DIR' not in os.environ:
+    _config_dir = Path(tempfile.mkdtemp(prefix='bot-bench-config-'))
+    shutil.copy(
+        ROOT_DIR / 'config' / 'config.example.yml', _config_dir / 'config.yml'
+    )
+    shutil.copy(
+        ROOT_DIR / 'config' / 'config.example.env', _config_dir / 'config.env'
+    )
+    for name in ('chat_modes.yml', 'models.yml'):
+        shutil.copy(ROOT_DIR / 'config' / name, _config_dir / name)
+    os.environ['BOT_CONFIG_DIR'] = str(_config_dir)
+    atexit.register(shutil.rmtree, _config_dir, ignore_errors=True)
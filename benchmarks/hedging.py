@@ -0,0 +1,114 @@
+"""
+Time to the first token of streamed replies with and without hedging, on a
+local fake OpenAI API served as two endpoints where a share of requests
+stalls. Reports the percentiles of the time to the first token, how many
+streams were hedged and the tokens spent on the streams that lost.
+
+    python -m benchmarks.hedging [--streams 400] [--stall-probability 0.05]
+"""
+import argparse
+import asyncio
+import collections
+import time
+
+import compat
+import config
+import endpoints
+import fake_openai
+import hedging
+import latency
+import openai_utils
+
+MESSAGES = [{'role': 'user', 'content': 'Hello!'}]
+
+
+async def read_stream(chatgpt, ttft_latencies) -> hedging.WastedTokens:
+    wasted_tokens = hedging.WastedTokens()
+    async with chatgpt._slot():
+        started_at = time.monotonic()
+        stream = await chatgpt._open_chat_stream(
+            10,
+            wasted_tokens,
+            model=chatgpt.model,
+            messages=MESSAGES,
+            **chatgpt._completion_options(),
+        )
+        async with compat.aclosing(stream):
+            async for r_item in stream:
+                if openai_utils._get_delta_content(r_item):
+                    ttft_latencies.observe(time.monotonic() - started_at)
+                    break
+    return wasted_tokens
+
+
+async def measure(hedge: bool, args: argparse.Namespace) -> dict:
+    config.openai_hedge_enabled = hedge
+    hedging.ttft_windows = collections.defaultdict(
+        lambda: latency.LatencyWindow(200, min_samples=20)
+    )
+    hedging.hedge_stats = hedging.HedgeStats()
+
+    server = fake_openai.FakeOpenAI(
+        first_token_latency=args.first_token_latency,
+        n_answer_tokens=5,
+        stall_probability=args.stall_probability,
+        stall_time=args.stall_time,
+    )
+    async with fake_openai.serving(server, port=args.port) as api_base:
+        openai_utils.endpoint_pool = endpoints.EndpointPool([
+            endpoints.Endpoint(f'fake-{i}', 'sk-fake', api_base)
+            for i in range(2)
+        ])
+        await openai_utils.start_http_session()
+        try:
+            ttft_latencies = latency.LatencyWindow(args.streams)
+            chatgpt = openai_utils.ChatGPT('gpt-3.5-turbo')
+            semaphore = asyncio.Semaphore(args.concurrency)
+
+            async def run_stream():
+                async with semaphore:
+                    return await read_stream(chatgpt, ttft_latencies)
+
+            wasted = await asyncio.gather(
+                *(run_stream() for _ in range(args.streams))
+            )
+        finally:
+            await openai_utils.close_http_session()
+
+    return {
+        'p50_ms': ttft_latencies.percentile(50) * 1000,
+        'p95_ms': ttft_latencies.percentile(95) * 1000,
+        'p99_ms': ttft_latencies.percentile(99) * 1000,
+        'requests': server.n_requests,
+        'hedged': hedging.hedge_stats.n_hedged,
+        'wasted_input_tokens': sum(w.n_input_tokens for w in wasted),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--streams', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--first-token-latency', type=float, default=0.05)
+    parser.add_argument('--stall-probability', type=float, default=0.05)
+    parser.add_argument('--stall-time', type=float, default=1.0)
+    parser.add_argument('--port', type=int, default=8082)
+    args = parser.parse_args()
+    config.openai_hedge_min_delay = args.first_token_latency
+
+    print(
+        f'{"hedging":>8} {"p50, ms":>9} {"p95, ms":>9} {"p99, ms":>9} '
+        f'{"requests":>9} {"hedged":>7} {"wasted input":>13}'
+    )
+    for hedge in (False, True):
+        result = asyncio.run(measure(hedge, args))
+        print(
+            f'{"on" if hedge else "off":>8} '
+            f'{result["p50_ms"]:>9.0f} {result["p95_ms"]:>9.0f} '
+            f'{result["p99_ms"]:>9.0f} {result["requests"]:>9} '
+            f'{result["hedged"]:>7} {result["wasted_input_tokens"]:>13}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+OpenAI calls with a session per call, openai's default, against the shared
+pooled session, on a local fake OpenAI API. Reports the latency of a call,
+the CPU time per call and how many TCP connections the server saw. Over
+plain HTTP on localhost only session and TCP setup are saved; against the
+real API every new connection costs a TLS handshake too.
+
+    python -m benchmarks.http_session [--calls 500] [--concurrency 20]
+"""
+import argparse
+import asyncio
+import time
+
+import openai
+
+import endpoints
+import fake_openai
+import latency
+import openai_utils
+
+MESSAGES = [{'role': 'user', 'content': 'Hello!'}]
+
+
+async def run_calls(n_calls: int, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    call_latencies = latency.LatencyWindow(n_calls)
+
+    async def call():
+        async with semaphore:
+            started_at = time.monotonic()
+            await openai_utils.call_openai(
+                openai.ChatCompletion.acreate,
+                model='gpt-3.5-turbo',
+                messages=MESSAGES,
+            )
+            call_latencies.observe(time.monotonic() - started_at)
+
+    started_at, cpu_started_at = time.monotonic(), time.process_time()
+    await asyncio.gather(*(call() for _ in range(n_calls)))
+    elapsed = time.monotonic() - started_at
+    cpu_time = time.process_time() - cpu_started_at
+
+    return {
+        'calls_per_second': n_calls / elapsed,
+        'p50_ms': call_latencies.percentile(50) * 1000,
+        'p95_ms': call_latencies.percentile(95) * 1000,
+        'cpu_ms_per_call': cpu_time / n_calls * 1000,
+    }
+
+
+async def measure(pooled: bool, args: argparse.Namespace) -> dict:
+    server = fake_openai.FakeOpenAI(n_answer_tokens=20)
+    async with fake_openai.serving(server, port=args.port) as api_base:
+        openai_utils.endpoint_pool = endpoints.EndpointPool(
+            [endpoints.Endpoint('fake', 'sk-fake', api_base)]
+        )
+        if pooled:
+            await openai_utils.start_http_session()
+        try:
+            result = await run_calls(args.calls, args.concurrency)
+        finally:
+            await openai_utils.close_http_session()
+
+    result['connections'] = server.n_connections
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--port', type=int, default=8082)
+    args = parser.parse_args()
+
+    print(
+        f'{"session":>9} {"calls/s":>9} {"p50, ms":>9} {"p95, ms":>9} '
+        f'{"CPU ms/call":>12} {"connections":>12}'
+    )
+    for pooled in (False, True):
+        result = asyncio.run(measure(pooled, args))
+        print(
+            f'{"pooled" if pooled else "per call":>9} '
+            f'{result["calls_per_second"]:>9.0f} '
+            f'{result["p50_ms"]:>9.2f} {result["p95_ms"]:>9.2f} '
+            f'{result["cpu_ms_per_call"]:>12.3f} {result["connections"]:>12}'
+        )
+    print(f'pooled session connections: {openai_utils.connection_stats.stats()}')
+
+
+if __name__ == '__main__':
+    main()
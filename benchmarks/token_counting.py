@@ -0,0 +1,89 @@
+"""
+CPU time spent counting the tokens of one streamed reply, for replies of
+several lengths. "before" does what the streaming loop used to do on every
+delta: get the encoding with encoding_for_model and re-encode the prompt and
+the whole answer so far. "after" is StreamingTokenCounter, which encodes
+each delta once.
+
+    python -m benchmarks.token_counting [--model gpt-3.5-turbo]
+"""
+import argparse
+import random
+import time
+
+import tiktoken
+
+from openai_utils import StreamingTokenCounter, get_encoding
+
+WORDS = (
+    'the a model answer token stream telegram message user bot reply of to '
+    'and in is it that for on with as this be are was by at from or an'
+).split()
+
+
+def make_deltas(model: str, n_tokens: int) -> list:
+    """An n_tokens long answer, one token per delta like OpenAI streams it."""
+    rng = random.Random(0)
+    text = ' '.join(rng.choice(WORDS) for _ in range(n_tokens))
+    encoding = get_encoding(model)
+    tokens = encoding.encode(text)[:n_tokens]
+    return [encoding.decode([token]) for token in tokens]
+
+
+def count_before(model: str, messages: list, deltas: list) -> int:
+    answer = ''
+    for delta in deltas:
+        answer += delta
+        encoding = tiktoken.encoding_for_model(model)
+        n_input_tokens = 2
+        for message in messages:
+            n_input_tokens += 4 + len(encoding.encode(message['content']))
+        n_output_tokens = 1 + len(encoding.encode(answer))
+    return n_output_tokens
+
+
+def count_after(model: str, messages: list, deltas: list) -> int:
+    counter = StreamingTokenCounter(model, n_tokens=1)
+    for delta in deltas:
+        n_output_tokens = counter.add(delta)
+    return n_output_tokens
+
+
+def measure(count, *args, repeat: int = 3) -> float:
+    """Least CPU seconds of `repeat` runs."""
+    cpu_times = []
+    for _ in range(repeat):
+        started_at = time.process_time()
+        count(*args)
+        cpu_times.append(time.process_time() - started_at)
+    return min(cpu_times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default='gpt-3.5-turbo')
+    args = parser.parse_args()
+
+    messages = [
+        {'role': 'system', 'content': 'You are a helpful assistant. ' * 20},
+        {'role': 'user', 'content': 'Tell me a long story. ' * 10},
+    ]
+    get_encoding(args.model)  # loading the BPE ranks isn't part of a reply
+
+    print(f'{"tokens":>8} {"before, ms":>12} {"after, ms":>12} {"speedup":>8}')
+    for n_tokens in (100, 300, 1000, 2000):
+        deltas = make_deltas(args.model, n_tokens)
+        assert count_before(args.model, messages, deltas) == count_after(
+            args.model, messages, deltas
+        )
+
+        before = measure(count_before, args.model, messages, deltas)
+        after = measure(count_after, args.model, messages, deltas)
+        print(
+            f'{n_tokens:>8} {before * 1000:>12.1f} {after * 1000:>12.1f} '
+            f'{before / after:>7.0f}x'
+        )
+
+
+if __name__ == '__main__':
+    main()
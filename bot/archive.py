@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import zlib
+from datetime import datetime, timedelta
+from typing import Optional
+
+import bson
+import pymongo
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+def compress_messages(messages: list) -> bson.Binary:
+    return bson.Binary(zlib.compress(bson.encode({"messages": messages}), config.dialog_archive_compression_level))
+
+
+def decompress_messages(data: bytes) -> list:
+    return bson.decode(zlib.decompress(data))["messages"]
+
+
+def archive_dialog_dict(dialog_dict: dict) -> dict:
+    archived_dialog_dict = {key: value for key, value in dialog_dict.items() if key != "messages"}
+    archived_dialog_dict["n_messages"] = len(dialog_dict["messages"])
+    archived_dialog_dict["messages_zlib"] = compress_messages(dialog_dict["messages"])
+    archived_dialog_dict["archived_at"] = datetime.now()
+
+    if config.dialog_archive_ttl_days is not None:
+        # removed by the TTL index on expire_at
+        archived_dialog_dict["expire_at"] = datetime.now() + timedelta(days=config.dialog_archive_ttl_days)
+
+    return archived_dialog_dict
+
+
+def unarchive_dialog_dict(archived_dialog_dict: dict) -> dict:
+    dialog_dict = {
+        key: value for key, value in archived_dialog_dict.items()
+        if key not in {"n_messages", "messages_zlib", "archived_at", "expire_at"}
+    }
+    dialog_dict["messages"] = decompress_messages(archived_dialog_dict["messages_zlib"])
+    return dialog_dict
+
+
+class DialogArchiver:
+    """
+    Periodically moves dialogs that were not updated for
+    `dialog_archive_after_days` from `dialog` into the compressed
+    `dialog_archive` collection.
+    """
+
+    def __init__(self, dialog_collection, archive_collection):
+        self.dialog_collection = dialog_collection
+        self.archive_collection = archive_collection
+
+        self.n_archived_dialogs = 0
+        self._task = None
+
+    def _stale_dialogs_query(self) -> dict:
+        cutoff = datetime.now() - timedelta(days=config.dialog_archive_after_days)
+        return {"$or": [
+            {"updated_at": {"$lt": cutoff}},
+            {"updated_at": None, "start_time": {"$lt": cutoff}},  # dialogs created before updated_at existed
+        ]}
+
+    async def archive_once(self, batch_size: Optional[int] = None) -> int:
+        """Archives one batch of stale dialogs and returns how many were moved."""
+        batch_size = batch_size or config.dialog_archive_batch_size
+        dialog_dicts = await self.dialog_collection.find(self._stale_dialogs_query()).limit(batch_size).to_list(None)
+        if len(dialog_dicts) == 0:
+            return 0
+
+        # upserts keep this idempotent if we crash between the two writes
+        await self.archive_collection.bulk_write([
+            pymongo.ReplaceOne({"_id": dialog_dict["_id"]}, archive_dialog_dict(dialog_dict), upsert=True)
+            for dialog_dict in dialog_dicts
+        ], ordered=False)
+
+        # a dialog that got a new message meanwhile stays live; its archived copy
+        # is shadowed by it and gets overwritten when it goes stale again
+        result = await self.dialog_collection.bulk_write([
+            pymongo.DeleteOne({"_id": dialog_dict["_id"], "updated_at": dialog_dict.get("updated_at")})
+            for dialog_dict in dialog_dicts
+        ], ordered=False)
+
+        self.n_archived_dialogs += result.deleted_count
+        return result.deleted_count
+
+    async def archive_all(self) -> int:
+        n_archived_dialogs = 0
+        while True:
+            n_archived_batch = await self.archive_once()
+            n_archived_dialogs += n_archived_batch
+            if n_archived_batch < config.dialog_archive_batch_size:
+                return n_archived_dialogs
+
+    async def _run(self):
+        while True:
+            try:
+                n_archived_dialogs = await self.archive_all()
+                if n_archived_dialogs > 0:
+                    logger.info(f"Archived {n_archived_dialogs} dialogs")
+            except Exception:
+                logger.exception("Dialog archiving failed")
+
+            await asyncio.sleep(config.dialog_archive_interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -19,7 +19,6 @@ from telegram import (
 )
 from telegram.constants import ParseMode
 from telegram.ext import (
-    AIORateLimiter,
     Application,
     ApplicationBuilder,
     CallbackContext,
@@ -31,11 +30,19 @@ from telegram.ext import (
 
 import config
 import database
+import egress
+import latency
 import openai_utils
+import streaming
+import summarization
+import webhook
 from src_bot.bot.handlers import add_handlers
 
 # setup
-db = database.Database()
+# created by build_application, in the process that runs the application:
+# webhook workers are forked first, and a database client can't be forked
+db: database.Database = None
+dialog_summarizer: summarization.DialogSummarizer = None
 logger = logging.getLogger(__name__)
 
 user_semaphores = {}
@@ -72,50 +79,21 @@ def split_text_into_chunks(text, chunk_size):
 
 
 async def register_user_if_not_exists(
-    update: Update, context: CallbackContext, user: User
+    update: Update, context: CallbackContext, user: User, touch: bool = True
 ):
-    if not db.check_if_user_exists(user.id):
-        db.add_new_user(
-            user.id,
-            update.message.chat_id,
-            username=user.username,
-            first_name=user.first_name,
-            last_name=user.last_name,
-        )
-        db.start_new_dialog(user.id)
-
-    if db.get_user_attribute(user.id, 'current_dialog_id') is None:
-        db.start_new_dialog(user.id)
+    # creates/backfills the user and, if `touch`, updates last_interaction
+    await db.register_user(
+        user.id,
+        update.message.chat_id,
+        username=user.username,
+        first_name=user.first_name,
+        last_name=user.last_name,
+        touch=touch,
+    )
 
     if user.id not in user_semaphores:
         user_semaphores[user.id] = asyncio.Semaphore(1)
 
-    if db.get_user_attribute(user.id, 'current_model') is None:
-        db.set_user_attribute(
-            user.id, 'current_model', config.models['available_text_models'][0]
-        )
-
-    # back compatibility for n_used_tokens field
-    n_used_tokens = db.get_user_attribute(user.id, 'n_used_tokens')
-    if isinstance(n_used_tokens, int) or isinstance(
-        n_used_tokens, float
-    ):  # old format
-        new_n_used_tokens = {
-            'gpt-3.5-turbo': {
-                'n_input_tokens': 0,
-                'n_output_tokens': n_used_tokens,
-            }
-        }
-        db.set_user_attribute(user.id, 'n_used_tokens', new_n_used_tokens)
-
-    # voice message transcription
-    if db.get_user_attribute(user.id, 'n_transcribed_seconds') is None:
-        db.set_user_attribute(user.id, 'n_transcribed_seconds', 0.0)
-
-    # image generation
-    if db.get_user_attribute(user.id, 'n_generated_images') is None:
-        db.set_user_attribute(user.id, 'n_generated_images', 0)
-
 
 async def is_bot_mentioned(update: Update, context: CallbackContext):
     try:
@@ -145,8 +123,7 @@ async def start_handle(update: Update, context: CallbackContext):
     )
     user_id = update.message.from_user.id
 
-    db.set_user_attribute(user_id, 'last_interaction', datetime.now())
-    db.start_new_dialog(user_id)
+    await db.start_new_dialog(user_id)
 
     reply_text = (
         "Hi! I'm <b>ChatGPT</b> bot implemented with OpenAI API 🤖\n\n"
@@ -162,7 +139,6 @@ async def help_handle(update: Update, context: CallbackContext):
         update, context, update.message.from_user
     )
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, 'last_interaction', datetime.now())
     await update.message.reply_text(HELP_MESSAGE, parse_mode=ParseMode.HTML)
 
 
@@ -171,7 +147,6 @@ async def help_group_chat_handle(update: Update, context: CallbackContext):
         update, context, update.message.from_user
     )
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, 'last_interaction', datetime.now())
 
     text = HELP_GROUP_CHAT_MESSAGE.format(
         bot_username='@' + context.bot.username
@@ -189,18 +164,13 @@ async def retry_handle(update: Update, context: CallbackContext):
         return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, 'last_interaction', datetime.now())
 
-    dialog_messages = db.get_dialog_messages(user_id, dialog_id=None)
-    if len(dialog_messages) == 0:
+    # last message is removed from the context
+    last_dialog_message = await db.pop_dialog_message(user_id, dialog_id=None)
+    if last_dialog_message is None:
         await update.message.reply_text('No message to retry 🤷‍♂️')
         return
 
-    last_dialog_message = dialog_messages.pop()
-    db.set_dialog_messages(
-        user_id, dialog_messages, dialog_id=None
-    )  # last message was removed from the context
-
     await message_handle(
         update,
         context,
@@ -209,14 +179,88 @@ async def retry_handle(update: Update, context: CallbackContext):
     )
 
 
+async def send_placeholder(update: Update, reply_timer: latency.ReplyTimer):
+    placeholder_message, _ = await asyncio.gather(
+        update.message.reply_text('...'),
+        update.message.chat.send_action(action='typing'),
+    )
+    reply_timer.mark('placeholder_sent')
+    return placeholder_message
+
+
+async def prepare_dialog(
+    update: Update, user_id: int, chat_mode: str, use_new_dialog_timeout: bool
+):
+    """
+    Returns the id, summary and last messages of the dialog to continue, and
+    how many messages before those are left out, and records the interaction.
+    Starts a new dialog if the last one timed out.
+    """
+    last_interaction = await db.get_user_attribute(user_id, 'last_interaction')
+    dialog_id = await db.get_user_attribute(user_id, 'current_dialog_id')
+    (
+        (dialog_summary, dialog_messages, n_dropped_messages),
+        _,
+    ) = await asyncio.gather(
+        dialog_summarizer.load_dialog(
+            user_id, dialog_id, last_n=config.max_context_dialog_messages
+        ),
+        db.set_user_attribute(user_id, 'last_interaction', datetime.now()),
+    )
+
+    # new dialog timeout
+    if (
+        use_new_dialog_timeout
+        and (datetime.now() - last_interaction).seconds
+        > config.new_dialog_timeout
+        and (dialog_summary is not None or len(dialog_messages) > 0)
+    ):
+        dialog_id = await db.start_new_dialog(user_id)
+        dialog_summary, dialog_messages, n_dropped_messages = None, [], 0
+        await update.message.reply_text(
+            f"Starting new dialog due to timeout (<b>{config.chat_modes[chat_mode]['name']}</b> mode) ✅",
+            parse_mode=ParseMode.HTML,
+        )
+
+    return dialog_id, dialog_summary, dialog_messages, n_dropped_messages
+
+
+async def download_photo(update: Update, context: CallbackContext):
+    if not update.message.effective_attachment:
+        return None
+
+    photo = update.message.effective_attachment[-1]
+    photo_file = await context.bot.get_file(photo.file_id)
+
+    # store file in memory, not on disk
+    buf = io.BytesIO()
+    await photo_file.download_to_memory(buf)
+    buf.name = 'image.jpg'  # file extension is required
+    buf.seek(0)  # move cursor to the beginning of the buffer
+    return buf
+
+
+async def send_removed_messages_note(
+    update: Update, n_first_dialog_messages_removed: int
+):
+    # send message if some messages were removed from the context
+    if n_first_dialog_messages_removed > 0:
+        if n_first_dialog_messages_removed == 1:
+            text = '✍️ <i>Note:</i> Your current dialog is too long, so your <b>first message</b> was removed from the context.\n Send /new command to start new dialog'
+        else:
+            text = f'✍️ <i>Note:</i> Your current dialog is too long, so <b>{n_first_dialog_messages_removed} first messages</b> were removed from the context.\n Send /new command to start new dialog'
+        await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+
+
 async def _vision_message_handle_fn(
     update: Update,
     context: CallbackContext,
+    reply_timer: latency.ReplyTimer,
     use_new_dialog_timeout: bool = True,
 ):
     logger.info('_vision_message_handle_fn')
     user_id = update.message.from_user.id
-    current_model = db.get_user_attribute(user_id, 'current_model')
+    current_model = await db.get_user_attribute(user_id, 'current_model')
 
     if current_model != 'gpt-4-vision-preview' and current_model != 'gpt-4o':
         await update.message.reply_text(
@@ -225,56 +269,53 @@ async def _vision_message_handle_fn(
         )
         return
 
-    chat_mode = db.get_user_attribute(user_id, 'current_chat_mode')
-
-    # new dialog timeout
-    if use_new_dialog_timeout:
-        if (
-            datetime.now() - db.get_user_attribute(user_id, 'last_interaction')
-        ).seconds > config.new_dialog_timeout and len(
-            db.get_dialog_messages(user_id)
-        ) > 0:
-            db.start_new_dialog(user_id)
-            await update.message.reply_text(
-                f"Starting new dialog due to timeout (<b>{config.chat_modes[chat_mode]['name']}</b> mode) ✅",
-                parse_mode=ParseMode.HTML,
-            )
-    db.set_user_attribute(user_id, 'last_interaction', datetime.now())
-
-    buf = None
-    if update.message.effective_attachment:
-        photo = update.message.effective_attachment[-1]
-        photo_file = await context.bot.get_file(photo.file_id)
-
-        # store file in memory, not on disk
-        buf = io.BytesIO()
-        await photo_file.download_to_memory(buf)
-        buf.name = 'image.jpg'  # file extension is required
-        buf.seek(0)  # move cursor to the beginning of the buffer
+    chat_mode = await db.get_user_attribute(user_id, 'current_chat_mode')
 
     # in case of CancelledError
     n_input_tokens, n_output_tokens = 0, 0
 
     try:
-        # send placeholder message to user
-        placeholder_message = await update.message.reply_text('...')
+        # the placeholder is sent while the dialog and the photo are loaded,
+        # the model request doesn't wait for it
+        placeholder_message_task = asyncio.create_task(
+            send_placeholder(update, reply_timer)
+        )
         message = update.message.caption or update.message.text or ''
 
-        # send typing action
-        await update.message.chat.send_action(action='typing')
-
-        dialog_messages = db.get_dialog_messages(user_id, dialog_id=None)
+        (
+            (dialog_id, dialog_summary, dialog_messages, n_dropped_messages),
+            buf,
+        ) = await asyncio.gather(
+            prepare_dialog(update, user_id, chat_mode, use_new_dialog_timeout),
+            download_photo(update, context),
+        )
+        dialog_summary_text = (
+            dialog_summary['text'] if dialog_summary is not None else None
+        )
         parse_mode = {'html': ParseMode.HTML, 'markdown': ParseMode.MARKDOWN}[
             config.chat_modes[chat_mode]['parse_mode']
         ]
 
-        chatgpt_instance = openai_utils.ChatGPT(model=current_model)
+        async def on_queued(position):
+            placeholder_message = await placeholder_message_task
+            await placeholder_message.edit_text(
+                f'⏳ Queued, position {position}'
+            )
+
+        is_premium = await db.get_user_attribute(user_id, 'is_premium')
+        chatgpt_instance = openai_utils.ChatGPT(
+            model=current_model,
+            is_premium=bool(is_premium),
+            on_queued=on_queued,
+        )
+        reply_timer.mark('request_started')
         if config.enable_message_streaming:
             gen = chatgpt_instance.send_vision_message_stream(
                 message,
                 dialog_messages=dialog_messages,
                 image_buffer=buf,
                 chat_mode=chat_mode,
+                dialog_summary=dialog_summary_text,
             )
         else:
             (
@@ -286,6 +327,7 @@ async def _vision_message_handle_fn(
                 dialog_messages=dialog_messages,
                 image_buffer=buf,
                 chat_mode=chat_mode,
+                dialog_summary=dialog_summary_text,
             )
 
             async def fake_gen():
@@ -301,44 +343,31 @@ async def _vision_message_handle_fn(
 
             gen = fake_gen()
 
-        prev_answer = ''
-        async for gen_item in gen:
-            (
-                status,
-                answer,
-                (n_input_tokens, n_output_tokens),
-                n_first_dialog_messages_removed,
-            ) = gen_item
-
-            answer = answer[:4096]  # telegram message limit
-
-            # update only when 100 new symbols are ready
-            if (
-                abs(len(answer) - len(prev_answer)) < 100
-                and status != 'finished'
-            ):
-                continue
-
-            try:
-                await context.bot.edit_message_text(
+        # edits are paced and sent in the background, and answers longer
+        # than a message continue in new ones, see streaming.py
+        async with streaming.AnswerEditor(
+            context.bot,
+            update.message.chat_id,
+            placeholder_message_task,
+            parse_mode=parse_mode,
+            is_group=update.message.chat.type != 'private',
+            on_shown=lambda: reply_timer.mark('first_shown'),
+        ) as editor:
+            async for gen_item in gen:
+                (
+                    status,
                     answer,
-                    chat_id=placeholder_message.chat_id,
-                    message_id=placeholder_message.message_id,
-                    parse_mode=parse_mode,
-                )
-            except telegram.error.BadRequest as e:
-                if str(e).startswith('Message is not modified'):
-                    continue
-                else:
-                    await context.bot.edit_message_text(
-                        answer,
-                        chat_id=placeholder_message.chat_id,
-                        message_id=placeholder_message.message_id,
-                    )
+                    (n_input_tokens, n_output_tokens),
+                    n_first_dialog_messages_removed,
+                ) = gen_item
 
-            await asyncio.sleep(0.01)  # wait a bit to avoid flooding
+                if len(answer) > 0:
+                    reply_timer.mark('first_token')
 
-            prev_answer = answer
+                editor.update(answer)
+
+        # the messages before those loaded were left out too
+        n_first_dialog_messages_removed += n_dropped_messages
 
         # update user data
         if buf is not None:
@@ -363,21 +392,29 @@ async def _vision_message_handle_fn(
                 'bot': answer,
                 'date': datetime.now(),
             }
+        new_dialog_message['n_tokens'] = (
+            chatgpt_instance.get_dialog_message_n_tokens(new_dialog_message)
+        )
 
-        db.set_dialog_messages(
+        await db.add_dialog_message(
+            user_id, new_dialog_message, dialog_id=dialog_id
+        )
+        dialog_summarizer.submit(
             user_id,
-            db.get_dialog_messages(user_id, dialog_id=None)
-            + [new_dialog_message],
-            dialog_id=None,
+            dialog_id,
+            dialog_summary,
+            dialog_messages + [new_dialog_message],
+            n_dropped_messages=n_dropped_messages,
         )
 
-        db.update_n_used_tokens(
+        await db.update_n_used_tokens(
             user_id, current_model, n_input_tokens, n_output_tokens
         )
+        logger.debug(f'Reply timings: {reply_timer}')
 
     except asyncio.CancelledError:
         # note: intermediate token updates only work when enable_message_streaming=True (config.yml)
-        db.update_n_used_tokens(
+        await db.update_n_used_tokens(
             user_id, current_model, n_input_tokens, n_output_tokens
         )
         raise
@@ -388,6 +425,8 @@ async def _vision_message_handle_fn(
         await update.message.reply_text(error_text)
         return
 
+    await send_removed_messages_note(update, n_first_dialog_messages_removed)
+
 
 async def unsupport_message_handle(
     update: Update, context: CallbackContext, message=None
@@ -404,6 +443,8 @@ async def message_handle(
     message=None,
     use_new_dialog_timeout=True,
 ):
+    reply_timer = latency.ReplyTimer()
+
     # check if bot was mentioned (for group chats)
     if not await is_bot_mentioned(update, context):
         return
@@ -420,65 +461,72 @@ async def message_handle(
         _message = _message.replace('@' + context.bot.username, '').strip()
 
     await register_user_if_not_exists(
-        update, context, update.message.from_user
+        update, context, update.message.from_user, touch=False
     )
     if await is_previous_message_not_answered_yet(update, context):
         return
 
     user_id = update.message.from_user.id
-    chat_mode = db.get_user_attribute(user_id, 'current_chat_mode')
+    chat_mode = await db.get_user_attribute(user_id, 'current_chat_mode')
 
     if chat_mode == 'artist':
         await generate_image_handle(update, context, message=message)
         return
 
-    current_model = db.get_user_attribute(user_id, 'current_model')
+    current_model = await db.get_user_attribute(user_id, 'current_model')
 
     async def message_handle_fn():
-        # new dialog timeout
-        if use_new_dialog_timeout:
-            if (
-                datetime.now()
-                - db.get_user_attribute(user_id, 'last_interaction')
-            ).seconds > config.new_dialog_timeout and len(
-                db.get_dialog_messages(user_id)
-            ) > 0:
-                db.start_new_dialog(user_id)
-                await update.message.reply_text(
-                    f"Starting new dialog due to timeout (<b>{config.chat_modes[chat_mode]['name']}</b> mode) ✅",
-                    parse_mode=ParseMode.HTML,
-                )
-        db.set_user_attribute(user_id, 'last_interaction', datetime.now())
+        if _message is None or len(_message) == 0:
+            await update.message.reply_text(
+                '🥲 You sent <b>empty message</b>. Please, try again!',
+                parse_mode=ParseMode.HTML,
+            )
+            return
 
         # in case of CancelledError
         n_input_tokens, n_output_tokens = 0, 0
 
         try:
-            # send placeholder message to user
-            placeholder_message = await update.message.reply_text('...')
-
-            # send typing action
-            await update.message.chat.send_action(action='typing')
-
-            if _message is None or len(_message) == 0:
-                await update.message.reply_text(
-                    '🥲 You sent <b>empty message</b>. Please, try again!',
-                    parse_mode=ParseMode.HTML,
-                )
-                return
-
-            dialog_messages = db.get_dialog_messages(user_id, dialog_id=None)
+            # the placeholder is sent while the dialog is loaded, the model
+            # request doesn't wait for it
+            placeholder_message_task = asyncio.create_task(
+                send_placeholder(update, reply_timer)
+            )
+            (
+                dialog_id,
+                dialog_summary,
+                dialog_messages,
+                n_dropped_messages,
+            ) = await prepare_dialog(
+                update, user_id, chat_mode, use_new_dialog_timeout
+            )
+            dialog_summary_text = (
+                dialog_summary['text'] if dialog_summary is not None else None
+            )
             parse_mode = {
                 'html': ParseMode.HTML,
                 'markdown': ParseMode.MARKDOWN,
             }[config.chat_modes[chat_mode]['parse_mode']]
 
-            chatgpt_instance = openai_utils.ChatGPT(model=current_model)
+            async def on_queued(position):
+                placeholder_message = await placeholder_message_task
+                await placeholder_message.edit_text(
+                    f'⏳ Queued, position {position}'
+                )
+
+            is_premium = await db.get_user_attribute(user_id, 'is_premium')
+            chatgpt_instance = openai_utils.ChatGPT(
+                model=current_model,
+                is_premium=bool(is_premium),
+                on_queued=on_queued,
+            )
+            reply_timer.mark('request_started')
             if config.enable_message_streaming:
                 gen = chatgpt_instance.send_message_stream(
                     _message,
                     dialog_messages=dialog_messages,
                     chat_mode=chat_mode,
+                    dialog_summary=dialog_summary_text,
                 )
             else:
                 (
@@ -489,6 +537,7 @@ async def message_handle(
                     _message,
                     dialog_messages=dialog_messages,
                     chat_mode=chat_mode,
+                    dialog_summary=dialog_summary_text,
                 )
 
                 async def fake_gen():
@@ -501,45 +550,31 @@ async def message_handle(
 
                 gen = fake_gen()
 
-            prev_answer = ''
-
-            async for gen_item in gen:
-                (
-                    status,
-                    answer,
-                    (n_input_tokens, n_output_tokens),
-                    n_first_dialog_messages_removed,
-                ) = gen_item
-
-                answer = answer[:4096]  # telegram message limit
-
-                # update only when 100 new symbols are ready
-                if (
-                    abs(len(answer) - len(prev_answer)) < 100
-                    and status != 'finished'
-                ):
-                    continue
-
-                try:
-                    await context.bot.edit_message_text(
+            # edits are paced and sent in the background, and answers longer
+            # than a message continue in new ones, see streaming.py
+            async with streaming.AnswerEditor(
+                context.bot,
+                update.message.chat_id,
+                placeholder_message_task,
+                parse_mode=parse_mode,
+                is_group=update.message.chat.type != 'private',
+                on_shown=lambda: reply_timer.mark('first_shown'),
+            ) as editor:
+                async for gen_item in gen:
+                    (
+                        status,
                         answer,
-                        chat_id=placeholder_message.chat_id,
-                        message_id=placeholder_message.message_id,
-                        parse_mode=parse_mode,
-                    )
-                except telegram.error.BadRequest as e:
-                    if str(e).startswith('Message is not modified'):
-                        continue
-                    else:
-                        await context.bot.edit_message_text(
-                            answer,
-                            chat_id=placeholder_message.chat_id,
-                            message_id=placeholder_message.message_id,
-                        )
+                        (n_input_tokens, n_output_tokens),
+                        n_first_dialog_messages_removed,
+                    ) = gen_item
+
+                    if len(answer) > 0:
+                        reply_timer.mark('first_token')
 
-                await asyncio.sleep(0.01)  # wait a bit to avoid flooding
+                    editor.update(answer)
 
-                prev_answer = answer
+            # the messages before those loaded were left out too
+            n_first_dialog_messages_removed += n_dropped_messages
 
             # update user data
             new_dialog_message = {
@@ -547,21 +582,31 @@ async def message_handle(
                 'bot': answer,
                 'date': datetime.now(),
             }
+            new_dialog_message['n_tokens'] = (
+                chatgpt_instance.get_dialog_message_n_tokens(
+                    new_dialog_message
+                )
+            )
 
-            db.set_dialog_messages(
+            await db.add_dialog_message(
+                user_id, new_dialog_message, dialog_id=dialog_id
+            )
+            dialog_summarizer.submit(
                 user_id,
-                db.get_dialog_messages(user_id, dialog_id=None)
-                + [new_dialog_message],
-                dialog_id=None,
+                dialog_id,
+                dialog_summary,
+                dialog_messages + [new_dialog_message],
+                n_dropped_messages=n_dropped_messages,
             )
 
-            db.update_n_used_tokens(
+            await db.update_n_used_tokens(
                 user_id, current_model, n_input_tokens, n_output_tokens
             )
+            logger.debug(f'Reply timings: {reply_timer}')
 
         except asyncio.CancelledError:
             # note: intermediate token updates only work when enable_message_streaming=True (config.yml)
-            db.update_n_used_tokens(
+            await db.update_n_used_tokens(
                 user_id, current_model, n_input_tokens, n_output_tokens
             )
             raise
@@ -572,13 +617,9 @@ async def message_handle(
             await update.message.reply_text(error_text)
             return
 
-        # send message if some messages were removed from the context
-        if n_first_dialog_messages_removed > 0:
-            if n_first_dialog_messages_removed == 1:
-                text = '✍️ <i>Note:</i> Your current dialog is too long, so your <b>first message</b> was removed from the context.\n Send /new command to start new dialog'
-            else:
-                text = f'✍️ <i>Note:</i> Your current dialog is too long, so <b>{n_first_dialog_messages_removed} first messages</b> were removed from the context.\n Send /new command to start new dialog'
-            await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+        await send_removed_messages_note(
+            update, n_first_dialog_messages_removed
+        )
 
     async with user_semaphores[user_id]:
         if (
@@ -595,11 +636,12 @@ async def message_handle(
                 and current_model != 'gpt-4-vision-preview'
             ):
                 current_model = 'gpt-4o'
-                db.set_user_attribute(user_id, 'current_model', 'gpt-4o')
+                await db.set_user_attribute(user_id, 'current_model', 'gpt-4o')
             task = asyncio.create_task(
                 _vision_message_handle_fn(
                     update,
                     context,
+                    reply_timer,
                     use_new_dialog_timeout=use_new_dialog_timeout,
                 )
             )
@@ -625,7 +667,7 @@ async def is_previous_message_not_answered_yet(
     update: Update, context: CallbackContext
 ):
     await register_user_if_not_exists(
-        update, context, update.message.from_user
+        update, context, update.message.from_user, touch=False
     )
 
     user_id = update.message.from_user.id
@@ -656,7 +698,6 @@ async def voice_message_handle(update: Update, context: CallbackContext):
         return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, 'last_interaction', datetime.now())
 
     voice = update.message.voice
     voice_file = await context.bot.get_file(voice.file_id)
@@ -672,11 +713,8 @@ async def voice_message_handle(update: Update, context: CallbackContext):
     await update.message.reply_text(text, parse_mode=ParseMode.HTML)
 
     # update n_transcribed_seconds
-    db.set_user_attribute(
-        user_id,
-        'n_transcribed_seconds',
-        voice.duration
-        + db.get_user_attribute(user_id, 'n_transcribed_seconds'),
+    await db.inc_user_attribute(
+        user_id, 'n_transcribed_seconds', voice.duration
     )
 
     await message_handle(update, context, message=transcribed_text)
@@ -692,7 +730,6 @@ async def generate_image_handle(
         return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, 'last_interaction', datetime.now())
 
     await update.message.chat.send_action(action='upload_photo')
 
@@ -715,11 +752,8 @@ async def generate_image_handle(
             raise
 
     # token usage
-    db.set_user_attribute(
-        user_id,
-        'n_generated_images',
-        config.return_n_generated_images
-        + db.get_user_attribute(user_id, 'n_generated_images'),
+    await db.inc_user_attribute(
+        user_id, 'n_generated_images', config.return_n_generated_images
     )
 
     for i, image_url in enumerate(image_urls):
@@ -729,19 +763,20 @@ async def generate_image_handle(
 
 async def new_dialog_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(
-        update, context, update.message.from_user
+        update, context, update.message.from_user, touch=False
     )
     if await is_previous_message_not_answered_yet(update, context):
         return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, 'last_interaction', datetime.now())
-    db.set_user_attribute(user_id, 'current_model', 'gpt-3.5-turbo')
+    await db.set_user_attributes(
+        user_id, last_interaction=datetime.now(), current_model='gpt-3.5-turbo'
+    )
 
-    db.start_new_dialog(user_id)
+    await db.start_new_dialog(user_id)
     await update.message.reply_text('Starting new dialog ✅')
 
-    chat_mode = db.get_user_attribute(user_id, 'current_chat_mode')
+    chat_mode = await db.get_user_attribute(user_id, 'current_chat_mode')
     await update.message.reply_text(
         f"{config.chat_modes[chat_mode]['welcome_message']}",
         parse_mode=ParseMode.HTML,
@@ -754,7 +789,6 @@ async def cancel_handle(update: Update, context: CallbackContext):
     )
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, 'last_interaction', datetime.now())
 
     if user_id in user_tasks:
         task = user_tasks[user_id]
@@ -837,7 +871,6 @@ async def show_chat_modes_handle(update: Update, context: CallbackContext):
         return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, 'last_interaction', datetime.now())
 
     text, reply_markup = get_chat_mode_menu(0)
     await update.message.reply_text(
@@ -857,7 +890,6 @@ async def show_chat_modes_callback_handle(
         return
 
     user_id = update.callback_query.from_user.id
-    db.set_user_attribute(user_id, 'last_interaction', datetime.now())
 
     query = update.callback_query
     await query.answer()
@@ -878,7 +910,10 @@ async def show_chat_modes_callback_handle(
 
 async def set_chat_mode_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(
-        update.callback_query, context, update.callback_query.from_user
+        update.callback_query,
+        context,
+        update.callback_query.from_user,
+        touch=False,
     )
     user_id = update.callback_query.from_user.id
 
@@ -887,8 +922,8 @@ async def set_chat_mode_handle(update: Update, context: CallbackContext):
 
     chat_mode = query.data.split('|')[1]
 
-    db.set_user_attribute(user_id, 'current_chat_mode', chat_mode)
-    db.start_new_dialog(user_id)
+    await db.set_user_attribute(user_id, 'current_chat_mode', chat_mode)
+    await db.start_new_dialog(user_id)
 
     await context.bot.send_message(
         update.callback_query.message.chat.id,
@@ -897,8 +932,8 @@ async def set_chat_mode_handle(update: Update, context: CallbackContext):
     )
 
 
-def get_settings_menu(user_id: int):
-    current_model = db.get_user_attribute(user_id, 'current_model')
+async def get_settings_menu(user_id: int):
+    current_model = await db.get_user_attribute(user_id, 'current_model')
     text = config.models['info'][current_model]['description']
 
     text += '\n\n'
@@ -937,9 +972,8 @@ async def settings_handle(update: Update, context: CallbackContext):
         return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, 'last_interaction', datetime.now())
 
-    text, reply_markup = get_settings_menu(user_id)
+    text, reply_markup = await get_settings_menu(user_id)
     await update.message.reply_text(
         text, reply_markup=reply_markup, parse_mode=ParseMode.HTML
     )
@@ -947,7 +981,10 @@ async def settings_handle(update: Update, context: CallbackContext):
 
 async def set_settings_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(
-        update.callback_query, context, update.callback_query.from_user
+        update.callback_query,
+        context,
+        update.callback_query.from_user,
+        touch=False,
     )
     user_id = update.callback_query.from_user.id
 
@@ -955,10 +992,10 @@ async def set_settings_handle(update: Update, context: CallbackContext):
     await query.answer()
 
     _, model_key = query.data.split('|')
-    db.set_user_attribute(user_id, 'current_model', model_key)
-    db.start_new_dialog(user_id)
+    await db.set_user_attribute(user_id, 'current_model', model_key)
+    await db.start_new_dialog(user_id)
 
-    text, reply_markup = get_settings_menu(user_id)
+    text, reply_markup = await get_settings_menu(user_id)
     try:
         await query.edit_message_text(
             text, reply_markup=reply_markup, parse_mode=ParseMode.HTML
@@ -988,11 +1025,21 @@ async def consider_payment(chat_id, context):
     )
 
 
+def parse_premium_till(premium_till):
+    # subscriptions store a datetime, older documents may hold a string
+    if isinstance(premium_till, str):
+        return datetime.strptime(premium_till, '%Y-%m-%d %H:%M:%S.%f')
+    return premium_till
+
+
 async def check_premium(user_id):
-    is_premium = db.get_user_attribute(user_id, 'is_premium')
+    is_premium = await db.get_user_attribute(user_id, 'is_premium')
     if is_premium:
-        premium_till = db.get_user_attribute(user_id, 'premium_till')
-        premium_till = datetime.strptime(premium_till, '%Y-%m-%d %H:%M:%S.%f')
+        premium_till = parse_premium_till(
+            await db.get_user_attribute(user_id, 'premium_till')
+        )
+        if premium_till is None:
+            return False
         is_premium = (premium_till - datetime.now()).total_seconds() > 0
         return is_premium
     return False
@@ -1009,7 +1056,7 @@ async def get_balance_state(chat_id, is_premium, daily_messages):
 
 async def show_balance_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(
-        update, context, update.message.from_user
+        update, context, update.message.from_user, touch=False
     )
 
     user_id = update.message.from_user.id
@@ -1019,8 +1066,8 @@ async def show_balance_handle(update: Update, context: CallbackContext):
         [InlineKeyboardButton('🔒 Unsubscribe', callback_data='unsubscribe')]
     ]
     is_premium = await check_premium(user_id)
-    premium_till = db.get_user_attribute(user_id, 'premium_till')
-    daily_messages = db.get_user_attribute(user_id, 'daily_messages')
+    premium_till = await db.get_user_attribute(user_id, 'premium_till')
+    daily_messages = await db.get_user_attribute(user_id, 'daily_messages')
     balance_state = await get_balance_state(
         user_id, is_premium, daily_messages
     )
@@ -1037,7 +1084,7 @@ async def show_balance_handle(update: Update, context: CallbackContext):
         reply_markup = None
         reply_markup = InlineKeyboardMarkup(UNSUBSCRIBE)
 
-        sub_date = datetime.strptime(premium_till, '%Y-%m-%d %H:%M:%S.%f')
+        sub_date = parse_premium_till(premium_till)
         sub_date.strftime('%m/%d/%Y %I:%M %p')
         message = f'<b>Your subscription is valid till {sub_date}</b>'
         message += f'\n{balance_state}'
@@ -1095,6 +1142,10 @@ async def error_handle(update: Update, context: CallbackContext) -> None:
 async def post_init(application: Application):
     from src_bot.bot.enums import CommandEnum
 
+    await db.start()
+    await openai_utils.start_http_session()
+    dialog_summarizer.start()
+
     await application.bot.set_my_commands(
         [
             BotCommand('/new', 'Start new dialog'),
@@ -1114,17 +1165,49 @@ async def post_init(application: Application):
     )
 
 
-def run_bot() -> None:
-    application = (
+async def post_shutdown(application: Application):
+    await dialog_summarizer.stop()
+    logger.info(f'Reply latency: {latency.stats()}')
+    logger.info(f'Answer edits: {streaming.edit_stats.stats()}')
+    logger.info(f'Telegram egress: {egress.egress_stats.stats()}')
+    logger.info(f'User cache: {db.user_cache.stats()}')
+    # write out usage counters that are still buffered
+    await db.close()
+    await openai_utils.close_http_session()
+
+
+# the update types the handlers below are for
+ALLOWED_UPDATES = [
+    Update.MESSAGE,
+    Update.EDITED_MESSAGE,
+    Update.CALLBACK_QUERY,
+]
+
+
+def build_application() -> Application:
+    global db, dialog_summarizer
+    db = database.Database()
+    dialog_summarizer = summarization.DialogSummarizer(db)
+
+    is_webhook = config.telegram_webhook_url is not None
+    n_processes = config.telegram_webhook_workers if is_webhook else 1
+    builder = (
         ApplicationBuilder()
         .token(config.telegram_token)
+        .base_url(config.telegram_api_base_url)
         .concurrent_updates(True)
-        .rate_limiter(AIORateLimiter(max_retries=5))
+        .rate_limiter(
+            egress.EgressScheduler(max_retries=5, n_processes=n_processes)
+        )
         .http_version('1.1')
         .get_updates_http_version('1.1')
         .post_init(post_init)
-        .build()
+        .post_shutdown(post_shutdown)
     )
+    if is_webhook:
+        # updates come from the webhook server
+        builder = builder.updater(None)
+    application = builder.build()
 
     # add handlers
     user_filter = filters.ALL
@@ -1220,8 +1303,14 @@ def run_bot() -> None:
 
     add_handlers(application=application, filters=user_filter)
 
-    # start the bot
-    application.run_polling()
+    return application
+
+
+def run_bot() -> None:
+    if config.telegram_webhook_url is not None:
+        webhook.run_webhook(build_application, ALLOWED_UPDATES)
+    else:
+        build_application().run_polling(allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == '__main__':
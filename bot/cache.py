@@ -0,0 +1,113 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class TTLCache:
+    """
+    LRU cache whose entries also expire `ttl` seconds after being stored.
+
+    A value read from its source while the key changed may be stale, so loads
+    are bracketed by `begin_load` and `end_load`: the loaded value is only
+    stored if the key wasn't set, popped or marked stale in between.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 30.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        # keys being loaded: key -> [number of loads, generation]
+        self._loads = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        self.mark_stale(key)
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        self.mark_stale(key)
+        item = self._data.pop(key, None)
+        if item is None:
+            return default
+        return item[1]
+
+    def peek(self, key: Hashable) -> Optional[Any]:
+        """Returns a live entry without touching LRU order or hit counters."""
+        item = self._data.get(key)
+        if item is None or item[0] < time.monotonic():
+            return None
+        return item[1]
+
+    def clear(self):
+        for key in self._loads:
+            self.mark_stale(key)
+        self._data.clear()
+
+    def begin_load(self, key: Hashable) -> int:
+        """Call before reading `key` from its source; returns the generation to pass to `end_load`."""
+        load = self._loads.setdefault(key, [0, 0])
+        load[0] += 1
+        return load[1]
+
+    def end_load(self, key: Hashable, generation: int, value: Any = None) -> bool:
+        """Stores the loaded `value` (unless None) if `key` didn't change since `begin_load`; returns whether it did."""
+        load = self._loads[key]
+        load[0] -= 1
+        if load[0] == 0:
+            del self._loads[key]
+
+        if value is None or load[1] != generation:
+            return False
+        self.set(key, value)
+        return True
+
+    def mark_stale(self, key: Hashable):
+        """Keeps loads of `key` in progress from storing what they read."""
+        load = self._loads.get(key)
+        if load is not None:
+            load[1] += 1
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.peek(key) is not None
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    @property
+    def hit_rate(self) -> float:
+        n_lookups = self.hits + self.misses
+        return self.hits / n_lookups if n_lookups > 0 else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hit_rate,
+        }
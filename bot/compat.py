@@ -0,0 +1,11 @@
+"""Backports of standard library helpers missing from Python 3.8, which the Docker image runs."""
+import contextlib
+
+
+@contextlib.asynccontextmanager
+async def aclosing(thing):
+    """`contextlib.aclosing` (Python 3.10+)."""
+    try:
+        yield thing
+    finally:
+        await thing.aclose()
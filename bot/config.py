@@ -1,8 +1,10 @@
+import os
 import yaml
 import dotenv
 from pathlib import Path
 
-config_dir = Path(__file__).parent.parent.resolve() / 'config'
+# tests and benchmarks point BOT_CONFIG_DIR at a config of their own
+config_dir = Path(os.environ.get('BOT_CONFIG_DIR') or Path(__file__).parent.parent.resolve() / 'config')
 
 # load yaml config
 with open(config_dir / 'config.yml', 'r') as f:
@@ -15,13 +17,73 @@ config_env = dotenv.dotenv_values(config_dir / 'config.env')
 telegram_token = config_yaml['telegram_token']
 openai_api_key = config_yaml['openai_api_key']
 openai_api_base = config_yaml.get('openai_api_base', None)
+openai_endpoints = config_yaml.get('openai_endpoints') or [
+    {'api_key': openai_api_key, 'api_base': openai_api_base}
+]
+openai_endpoint_eject_after = config_yaml.get('openai_endpoint_eject_after', 3)
+openai_endpoint_eject_seconds = config_yaml.get('openai_endpoint_eject_seconds', 30.0)
+openai_endpoint_max_eject_seconds = config_yaml.get('openai_endpoint_max_eject_seconds', 600.0)
+openai_pool_size = config_yaml.get('openai_pool_size', 100)
+openai_stream_stall_timeout = config_yaml.get('openai_stream_stall_timeout', 20.0)
+openai_stream_max_resumes = config_yaml.get('openai_stream_max_resumes', 2)
+openai_hedge_enabled = config_yaml.get('openai_hedge_enabled', False)
+openai_hedge_percentile = config_yaml.get('openai_hedge_percentile', 95)
+openai_hedge_default_delay = config_yaml.get('openai_hedge_default_delay', 5.0)
+openai_hedge_min_delay = config_yaml.get('openai_hedge_min_delay', 1.0)
+openai_hedge_window_size = config_yaml.get('openai_hedge_window_size', 200)
+openai_hedge_min_samples = config_yaml.get('openai_hedge_min_samples', 20)
+openai_max_concurrent_requests = config_yaml.get('openai_max_concurrent_requests', 20)
+premium_lane_weight = config_yaml.get('premium_lane_weight', 3)
+openai_pool_size_per_host = config_yaml.get('openai_pool_size_per_host', 50)
+openai_keepalive_timeout = config_yaml.get('openai_keepalive_timeout', 30.0)
+openai_timeout_min = config_yaml.get('openai_timeout_min', 15.0)
+openai_timeout_max = config_yaml.get('openai_timeout_max', 120.0)
+openai_max_attempts = config_yaml.get('openai_max_attempts', 4)
+openai_retry_base_delay = config_yaml.get('openai_retry_base_delay', 0.5)
+openai_retry_max_delay = config_yaml.get('openai_retry_max_delay', 20.0)
+openai_circuit_failure_threshold = config_yaml.get('openai_circuit_failure_threshold', 5)
+openai_circuit_cooldown = config_yaml.get('openai_circuit_cooldown', 30.0)
+telegram_edit_interval = config_yaml.get('telegram_edit_interval', 1.0)
+telegram_group_edit_interval = config_yaml.get('telegram_group_edit_interval', 3.0)
+telegram_edit_min_chars = config_yaml.get('telegram_edit_min_chars', 30)
+telegram_edit_max_wait = config_yaml.get('telegram_edit_max_wait', 3.0)
+telegram_edit_max_interval = config_yaml.get('telegram_edit_max_interval', 10.0)
+telegram_global_rate = config_yaml.get('telegram_global_rate', 30)
+telegram_chat_rate = config_yaml.get('telegram_chat_rate', 1.0)
+telegram_group_rate = config_yaml.get('telegram_group_rate', 20)
+telegram_chat_burst = config_yaml.get('telegram_chat_burst', 3)
+telegram_edit_max_queue_time = config_yaml.get('telegram_edit_max_queue_time', 2.0)
+telegram_api_base_url = config_yaml.get('telegram_api_base_url', 'https://api.telegram.org/bot')
+telegram_webhook_url = config_yaml.get('telegram_webhook_url', None)
+telegram_webhook_secret = config_yaml.get('telegram_webhook_secret', None)
+telegram_webhook_host = config_yaml.get('telegram_webhook_host', '0.0.0.0')
+telegram_webhook_port = config_yaml.get('telegram_webhook_port', 8443)
+telegram_webhook_workers = config_yaml.get('telegram_webhook_workers', 1)
 allowed_telegram_usernames = config_yaml['allowed_telegram_usernames']
 new_dialog_timeout = config_yaml['new_dialog_timeout']
 enable_message_streaming = config_yaml.get('enable_message_streaming', True)
 return_n_generated_images = config_yaml.get('return_n_generated_images', 1)
 image_size = config_yaml.get('image_size', '512x512')
 n_chat_modes_per_page = config_yaml.get('n_chat_modes_per_page', 5)
+max_context_dialog_messages = config_yaml.get('max_context_dialog_messages', 30)
+storage_backend = config_yaml.get('storage_backend', 'mongo')
 mongodb_uri = f"mongodb://mongo:{config_env['MONGODB_PORT']}"
+sqlite_path = config_yaml.get('sqlite_path', str(config_dir.parent / 'data' / 'bot.sqlite3'))
+user_cache_size = config_yaml.get('user_cache_size', 10000)
+user_cache_ttl = config_yaml.get('user_cache_ttl', 30.0)
+user_cache_poll_ttl = config_yaml.get('user_cache_poll_ttl', 2.0)
+db_flush_interval = config_yaml.get('db_flush_interval', 0.3)
+dialog_summary_enabled = config_yaml.get('dialog_summary_enabled', False)
+dialog_summary_model = config_yaml.get('dialog_summary_model', 'gpt-3.5-turbo')
+dialog_summary_threshold_tokens = config_yaml.get('dialog_summary_threshold_tokens', 3000)
+dialog_summary_keep_messages = config_yaml.get('dialog_summary_keep_messages', 4)
+dialog_summary_batch_tokens = config_yaml.get('dialog_summary_batch_tokens', 8000)
+dialog_summary_max_tokens = config_yaml.get('dialog_summary_max_tokens', 500)
+dialog_archive_after_days = config_yaml.get('dialog_archive_after_days', 30)
+dialog_archive_ttl_days = config_yaml.get('dialog_archive_ttl_days', None)
+dialog_archive_interval = config_yaml.get('dialog_archive_interval', 3600)
+dialog_archive_batch_size = config_yaml.get('dialog_archive_batch_size', 500)
+dialog_archive_compression_level = config_yaml.get('dialog_archive_compression_level', 6)
 
 # chat_modes
 with open(config_dir / 'chat_modes.yml', 'r') as f:
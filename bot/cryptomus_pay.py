@@ -65,7 +65,7 @@ async def create_invoice(db, user_id: int, amount: int, currency: str, network:
         invoice = await response.json()
 
         if "result" in invoice and "uuid" in invoice["result"]:
-            db.add_new_payment(
+            await db.add_new_payment(
                 user_id=user_id,
                 amount=float(invoice["result"]["amount"]),
                 currency=invoice["result"]["currency"],
@@ -110,15 +110,15 @@ async def get_invoice(db, uuid: str) -> Any:
         )
         invoice = await response.json()
 
-        pay_doc = db.payment_collection.find_one({"additional_data.uuid": uuid})
+        pay_doc = await db.get_payment_by_invoice_uuid(uuid)
         if pay_doc and "result" in invoice:
             new_status = invoice["result"].get("status", pay_doc["status"])
-            db.update_payment_status(pay_doc["_id"], new_status)
+            await db.update_payment_status(pay_doc["_id"], new_status)
 
         return invoice
 
 
-def cryptomus_webhook_handler(db, request):
+async def cryptomus_webhook_handler(db, request):
     """
         Обработчик вебхука от Cryptomus.
 
@@ -166,7 +166,7 @@ def cryptomus_webhook_handler(db, request):
     payment_status = data.get("status", "")
     payment_id = data.get("uuid")
 
-    pay_doc = db.payment_collection.find_one({"payment_id": payment_id})
+    pay_doc = await db.get_payment_by_external_id(payment_id)
     if not pay_doc:
         logger.error(f"Платеж с ID {payment_id} не найден в базе данных.")
         return HttpResponse(status=400)
@@ -175,14 +175,14 @@ def cryptomus_webhook_handler(db, request):
         logger.error("Не указан payment_id (uuid) в данных платежа.")
         return HttpResponse(status=400)
 
-    db.update_payment_status(pay_doc["_id"], payment_status)
+    await db.update_payment_status(pay_doc["_id"], payment_status)
     logger.info(f"Статус платежа {payment_id} обновлен на {payment_status}.")
 
     if payment_status == "paid":
         # Активируем подписку пользователю на основании telegram_id
         telegram_id = pay_doc.get("telegram_id")
         if telegram_id:
-            db.update_user_subscription(telegram_id, duration_days=30)
+            await db.update_user_subscription(telegram_id, duration_days=30)
             logger.info(f"Подписка для пользователя с telegram_id={telegram_id} активирована на 30 дней.")
         else:
             logger.warning(f"Для платежа {payment_id} не указан telegram_id, невозможно активировать подписку.")
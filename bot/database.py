@@ -1,23 +1,78 @@
 from typing import Optional, Any
 from datetime import datetime, timedelta
-import pymongo
+import asyncio
+import collections
+import copy
+import logging
 import uuid
-from datetime import datetime
 
 import config
+from cache import TTLCache
+from invalidation import CacheInvalidator
+from storage import Storage, create_storage
+from storage.base import inc_path
 
+logger = logging.getLogger(__name__)
 
-class Database:
-    def __init__(self):
-        self.client = pymongo.MongoClient(config.mongodb_uri)
-        self.db = self.client["chatgpt_telegram_bot"]
 
-        self.user_collection = self.db["user"]
-        self.dialog_collection = self.db["dialog"]
-        self.payment_collection = self.db["payments"]
+class Database:
+    # fields added after the first release; old documents may lack them
+    BACKFILLED_USER_FIELDS = ("current_dialog_id", "current_model", "n_used_tokens", "n_transcribed_seconds", "n_generated_images")
+
+    def __init__(self, storage: Optional[Storage] = None):
+        self.storage = storage or create_storage(config.storage_backend)
+
+        # user documents are read on almost every handler step, so keep hot ones
+        # in memory and write through on every update made via this class
+        self.user_cache = TTLCache(maxsize=config.user_cache_size, ttl=config.user_cache_ttl)
+        # ...and evict them when another process changes them
+        self.invalidator = CacheInvalidator(self.storage, self.user_cache)
+
+        # counter increments waiting for the next bulk flush: {user_id: {path: value}}
+        self._pending_increments = {}
+        # users whose increments flush() is writing: {user_id: number of flushes}
+        self._flushing_users = collections.Counter()
+        self._flush_task = None
+        # flushes started by _buffer_increments when there is no flusher
+        self._write_through_tasks = set()
+
+    async def start(self):
+        """Prepares the storage backend and starts background tasks."""
+        await self.storage.start()
+        self.invalidator.start()
+        self.start_flusher()
+
+    async def _get_user(self, user_id: int) -> Optional[dict]:
+        user_dict = self.user_cache.get(user_id)
+        if user_dict is None:
+            generation = self.user_cache.begin_load(user_id)
+            try:
+                user_dict = await self.storage.get_user(user_id)
+            finally:
+                if user_dict is not None:
+                    # increments not flushed yet are missing from the stored document
+                    self._apply_increments(user_dict, self._pending_increments.get(user_id, {}))
+                # whether the document has the increments being flushed is unknown
+                is_flushing = self._flushing_users[user_id] > 0
+                self.user_cache.end_load(user_id, generation, None if is_flushing else user_dict)
+
+        return user_dict
+
+    def _update_cached_user(self, user_id: int, fields: dict):
+        user_dict = self.user_cache.peek(user_id)
+        if user_dict is None:
+            # a read in progress may have missed the update
+            self.user_cache.mark_stale(user_id)
+            return
+
+        if any("." in key for key in fields):
+            # nested paths are not mirrored locally, just reload on next read
+            self.user_cache.pop(user_id)
+        else:
+            user_dict.update(copy.deepcopy(fields))
 
-    def check_if_user_exists(self, user_id: int, raise_exception: bool = False):
-        if self.user_collection.count_documents({"_id": user_id}) > 0:
+    async def check_if_user_exists(self, user_id: int, raise_exception: bool = False):
+        if await self._get_user(user_id) is not None:
             return True
         else:
             if raise_exception:
@@ -25,15 +80,15 @@ class Database:
             else:
                 return False
 
-    def add_new_user(
+    def _new_user_dict(
         self,
         user_id: int,
         chat_id: int,
         username: str = "",
         first_name: str = "",
         last_name: str = "",
-    ):
-        user_dict = {
+    ) -> dict:
+        return {
             "_id": user_id,
             "chat_id": chat_id,
 
@@ -57,87 +112,299 @@ class Database:
             "daily_messages":0,
         }
 
-        if not self.check_if_user_exists(user_id):
-            self.user_collection.insert_one(user_dict)
-
-    def start_new_dialog(self, user_id: int):
-        self.check_if_user_exists(user_id, raise_exception=True)
-
-        dialog_id = str(uuid.uuid4())
-        dialog_dict = {
-            "_id": dialog_id,
+    def _new_dialog_dict(self, user_id: int, chat_mode: str, model: str, dialog_id: Optional[str] = None) -> dict:
+        return {
+            "_id": dialog_id or str(uuid.uuid4()),
             "user_id": user_id,
-            "chat_mode": self.get_user_attribute(user_id, "current_chat_mode"),
+            "chat_mode": chat_mode,
             "start_time": datetime.now(),
-            "model": self.get_user_attribute(user_id, "current_model"),
+            "updated_at": datetime.now(),
+            "model": model,
             "messages": []
         }
 
+    def _is_user_up_to_date(self, user_dict: dict) -> bool:
+        return (
+            all(user_dict.get(key) is not None for key in self.BACKFILLED_USER_FIELDS)
+            and isinstance(user_dict["n_used_tokens"], dict)
+        )
+
+    async def add_new_user(
+        self,
+        user_id: int,
+        chat_id: int,
+        username: str = "",
+        first_name: str = "",
+        last_name: str = "",
+    ):
+        user_dict = self._new_user_dict(
+            user_id, chat_id, username=username, first_name=first_name, last_name=last_name
+        )
+
+        if not await self.check_if_user_exists(user_id):
+            await self.storage.insert_user(user_dict)
+            self.user_cache.set(user_id, user_dict)
+
+    async def register_user(
+        self,
+        user_id: int,
+        chat_id: int,
+        username: str = "",
+        first_name: str = "",
+        last_name: str = "",
+        touch: bool = True,
+    ) -> dict:
+        """
+        Creates the user if needed, backfills missing fields of old documents and,
+        if `touch` is set, bumps `last_interaction` - all in a single upsert.
+        Returns the resulting user document.
+        """
+        defaults = self._new_user_dict(
+            user_id, chat_id, username=username, first_name=first_name, last_name=last_name
+        )
+        del defaults["_id"]
+
+        if not touch:
+            user_dict = await self._get_user(user_id)
+            if user_dict is not None and self._is_user_up_to_date(user_dict):
+                return user_dict
+
+        # a dialog is only created if the upsert below leaves this id in place
+        new_dialog_id = str(uuid.uuid4())
+        defaults["current_dialog_id"] = new_dialog_id
+
+        fields = {"last_interaction": defaults.pop("last_interaction")} if touch else {}
+        user_dict = await self.storage.upsert_user(user_id, defaults, fields)
+
+        # back compatibility for n_used_tokens field
+        n_used_tokens = user_dict["n_used_tokens"]
+        if isinstance(n_used_tokens, (int, float)):  # old format
+            user_dict["n_used_tokens"] = {
+                self._model_key("gpt-3.5-turbo"): {
+                    "n_input_tokens": 0,
+                    "n_output_tokens": n_used_tokens,
+                }
+            }
+            await self.storage.update_user(user_id, {"n_used_tokens": user_dict["n_used_tokens"]})
+
+        if user_dict["current_dialog_id"] == new_dialog_id:
+            await self.storage.insert_dialog(self._new_dialog_dict(
+                user_id, user_dict["current_chat_mode"], user_dict["current_model"], dialog_id=new_dialog_id
+            ))
+
+        self._apply_increments(user_dict, self._pending_increments.get(user_id, {}))
+        self.user_cache.set(user_id, user_dict)
+        return user_dict
+
+    async def start_new_dialog(self, user_id: int):
+        user_dict = await self._get_user(user_id)
+        if user_dict is None:
+            raise ValueError(f"User {user_id} does not exist")
+
+        dialog_dict = self._new_dialog_dict(user_id, user_dict["current_chat_mode"], user_dict["current_model"])
+        dialog_id = dialog_dict["_id"]
+
         # add new dialog
-        self.dialog_collection.insert_one(dialog_dict)
+        await self.storage.insert_dialog(dialog_dict)
 
         # update user's current dialog
-        self.user_collection.update_one(
-            {"_id": user_id},
-            {"$set": {"current_dialog_id": dialog_id}}
-        )
+        await self.storage.update_user(user_id, {"current_dialog_id": dialog_id})
+        self._update_cached_user(user_id, {"current_dialog_id": dialog_id})
         return dialog_id
 
-    def get_user_attribute(self, user_id: int, key: str):
-        self.check_if_user_exists(user_id, raise_exception=True)
-        user_dict = self.user_collection.find_one({"_id": user_id})
+    async def get_user_attribute(self, user_id: int, key: str):
+        user_dict = await self._get_user(user_id)
+        if user_dict is None:
+            raise ValueError(f"User {user_id} does not exist")
 
         if key not in user_dict:
             return None
 
-        return user_dict[key]
+        # callers may mutate the value, don't let that leak into the cache
+        return copy.deepcopy(user_dict[key])
 
-    def set_user_attribute(self, user_id: int, key: str, value: Any):
-        self.check_if_user_exists(user_id, raise_exception=True)
-        self.user_collection.update_one({"_id": user_id}, {"$set": {key: value}})
+    async def set_user_attribute(self, user_id: int, key: str, value: Any):
+        await self.set_user_attributes(user_id, **{key: value})
 
-    def update_n_used_tokens(self, user_id: int, model: str, n_input_tokens: int, n_output_tokens: int):
-        n_used_tokens_dict = self.get_user_attribute(user_id, "n_used_tokens")
+    async def set_user_attributes(self, user_id: int, **fields: Any):
+        if not await self.storage.update_user(user_id, fields):
+            self.user_cache.pop(user_id)
+            raise ValueError(f"User {user_id} does not exist")
 
-        if model in n_used_tokens_dict:
-            n_used_tokens_dict[model]["n_input_tokens"] += n_input_tokens
-            n_used_tokens_dict[model]["n_output_tokens"] += n_output_tokens
-        else:
-            n_used_tokens_dict[model] = {
-                "n_input_tokens": n_input_tokens,
-                "n_output_tokens": n_output_tokens
-            }
+        self._update_cached_user(user_id, fields)
 
-        self.set_user_attribute(user_id, "n_used_tokens", n_used_tokens_dict)
+    @staticmethod
+    def _model_key(model: str) -> str:
+        # model names like "gpt-3.5-turbo" can't be used in a dotted update path
+        return model.replace(".", "_")
 
-    def get_dialog_messages(self, user_id: int, dialog_id: Optional[str] = None):
-        self.check_if_user_exists(user_id, raise_exception=True)
+    async def update_n_used_tokens(self, user_id: int, model: str, n_input_tokens: int, n_output_tokens: int):
+        model_key = self._model_key(model)
+        self._buffer_increments(user_id, {
+            f"n_used_tokens.{model_key}.n_input_tokens": n_input_tokens,
+            f"n_used_tokens.{model_key}.n_output_tokens": n_output_tokens,
+        })
+
+    async def get_n_used_tokens(self, user_id: int) -> dict:
+        """
+        Returns {model: {"n_input_tokens": ..., "n_output_tokens": ...}}, merging
+        entries written before model names were escaped.
+        """
+        model_by_key = {self._model_key(model): model for model in config.models["info"]}
+
+        n_used_tokens = {}
+        for key, value in (await self.get_user_attribute(user_id, "n_used_tokens") or {}).items():
+            model = model_by_key.get(key, key)
+            model_n_used_tokens = n_used_tokens.setdefault(model, {"n_input_tokens": 0, "n_output_tokens": 0})
+            for n_tokens_key in model_n_used_tokens:
+                model_n_used_tokens[n_tokens_key] += value.get(n_tokens_key, 0)
+
+        return n_used_tokens
+
+    async def inc_user_attribute(self, user_id: int, key: str, value: float):
+        self._buffer_increments(user_id, {key: value})
+
+    def _merge_increments(self, user_id: int, increments: dict):
+        user_increments = self._pending_increments.setdefault(user_id, {})
+        for path, value in increments.items():
+            user_increments[path] = user_increments.get(path, 0) + value
+
+    @staticmethod
+    def _apply_increments(user_dict: dict, increments: dict):
+        for path, value in increments.items():
+            inc_path(user_dict, path, value)
+
+    def _buffer_increments(self, user_id: int, increments: dict):
+        # counters are only ever incremented, so they are applied to the cached
+        # document right away and sent to Mongo in batches by flush()
+        self._merge_increments(user_id, increments)
+
+        user_dict = self.user_cache.peek(user_id)
+        if user_dict is not None:
+            self._apply_increments(user_dict, increments)
+
+        if self._flush_task is None:
+            # no background flusher (e.g. in scripts), write through immediately
+            task = asyncio.get_running_loop().create_task(self.flush())
+            self._write_through_tasks.add(task)
+            task.add_done_callback(self._on_write_through_done)
+
+    def _on_write_through_done(self, task: asyncio.Task):
+        self._write_through_tasks.discard(task)
+        if not task.cancelled():
+            task.exception()  # already logged by flush(), increments are kept for the next one
+
+    async def flush(self):
+        """Writes all buffered counter increments in a single batch."""
+        if len(self._pending_increments) == 0:
+            return
+
+        pending_increments, self._pending_increments = self._pending_increments, {}
+        # reads in progress can't tell whether they see the increments
+        self._flushing_users.update(pending_increments.keys())
+        self._mark_users_stale(pending_increments)
+        try:
+            await self.storage.increment_users(pending_increments)
+        except Exception:
+            logger.exception("Failed to flush counter updates of %d users, will retry", len(pending_increments))
+            for user_id, increments in pending_increments.items():
+                self._merge_increments(user_id, increments)
+            raise
+        finally:
+            self._flushing_users -= collections.Counter(pending_increments.keys())
+            self._mark_users_stale(pending_increments)
+
+    def _mark_users_stale(self, user_ids):
+        for user_id in user_ids:
+            self.user_cache.mark_stale(user_id)
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(config.db_flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                pass  # already logged, increments are kept for the next round
+
+    def start_flusher(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_periodically())
+
+    async def close(self):
+        """Stops background tasks and writes out everything still buffered."""
+        await self.invalidator.stop()
+
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+
+        await asyncio.gather(*self._write_through_tasks, return_exceptions=True)
+        await self.flush()
+        await self.storage.close()
+
+    async def _resolve_dialog_id(self, user_id: int, dialog_id: Optional[str] = None) -> str:
+        await self.check_if_user_exists(user_id, raise_exception=True)
 
         if dialog_id is None:
-            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
 
-        dialog_dict = self.dialog_collection.find_one({"_id": dialog_id, "user_id": user_id})
-        return dialog_dict["messages"]
+        return dialog_id
 
-    def set_dialog_messages(self, user_id: int, dialog_messages: list, dialog_id: Optional[str] = None):
-        self.check_if_user_exists(user_id, raise_exception=True)
+    async def get_dialog_messages(self, user_id: int, dialog_id: Optional[str] = None, last_n: Optional[int] = None):
+        """
+        Returns dialog messages, oldest first. If `last_n` is given, only the
+        last `last_n` messages are loaded from the database.
+        """
+        dialog_id = await self._resolve_dialog_id(user_id, dialog_id)
 
-        if dialog_id is None:
-            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+        return await self.storage.get_dialog_messages(user_id, dialog_id, last_n=last_n)
 
-        self.dialog_collection.update_one(
-            {"_id": dialog_id, "user_id": user_id},
-            {"$set": {"messages": dialog_messages}}
-        )
+    async def count_dialog_messages(self, user_id: int, dialog_id: Optional[str] = None) -> Optional[int]:
+        dialog_id = await self._resolve_dialog_id(user_id, dialog_id)
+
+        return await self.storage.count_dialog_messages(user_id, dialog_id)
+
+    async def set_dialog_messages(self, user_id: int, dialog_messages: list, dialog_id: Optional[str] = None):
+        dialog_id = await self._resolve_dialog_id(user_id, dialog_id)
+
+        await self.storage.set_dialog_messages(user_id, dialog_id, dialog_messages)
+
+    async def add_dialog_message(self, user_id: int, dialog_message: dict, dialog_id: Optional[str] = None):
+        dialog_id = await self._resolve_dialog_id(user_id, dialog_id)
+
+        await self.storage.push_dialog_message(user_id, dialog_id, dialog_message)
+
+    async def pop_dialog_message(self, user_id: int, dialog_id: Optional[str] = None) -> Optional[dict]:
+        """
+        Removes the last message of the dialog and returns it, or None if the
+        dialog is empty.
+        """
+        dialog_id = await self._resolve_dialog_id(user_id, dialog_id)
+
+        return await self.storage.pop_dialog_message(user_id, dialog_id)
+
+    async def get_dialog_summary(self, user_id: int, dialog_id: Optional[str] = None) -> Optional[dict]:
+        dialog_id = await self._resolve_dialog_id(user_id, dialog_id)
+
+        return await self.storage.get_dialog_summary(user_id, dialog_id)
+
+    async def set_dialog_summary(self, user_id: int, summary: dict, dialog_id: Optional[str] = None):
+        dialog_id = await self._resolve_dialog_id(user_id, dialog_id)
+
+        await self.storage.set_dialog_summary(user_id, dialog_id, summary)
 
-    def add_new_payment(self, user_id: int,
-                        amount: float,
-                        currency: str,
-                        payment_type: str,
-                        payment_id: Optional[str] = None,
-                        order_id: Optional[str] = None,
-                        status: str = "pending",
-                        additional_data: Optional[dict] = None) -> str:
+    async def add_new_payment(self, user_id: int,
+                              amount: float,
+                              currency: str,
+                              payment_type: str,
+                              payment_id: Optional[str] = None,
+                              order_id: Optional[str] = None,
+                              status: str = "pending",
+                              additional_data: Optional[dict] = None) -> str:
         """
         Добавляет новый платеж в базу данных.
 
@@ -154,7 +421,7 @@ class Database:
         Возвращает:
             str: ID добавленного платежа.
         """
-        self.check_if_user_exists(user_id, raise_exception=True)
+        await self.check_if_user_exists(user_id, raise_exception=True)
 
         pay_id = str(uuid.uuid4())
         payment_doc = {
@@ -171,10 +438,10 @@ class Database:
             "updated_at": datetime.now()
         }
 
-        self.payment_collection.insert_one(payment_doc)
+        await self.storage.insert_payment(payment_doc)
         return pay_id
 
-    def get_payment_by_id(self, pay_id: str) -> Optional[dict]:
+    async def get_payment_by_id(self, pay_id: str) -> Optional[dict]:
         """
         Получает данные о платеже по его внутреннему ID.
 
@@ -184,9 +451,33 @@ class Database:
         Возвращает:
             Optional[dict]: Документ с информацией о платеже или None, если платеж не найден.
         """
-        return self.payment_collection.find_one({"_id": pay_id})
+        return await self.storage.find_payment("_id", pay_id)
 
-    def update_payment_status(self, pay_id: str, new_status: str):
+    async def get_payment_by_external_id(self, payment_id: str) -> Optional[dict]:
+        """
+        Получает данные о платеже по его идентификатору во внешней платежной системе.
+
+        Аргументы:
+            payment_id (str): Идентификатор платежа во внешней системе.
+
+        Возвращает:
+            Optional[dict]: Документ с информацией о платеже или None, если платеж не найден.
+        """
+        return await self.storage.find_payment("payment_id", payment_id)
+
+    async def get_payment_by_invoice_uuid(self, uuid: str) -> Optional[dict]:
+        """
+        Получает данные о платеже по UUID счета Cryptomus.
+
+        Аргументы:
+            uuid (str): UUID счета, сохраненный в additional_data.
+
+        Возвращает:
+            Optional[dict]: Документ с информацией о платеже или None, если платеж не найден.
+        """
+        return await self.storage.find_payment("additional_data.uuid", uuid)
+
+    async def update_payment_status(self, pay_id: str, new_status: str):
         """
         Обновляет статус платежа.
 
@@ -197,13 +488,9 @@ class Database:
         Возвращает:
             None
         """
-        self.payment_collection.update_one(
-            {"_id": pay_id},
-            {"$set": {"status": new_status, "updated_at": datetime.now()}}
-
-        )
+        await self.storage.update_payment(pay_id, {"status": new_status, "updated_at": datetime.now()})
 
-    def update_user_subscription(self, user_id: int, duration_days: int = 30):
+    async def update_user_subscription(self, user_id: int, duration_days: int = 30):
         """
         Активирует подписку для пользователя на указанный период.
 
@@ -212,15 +499,14 @@ class Database:
             duration_days (int): Кол-во дней подписки. По умолчанию 30.
         """
         subscription_end = datetime.now() + timedelta(days=duration_days)
-        self.user_collection.update_one(
-            {"_id": user_id},
+        await self.storage.update_user(
+            user_id,
             {
-                "$set": {
-                    "is_premium": True,
-                    "premiumn_till": subscription_end
-                }
+                "is_premium": True,
+                "premium_till": subscription_end
             }
         )
+        self._update_cached_user(user_id, {"is_premium": True, "premium_till": subscription_end})
     # def set_payment_external_ids(self, pay_id: str, payment_id: Optional[str] = None, order_id: Optional[str] = None):
     #     """
     #     Устанавливает внешние идентификаторы платежа, если они стали известны после создания записи.
@@ -0,0 +1,265 @@
+"""
+Scheduling of outgoing Telegram requests.
+
+`EgressScheduler` takes the place of PTB's `AIORateLimiter`, which only
+reacts to 429s. It keeps requests within Telegram's budgets before they go out:
+`telegram_global_rate` per second overall, `telegram_chat_rate` per second
+in a private chat and `telegram_group_rate` per minute in a group, with
+bursts of up to `telegram_chat_burst` in a chat.
+
+Requests wait in one queue, ordered by priority and then by arrival.
+Replies, which is everything by default, go before intermediate edits of
+streamed answers. Those edits are sent with `rate_limit_args=Priority.EDIT`,
+and they can't use the last `EDIT_RESERVE` of the global budget. An edit
+that has waited `telegram_edit_max_queue_time` is dropped with
+`EditDropped`. Its editor sends the newer text in its place, so when the
+budget is tight the edits of a message are coalesced.
+
+A 429 holds back its chat for `retry_after`. It may have come from the global
+limit rather than the chat's, so edits to every chat are held back as long
+too; replies to other chats go on. Replies are retried; edits are left to
+their editor. Requests that aren't sent to a chat (getUpdates,
+callback query answers, ...) aren't limited.
+"""
+import asyncio
+import bisect
+import collections
+import enum
+import itertools
+import logging
+import time
+from typing import Optional
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import config
+import latency
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(enum.IntEnum):
+    # PTB ignores falsy rate_limit_args, so none of them is 0
+    REPLY = 1
+    EDIT = 2
+
+
+class EditDropped(Exception):
+    """An intermediate edit waited too long in the queue and wasn't sent."""
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.tokens + (now - self.updated_at) * self.rate, self.capacity)
+        self.updated_at = now
+
+    def get_wait_time(self, now: float, reserve: float = 0.0) -> float:
+        """Seconds until a token can be taken without going below `reserve`."""
+        self._refill(now)
+        return max(self.blocked_until - now, (1 + reserve - self.tokens) / self.rate, 0.0)
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, until: float):
+        self.blocked_until = max(self.blocked_until, until)
+
+
+class EgressStats:
+    def __init__(self):
+        self.n_requests = collections.Counter()  # by priority
+        self.n_dropped_edits = 0
+        self.n_rate_limited = 0
+        self.queue_length = 0
+        self.max_queue_length = 0
+        self.queue_times = {priority: latency.LatencyWindow(latency.WINDOW_SIZE) for priority in Priority}
+
+    def stats(self) -> dict:
+        stats = {
+            "requests": {priority.name.lower(): self.n_requests[priority] for priority in Priority},
+            "dropped_edits": self.n_dropped_edits,
+            "rate_limited": self.n_rate_limited,
+            "queue_length": self.queue_length,
+            "max_queue_length": self.max_queue_length,
+        }
+        for priority, queue_times in self.queue_times.items():
+            stats[f"{priority.name.lower()}_queue_time_p50"] = queue_times.percentile(50)
+            stats[f"{priority.name.lower()}_queue_time_p95"] = queue_times.percentile(95)
+        return stats
+
+
+egress_stats = EgressStats()
+
+
+def is_group_chat(chat_id) -> bool:
+    # usernames (strings) only work for channels and supergroups
+    return isinstance(chat_id, str) or chat_id < 0
+
+
+class _Request:
+    def __init__(self, priority: Priority, seq: int, chat_id):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.queued_at = time.monotonic()
+        self.granted = asyncio.get_running_loop().create_future()
+
+    def __lt__(self, other: "_Request") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class EgressScheduler(BaseRateLimiter):
+    # share of the global budget that intermediate edits leave to replies
+    EDIT_RESERVE = 0.2
+
+    def __init__(self, max_retries: int = 0, n_processes: int = 1):
+        self.max_retries = max_retries
+        # processes sending for the same bot, which share the global budget
+        self.n_processes = n_processes
+
+        self._global_bucket = None
+        # after a 429 that may have been the global limit's
+        self._edits_blocked_until = 0.0
+        self._chat_buckets = TTLCache(maxsize=10000, ttl=600)
+        # sorted by priority, then arrival
+        self._queue = []
+        self._seq = itertools.count()
+        self._changed = None
+        self._task = None
+
+    async def initialize(self):
+        if self._task is None:
+            global_rate = config.telegram_global_rate / self.n_processes
+            self._global_bucket = TokenBucket(global_rate, max(global_rate, 1))
+            self._changed = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+            for request in self._queue:
+                request.granted.cancel()
+            self._queue.clear()
+            egress_stats.queue_length = 0
+
+    def _get_chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if is_group_chat(chat_id):
+                bucket = TokenBucket(config.telegram_group_rate / 60, config.telegram_chat_burst)
+            else:
+                bucket = TokenBucket(config.telegram_chat_rate, config.telegram_chat_burst)
+        self._chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    def _get_wait_time(self, chat_id, priority: Priority, now: float) -> float:
+        reserve, blocked_for = 0.0, 0.0
+        if priority == Priority.EDIT:
+            reserve = self.EDIT_RESERVE * self._global_bucket.capacity
+            blocked_for = self._edits_blocked_until - now
+        return max(
+            self._global_bucket.get_wait_time(now, reserve=reserve),
+            self._get_chat_bucket(chat_id).get_wait_time(now),
+            blocked_for,
+            0.0,
+        )
+
+    def _take(self, chat_id, now: float):
+        self._global_bucket.take(now)
+        self._get_chat_bucket(chat_id).take(now)
+
+    def _dispatch(self) -> Optional[float]:
+        """Lets through whatever the budgets allow, in queue order. Returns the seconds until the next change."""
+        now = time.monotonic()
+        timeout = None
+        waiting = []
+        for request in self._queue:
+            if request.granted.done():  # the caller is gone
+                continue
+
+            if request.priority == Priority.EDIT:
+                expires_in = request.queued_at + config.telegram_edit_max_queue_time - now
+                if expires_in <= 0:
+                    egress_stats.n_dropped_edits += 1
+                    request.granted.set_exception(EditDropped())
+                    continue
+                timeout = expires_in if timeout is None else min(timeout, expires_in)
+
+            wait_time = self._get_wait_time(request.chat_id, request.priority, now)
+            if wait_time == 0:
+                self._take(request.chat_id, now)
+                egress_stats.queue_times[request.priority].observe(now - request.queued_at)
+                request.granted.set_result(None)
+                continue
+
+            waiting.append(request)
+            timeout = wait_time if timeout is None else min(timeout, wait_time)
+
+        self._queue = waiting
+        egress_stats.queue_length = len(waiting)
+        return timeout
+
+    async def _run(self):
+        while True:
+            self._changed.clear()
+            timeout = self._dispatch()
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _acquire(self, chat_id, priority: Priority):
+        egress_stats.n_requests[priority] += 1
+
+        now = time.monotonic()
+        if len(self._queue) == 0 and self._get_wait_time(chat_id, priority, now) == 0:
+            self._take(chat_id, now)
+            egress_stats.queue_times[priority].observe(0.0)
+            return
+
+        request = _Request(priority, next(self._seq), chat_id)
+        bisect.insort(self._queue, request)
+        egress_stats.max_queue_length = max(egress_stats.max_queue_length, len(self._queue))
+        self._changed.set()
+        await request.granted
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None or self._task is None:
+            return await callback(*args, **kwargs)
+
+        try:
+            chat_id = int(chat_id)
+        except (ValueError, TypeError):
+            pass
+        priority = Priority(rate_limit_args or Priority.REPLY)
+
+        for i in range(self.max_retries + 1):
+            await self._acquire(chat_id, priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                egress_stats.n_rate_limited += 1
+                blocked_until = time.monotonic() + e.retry_after
+                self._get_chat_bucket(chat_id).block(blocked_until)
+                self._edits_blocked_until = max(self._edits_blocked_until, blocked_until)
+                if priority == Priority.EDIT or i == self.max_retries:
+                    raise
+                logger.info(f"{endpoint} to chat {chat_id} is rate limited, retrying in {e.retry_after}s")
@@ -0,0 +1,128 @@
+"""
+Pool of OpenAI API keys / OpenAI-compatible endpoints from `openai_endpoints`
+in config.yml. Each request goes to the healthiest endpoint: the fewest
+requests in flight, weighted by its recent share of 429 responses. Endpoints
+that keep failing are ejected for a while and readmitted automatically.
+"""
+import logging
+import time
+from typing import Optional
+
+import openai
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class Endpoint:
+    # weight of the latest response in the smoothed 429 rate
+    RATE_LIMIT_ALPHA = 0.2
+
+    def __init__(self, name: str, api_key: str, api_base: Optional[str] = None):
+        self.name = name
+        self.api_key = api_key
+        self.api_base = api_base
+
+        self.n_in_flight = 0
+        self.rate_limit_rate = 0.0
+        self.n_consecutive_failures = 0
+        self.n_ejections = 0
+        self.ejected_until = 0.0
+
+        self.n_requests = 0
+        self.n_errors = 0
+        self.n_rate_limited = 0
+
+    @property
+    def is_ejected(self) -> bool:
+        return time.monotonic() < self.ejected_until
+
+    @property
+    def load(self) -> float:
+        return (self.n_in_flight + 1) * (1 + 10 * self.rate_limit_rate)
+
+    def _eject(self, seconds: float):
+        self.ejected_until = max(self.ejected_until, time.monotonic() + seconds)
+        self.n_ejections += 1
+        logger.warning(f"OpenAI endpoint {self.name} ejected for {seconds:.0f}s")
+
+    def acquire(self):
+        self.n_in_flight += 1
+        self.n_requests += 1
+
+    def release(self, error: Optional[BaseException] = None):
+        """`error` is what the request failed with, None if it succeeded."""
+        self.n_in_flight -= 1
+
+        if error is None:
+            self.rate_limit_rate *= 1 - self.RATE_LIMIT_ALPHA
+            self.n_consecutive_failures = 0
+            self.n_ejections = 0
+            return
+        if not isinstance(error, Exception) or isinstance(error, openai.error.InvalidRequestError):
+            return  # cancelled, or a problem with the request rather than the endpoint
+
+        self.n_errors += 1
+        if isinstance(error, openai.error.RateLimitError):
+            self.n_rate_limited += 1
+            self.rate_limit_rate = self.RATE_LIMIT_ALPHA + (1 - self.RATE_LIMIT_ALPHA) * self.rate_limit_rate
+
+            # an explicit Retry-After means the key is out of quota for that long
+            retry_after = (getattr(error, "headers", None) or {}).get("retry-after")
+            if retry_after is not None and retry_after.isdigit():
+                self._eject(float(retry_after))
+            return
+
+        self.n_consecutive_failures += 1
+        if self.n_consecutive_failures >= config.openai_endpoint_eject_after:
+            self.n_consecutive_failures = 0
+            # failing again right after readmission ejects for longer
+            self._eject(min(
+                config.openai_endpoint_eject_seconds * 2 ** self.n_ejections,
+                config.openai_endpoint_max_eject_seconds,
+            ))
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "in_flight": self.n_in_flight,
+            "requests": self.n_requests,
+            "errors": self.n_errors,
+            "rate_limited": self.n_rate_limited,
+            "rate_limit_rate": self.rate_limit_rate,
+            "ejected": self.is_ejected,
+        }
+
+
+class EndpointPool:
+    def __init__(self, endpoints: list):
+        if len(endpoints) == 0:
+            raise ValueError("At least one OpenAI endpoint is required")
+        self.endpoints = endpoints
+
+    @classmethod
+    def from_config(cls) -> "EndpointPool":
+        return cls([
+            Endpoint(
+                endpoint.get("name") or endpoint.get("api_base") or f"endpoint-{i}",
+                endpoint["api_key"],
+                api_base=endpoint.get("api_base"),
+            )
+            for i, endpoint in enumerate(config.openai_endpoints)
+        ])
+
+    def acquire(self) -> Endpoint:
+        """Picks the healthiest endpoint and marks a request in flight on it; pair with `release`."""
+        admitted_endpoints = [endpoint for endpoint in self.endpoints if not endpoint.is_ejected]
+        if len(admitted_endpoints) > 0:
+            endpoint = min(admitted_endpoints, key=lambda endpoint: endpoint.load)
+        else:
+            # everything is ejected: better to try the one coming back first than to fail
+            endpoint = min(self.endpoints, key=lambda endpoint: endpoint.ejected_until)
+
+        endpoint.acquire()
+        return endpoint
+
+    def stats(self) -> list:
+        return [endpoint.stats() for endpoint in self.endpoints]
@@ -0,0 +1,150 @@
+"""
+Stall detection and mid-stream failover for chat completion streams.
+
+Every chunk must arrive within `openai_stream_stall_timeout` seconds. If a
+stream stalls or breaks after it started, a new stream is opened (the
+endpoint pool prefers another endpoint) that asks the model to continue the
+partial answer, and its text is appended to what the user already has.
+"""
+import asyncio
+import logging
+import time
+from typing import AsyncIterator, Awaitable, Callable
+
+import aiohttp
+
+import compat
+import config
+import resilience
+
+logger = logging.getLogger(__name__)
+
+CONTINUE_PROMPT = (
+    "Your previous answer was cut off. Continue it exactly where it stopped, "
+    "without repeating anything and without any preamble."
+)
+
+# a continuation is buffered up to this many characters to cut off text it repeats
+OVERLAP_WINDOW = 200
+MIN_OVERLAP = 10
+
+
+class StallStats:
+    # weight of the latest recovery in the smoothed recovery latency
+    RECOVERY_LATENCY_ALPHA = 0.1
+
+    def __init__(self):
+        self.n_stalls = 0
+        self.n_errors = 0
+        self.n_recovered = 0
+        self.avg_recovery_latency = 0.0
+        self.max_recovery_latency = 0.0
+
+    def record_recovery(self, latency: float):
+        self.n_recovered += 1
+        self.avg_recovery_latency += self.RECOVERY_LATENCY_ALPHA * (latency - self.avg_recovery_latency)
+        self.max_recovery_latency = max(self.max_recovery_latency, latency)
+
+    def stats(self) -> dict:
+        return {
+            "stalls": self.n_stalls,
+            "errors": self.n_errors,
+            "recovered": self.n_recovered,
+            "avg_recovery_latency": self.avg_recovery_latency,
+            "max_recovery_latency": self.max_recovery_latency,
+        }
+
+
+stall_stats = StallStats()
+
+
+def _is_resumable(error: Exception) -> bool:
+    return resilience.is_retryable(error) or isinstance(error, aiohttp.ClientError)
+
+
+def trim_overlap(answer: str, continuation: str) -> str:
+    """Drops the start of `continuation` if it repeats the end of `answer`."""
+    for n_overlap in range(min(len(answer), len(continuation), OVERLAP_WINDOW), MIN_OVERLAP - 1, -1):
+        if answer.endswith(continuation[:n_overlap]):
+            return continuation[n_overlap:]
+    return continuation
+
+
+async def _read_with_deadline(stream: AsyncIterator, get_content: Callable) -> AsyncIterator[str]:
+    while True:
+        try:
+            item = await asyncio.wait_for(stream.__anext__(), config.openai_stream_stall_timeout)
+        except StopAsyncIteration:
+            return
+
+        content = get_content(item)
+        if len(content) > 0:
+            yield content
+
+
+async def resumable_stream(
+    open_stream: Callable[[list], Awaitable[AsyncIterator]],
+    messages: list,
+    get_content: Callable,
+) -> AsyncIterator[str]:
+    """
+    Yields the content deltas of `open_stream(messages)`, resuming with
+    `open_stream(continuation_messages)` after a stall or a broken stream.
+    """
+    answer = ""
+    stream_messages = messages
+    n_resumes = 0
+    interrupted_at = None
+
+    while True:
+        stream = await open_stream(stream_messages)
+        # text of a resumed stream is held back until repeated text can be cut off
+        continuation = "" if interrupted_at is not None else None
+        try:
+            async with compat.aclosing(stream):
+                async for content in _read_with_deadline(stream, get_content):
+                    if continuation is not None:
+                        continuation += content
+                        if len(continuation) < OVERLAP_WINDOW:
+                            continue
+                        content, continuation = trim_overlap(answer, continuation), None
+                        stall_stats.record_recovery(time.monotonic() - interrupted_at)
+                        interrupted_at = None
+
+                    answer += content
+                    yield content
+        except Exception as e:
+            if isinstance(e, asyncio.TimeoutError):
+                stall_stats.n_stalls += 1
+            elif _is_resumable(e):
+                stall_stats.n_errors += 1
+            else:
+                raise
+
+            if n_resumes >= config.openai_stream_max_resumes:
+                raise
+            n_resumes += 1
+            logger.warning(f"Stream interrupted after {len(answer)} characters ({type(e).__name__}), resuming")
+
+            if continuation:
+                # the resumed stream broke too, keep what it managed to say
+                content = trim_overlap(answer, continuation)
+                answer += content
+                yield content
+            if len(answer) > 0:
+                # with nothing to repeat the retry is streamed as it comes
+                interrupted_at = interrupted_at or time.monotonic()
+                stream_messages = messages + [
+                    {"role": "assistant", "content": answer},
+                    {"role": "user", "content": CONTINUE_PROMPT},
+                ]
+            continue
+
+        if continuation is not None:
+            # the resumed stream ended within the buffer
+            stall_stats.record_recovery(time.monotonic() - interrupted_at)
+            content = trim_overlap(answer, continuation)
+            if len(content) > 0:
+                answer += content
+                yield content
+        return
@@ -0,0 +1,179 @@
+"""
+A fake OpenAI API for tests and benchmarks without the real one.
+
+Serves chat completions, streamed or not, with injected latency: the first
+token comes `first_token_latency` seconds after the request, then one token
+every `token_interval`. With probability `stall_probability` a request
+stalls for `stall_time` before its first token, the tail hedging cuts.
+Counts requests, TCP connections and streams the client gave up on.
+Point the bot at it:
+
+    openai_api_base: "http://127.0.0.1:8082/v1"
+
+and start it with e.g.
+
+    python3 bot/fake_openai.py --first-token-latency 0.3 --stall-probability 0.05
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import random
+import sys
+import time
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+logger = logging.getLogger(__name__)
+
+
+class FakeOpenAI:
+    def __init__(
+        self,
+        first_token_latency: float = 0.0,
+        token_interval: float = 0.0,
+        n_answer_tokens: int = 20,
+        stall_probability: float = 0.0,
+        stall_time: float = 10.0,
+        seed: int = 0,
+    ):
+        self.first_token_latency = first_token_latency
+        self.token_interval = token_interval
+        self.n_answer_tokens = n_answer_tokens
+        self.stall_probability = stall_probability
+        self.stall_time = stall_time
+        self.rng = random.Random(seed)
+
+        self.n_requests = 0
+        self.n_stalled = 0
+        # streams the client closed before they were done
+        self.n_abandoned = 0
+        self.n_output_tokens = 0
+        self._connections = set()
+
+    @property
+    def n_connections(self) -> int:
+        return len(self._connections)
+
+    def _get_first_token_latency(self) -> float:
+        if self.rng.random() < self.stall_probability:
+            self.n_stalled += 1
+            return self.stall_time
+        return self.first_token_latency
+
+    def _make_chunk(self, model: str, delta: dict, finish_reason=None) -> str:
+        chunk = {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        return f"data: {json.dumps(chunk)}\n\n"
+
+    async def _stream(self, model: str, first_token_latency: float):
+        n_sent_tokens = 0
+        try:
+            await asyncio.sleep(first_token_latency)
+            yield self._make_chunk(model, {"role": "assistant", "content": ""})
+            for i in range(self.n_answer_tokens):
+                if i > 0:
+                    await asyncio.sleep(self.token_interval)
+                yield self._make_chunk(model, {"content": "token "})
+                n_sent_tokens += 1
+            yield self._make_chunk(model, {}, finish_reason="stop")
+            yield "data: [DONE]\n\n"
+        except asyncio.CancelledError:
+            self.n_abandoned += 1
+            raise
+        finally:
+            self.n_output_tokens += n_sent_tokens
+
+    async def handle_chat_completion(self, request: Request):
+        self.n_requests += 1
+        self._connections.add((request.client.host, request.client.port))
+        params = await request.json()
+        model = params.get("model", "gpt-3.5-turbo")
+        first_token_latency = self._get_first_token_latency()
+
+        if params.get("stream", False):
+            return StreamingResponse(self._stream(model, first_token_latency), media_type="text/event-stream")
+
+        await asyncio.sleep(first_token_latency + self.token_interval * (self.n_answer_tokens - 1))
+        self.n_output_tokens += self.n_answer_tokens
+        return JSONResponse({
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "token " * self.n_answer_tokens},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 10, "completion_tokens": self.n_answer_tokens, "total_tokens": 10 + self.n_answer_tokens},
+        })
+
+    def create_app(self) -> Starlette:
+        return Starlette(routes=[Route("/v1/chat/completions", self.handle_chat_completion, methods=["POST"])])
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.n_requests,
+            "connections": self.n_connections,
+            "stalled": self.n_stalled,
+            "abandoned": self.n_abandoned,
+            "output_tokens": self.n_output_tokens,
+        }
+
+
+@contextlib.asynccontextmanager
+async def serving(fake_openai: FakeOpenAI, host: str = "127.0.0.1", port: int = 8082):
+    """Serves `fake_openai` on the current event loop while in the block, yields its api base. Port 0 picks a free one."""
+    server = uvicorn.Server(uvicorn.Config(fake_openai.create_app(), host=host, port=port, access_log=False, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        if server_task.done():
+            await server_task  # failed to start
+        await asyncio.sleep(0.01)
+
+    port = server.servers[0].sockets[0].getsockname()[1]
+    try:
+        yield f"http://{host}:{port}/v1"
+    finally:
+        server.should_exit = True
+        await server_task
+
+
+async def main(args: argparse.Namespace):
+    fake_openai = FakeOpenAI(
+        first_token_latency=args.first_token_latency,
+        token_interval=args.token_interval,
+        n_answer_tokens=args.answer_tokens,
+        stall_probability=args.stall_probability,
+        stall_time=args.stall_time,
+    )
+    server = uvicorn.Server(uvicorn.Config(fake_openai.create_app(), host=args.host, port=args.port, access_log=False))
+    # until Ctrl+C
+    await server.serve()
+    logger.info(f"Fake OpenAI API: {fake_openai.stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a fake OpenAI API with injected latency")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--first-token-latency", type=float, default=0.3, help="seconds to the first token")
+    parser.add_argument("--token-interval", type=float, default=0.02, help="seconds between tokens")
+    parser.add_argument("--answer-tokens", type=int, default=50)
+    parser.add_argument("--stall-probability", type=float, default=0.0, help="share of requests that stall")
+    parser.add_argument("--stall-time", type=float, default=10.0, help="seconds a stalled request waits for its first token")
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(main(parser.parse_args()))
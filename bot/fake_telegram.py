@@ -0,0 +1,175 @@
+"""
+A fake Telegram for benchmarking the webhook mode offline.
+
+Serves a Bot API that accepts every method and answers with plausible
+results, and posts synthetic updates to the bot's webhook like Telegram
+would. Reports how fast the webhook acknowledges updates, and the time from
+an update to the bot's first message in its chat. Point the bot at it:
+
+    telegram_api_base_url: "http://127.0.0.1:8081/bot"
+    telegram_webhook_url: "http://127.0.0.1:8443/telegram"
+
+then start this before the bot, which sets its webhook on startup:
+
+    python3 bot/fake_telegram.py --updates 1000 --concurrency 50
+    python3 bot/bot.py
+
+The default text, /help, doesn't reach the model.
+"""
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import logging
+import sys
+import time
+from urllib.parse import parse_qsl, urlsplit
+
+import aiohttp
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+import config
+import latency
+import webhook
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_METHODS = {"sendMessage", "editMessageText", "sendPhoto", "sendDocument", "sendVoice"}
+# how long to wait for the bot's webhook server to come up
+STARTUP_TIMEOUT = 60.0
+
+
+class FakeTelegram:
+    def __init__(self, api_latency: float = 0.0):
+        self.api_latency = api_latency
+
+        self.n_calls = collections.Counter()  # by method
+        self.webhook_set = asyncio.Event()
+        self._message_ids = itertools.count(1)
+        # when the updates still waiting for a message were posted, by chat
+        self._pending = collections.defaultdict(collections.deque)
+        self.ack_latencies = latency.LatencyWindow(sys.maxsize)
+        self.reply_latencies = latency.LatencyWindow(sys.maxsize)
+
+    def _make_result(self, method: str, params: dict):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+        if method not in MESSAGE_METHODS:
+            return True
+
+        chat_id = int(params.get("chat_id", 0))
+        if method != "editMessageText" and len(self._pending[chat_id]) > 0:
+            self.reply_latencies.observe(time.monotonic() - self._pending[chat_id].popleft())
+        return {
+            "message_id": int(params.get("message_id") or next(self._message_ids)),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+            "text": params.get("text", ""),
+        }
+
+    async def handle_method(self, request: Request) -> JSONResponse:
+        method = request.path_params["method"]
+        self.n_calls[method] += 1
+        if method == "setWebhook":
+            self.webhook_set.set()
+
+        # PTB sends form-encoded parameters, multipart only with files
+        params = {}
+        if request.headers.get("content-type", "").startswith("application/x-www-form-urlencoded"):
+            params = dict(parse_qsl((await request.body()).decode()))
+
+        await asyncio.sleep(self.api_latency)
+        return JSONResponse({"ok": True, "result": self._make_result(method, params)})
+
+    def make_update(self, update_id: int, chat_id: int, text: str) -> dict:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Bench", "username": f"bench{chat_id}"},
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": update_id, "message": message}
+
+    async def wait_for_webhook(self, session: aiohttp.ClientSession, url: str):
+        """Until the bot's webhook server answers (without the secret token it's a 403)."""
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while True:
+            try:
+                async with session.post(url, json={}):
+                    return
+            except aiohttp.ClientConnectionError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.5)
+
+    async def post_updates(self, url: str, n_updates: int, n_chats: int, concurrency: int, text: str) -> float:
+        """Posts the updates, returns how long it took."""
+        semaphore = asyncio.Semaphore(concurrency)
+        headers = {webhook.SECRET_TOKEN_HEADER: webhook.get_secret_token()}
+
+        async with aiohttp.ClientSession() as session:
+            await self.wait_for_webhook(session, url)
+
+            async def post_update(update_id: int):
+                chat_id = 1000 + update_id % n_chats
+                async with semaphore:
+                    posted_at = time.monotonic()
+                    self._pending[chat_id].append(posted_at)
+                    async with session.post(url, json=self.make_update(update_id, chat_id, text), headers=headers) as response:
+                        response.raise_for_status()
+                    self.ack_latencies.observe(time.monotonic() - posted_at)
+
+            started_at = time.monotonic()
+            await asyncio.gather(*(post_update(update_id) for update_id in range(1, n_updates + 1)))
+            return time.monotonic() - started_at
+
+    async def wait_for_replies(self, timeout: float):
+        deadline = time.monotonic() + timeout
+        while any(len(pending) > 0 for pending in self._pending.values()) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
+
+async def main(args: argparse.Namespace):
+    fake_telegram = FakeTelegram(api_latency=args.api_latency)
+    app = Starlette(routes=[Route("/bot{token}/{method}", fake_telegram.handle_method, methods=["GET", "POST"])])
+    api_url = urlsplit(config.telegram_api_base_url)
+    server = uvicorn.Server(uvicorn.Config(app, host=api_url.hostname, port=api_url.port, access_log=False))
+    server_task = asyncio.create_task(server.serve())
+
+    logger.info(f"Fake Bot API on {api_url.hostname}:{api_url.port}, waiting for the bot to set its webhook")
+    await fake_telegram.webhook_set.wait()
+    elapsed = await fake_telegram.post_updates(args.webhook_url, args.updates, args.chats, args.concurrency, args.text)
+    await fake_telegram.wait_for_replies(args.timeout)
+
+    print(f"{args.updates} updates posted in {elapsed:.2f}s ({args.updates / elapsed:.0f}/s)")
+    for name, window in (("ack", fake_telegram.ack_latencies), ("first message", fake_telegram.reply_latencies)):
+        print(
+            f"{name}: {len(window.latencies)} measured, "
+            f"p50 {window.percentile(50) or 0:.4f}s, p95 {window.percentile(95) or 0:.4f}s, p99 {window.percentile(99) or 0:.4f}s"
+        )
+    print(f"Bot API calls: {json.dumps(dict(fake_telegram.n_calls))}")
+
+    server.should_exit = True
+    await server_task
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the webhook mode against a fake Telegram")
+    parser.add_argument("--webhook-url", default=config.telegram_webhook_url)
+    parser.add_argument("--updates", type=int, default=1000)
+    parser.add_argument("--chats", type=int, default=100, help="updates are spread over this many private chats")
+    parser.add_argument("--concurrency", type=int, default=50, help="updates posted at once")
+    parser.add_argument("--text", default="/help")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="seconds every Bot API call takes")
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds to wait for the bot's messages")
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,167 @@
+"""
+Hedged streaming requests.
+
+If a stream hasn't produced its first token after the model's recent
+`openai_hedge_percentile` time-to-first-token, a second identical request is
+started (the endpoint pool routes it to the least busy endpoint, so normally
+another key or backend). The second request takes a scheduler slot of its
+own and is skipped if none is free. Whichever stream produces a token first
+is used, the other one is closed. What the loser cost is kept in
+`HedgeStats` and in the caller's `WastedTokens`, to be billed to the user.
+"""
+import asyncio
+import collections
+import contextlib
+import logging
+import time
+from typing import AsyncContextManager, AsyncIterator, Awaitable, Callable, Optional
+
+import compat
+import config
+import latency
+
+logger = logging.getLogger(__name__)
+
+
+class HedgeStats:
+    def __init__(self):
+        self.n_streams = 0
+        self.n_hedged = 0
+        # late, but no scheduler slot was free for a second request
+        self.n_skipped_busy = 0
+        self.n_hedge_won = 0
+        # spent on streams that lost the race
+        self.n_wasted_input_tokens = 0
+        self.n_wasted_output_tokens = 0
+
+    def stats(self) -> dict:
+        return {
+            "streams": self.n_streams,
+            "hedged": self.n_hedged,
+            "skipped_busy": self.n_skipped_busy,
+            "hedge_won": self.n_hedge_won,
+            "wasted_input_tokens": self.n_wasted_input_tokens,
+            "wasted_output_tokens": self.n_wasted_output_tokens,
+        }
+
+
+ttft_windows = collections.defaultdict(
+    lambda: latency.LatencyWindow(config.openai_hedge_window_size, min_samples=config.openai_hedge_min_samples)
+)
+hedge_stats = HedgeStats()
+
+
+class WastedTokens:
+    """Tokens spent on the streams that lost a race, billed with the answer."""
+
+    def __init__(self):
+        self.n_input_tokens = 0
+        self.n_output_tokens = 0
+
+
+def get_hedge_delay(model: str) -> float:
+    delay = ttft_windows[model].percentile(config.openai_hedge_percentile)
+    if delay is None:
+        delay = config.openai_hedge_default_delay
+    return max(delay, config.openai_hedge_min_delay)
+
+
+class _Attempt:
+    """One request of the race: opens the stream and reads up to its first token."""
+
+    def __init__(self, open_stream: Callable[[], Awaitable[AsyncIterator]], is_token: Callable):
+        self.open_stream = open_stream
+        self.is_token = is_token
+
+        self.stream = None
+        self.buffered_items = []
+        self.started_at = time.monotonic()
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        self.stream = await self.open_stream()
+        async for item in self.stream:
+            self.buffered_items.append(item)
+            if self.is_token(item):
+                return
+        # finished without a single token, which is a valid (empty) answer too
+
+    async def cancel(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except BaseException:
+            pass
+        if self.stream is not None:
+            await self.stream.aclose()
+
+
+async def _chain(attempt: _Attempt) -> AsyncIterator:
+    async with compat.aclosing(attempt.stream):
+        for item in attempt.buffered_items:
+            yield item
+        async for item in attempt.stream:
+            yield item
+
+
+async def open_hedged_stream(
+    model: str,
+    open_stream: Callable[[], Awaitable[AsyncIterator]],
+    is_token: Callable,
+    count_output_tokens: Callable[[list], int],
+    n_input_tokens: int,
+    get_hedge_slot: Callable[[], Optional[AsyncContextManager]],
+    wasted_tokens: Optional[WastedTokens] = None,
+) -> AsyncIterator:
+    """
+    Returns the stream of whichever of up to two `open_stream()` calls yields
+    an item satisfying `is_token` first. The second call runs in the slot
+    `get_hedge_slot()` returns, None if there's no free one: it's held until
+    the race is decided. `count_output_tokens(items)` and `n_input_tokens`
+    are used to account for the loser.
+    """
+    hedge_stats.n_streams += 1
+    started_at = time.monotonic()
+
+    async with contextlib.AsyncExitStack() as hedge_stack:
+        attempts = [_Attempt(open_stream, is_token)]
+        done, _ = await asyncio.wait([attempts[0].task], timeout=get_hedge_delay(model))
+        if len(done) == 0:
+            hedge_slot = get_hedge_slot()
+            if hedge_slot is None:
+                hedge_stats.n_skipped_busy += 1
+            else:
+                await hedge_stack.enter_async_context(hedge_slot)
+                hedge_stats.n_hedged += 1
+                logger.info(f"No first token from {model} after {time.monotonic() - started_at:.1f}s, hedging")
+                attempts.append(_Attempt(open_stream, is_token))
+
+        winner = None
+        try:
+            pending = {attempt.task for attempt in attempts}
+            while winner is None and len(pending) > 0:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for attempt in attempts:
+                    if attempt.task in done and attempt.task.exception() is None and winner is None:
+                        winner = attempt
+
+            if winner is None:
+                # every attempt failed; raise the primary's error
+                await attempts[0].task
+        finally:
+            for attempt in attempts:
+                if attempt is not winner:
+                    if winner is not None and attempt.stream is not None:
+                        n_wasted_output_tokens = count_output_tokens(attempt.buffered_items)
+                        hedge_stats.n_wasted_input_tokens += n_input_tokens
+                        hedge_stats.n_wasted_output_tokens += n_wasted_output_tokens
+                        if wasted_tokens is not None:
+                            wasted_tokens.n_input_tokens += n_input_tokens
+                            wasted_tokens.n_output_tokens += n_wasted_output_tokens
+                    await attempt.cancel()
+
+    if winner is not attempts[0]:
+        hedge_stats.n_hedge_won += 1
+    ttft_windows[model].observe(time.monotonic() - winner.started_at)
+
+    return _chain(winner)
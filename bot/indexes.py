@@ -0,0 +1,102 @@
+"""
+Index declarations for all collections.
+
+Indexes are created idempotently on startup (see `ensure_indexes`). Run this
+module directly to create them and verify that none of the queries issued by
+`Database` falls back to a collection scan:
+
+    python3 bot/indexes.py
+
+tests/test_indexes.py does the same on a test database.
+"""
+import asyncio
+import logging
+import sys
+from datetime import datetime
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+logger = logging.getLogger(__name__)
+
+
+INDEXES = {
+    "user": [
+        IndexModel([("premium_till", ASCENDING)], name="premium_till"),
+        IndexModel([("last_interaction", ASCENDING)], name="last_interaction"),
+    ],
+    "dialog": [
+        IndexModel([("user_id", ASCENDING), ("start_time", DESCENDING)], name="user_id_start_time"),
+        IndexModel([("updated_at", ASCENDING)], name="updated_at"),
+        IndexModel([("start_time", ASCENDING)], name="start_time"),
+    ],
+    "dialog_archive": [
+        IndexModel([("user_id", ASCENDING), ("start_time", DESCENDING)], name="user_id_start_time"),
+        IndexModel([("expire_at", ASCENDING)], name="expire_at", expireAfterSeconds=0),
+    ],
+    "payments": [
+        IndexModel([("payment_id", ASCENDING)], name="payment_id"),
+        IndexModel([("additional_data.uuid", ASCENDING)], name="additional_data_uuid", sparse=True),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING)], name="user_id_created_at"),
+    ],
+}
+
+# (collection, filter) pairs shaped like the queries `Database` and the payment
+# handlers issue; every one of them must be answered from an index
+QUERIES = [
+    ("user", {"_id": 0}),
+    ("user", {"premium_till": {"$lt": datetime.now()}}),
+    ("user", {"last_interaction": {"$lt": datetime.now()}}),
+    ("dialog", {"_id": "", "user_id": 0}),
+    ("dialog", {"user_id": 0}),
+    ("dialog", {"$or": [
+        {"updated_at": {"$lt": datetime.now()}},
+        {"updated_at": None, "start_time": {"$lt": datetime.now()}},
+    ]}),
+    ("dialog_archive", {"_id": "", "user_id": 0}),
+    ("payments", {"_id": ""}),
+    ("payments", {"payment_id": ""}),
+    ("payments", {"additional_data.uuid": ""}),
+]
+
+
+async def ensure_indexes(db):
+    """Creates all declared indexes; existing ones with the same spec are left alone."""
+    for collection_name, index_models in INDEXES.items():
+        names = await db[collection_name].create_indexes(index_models)
+        logger.info(f"Indexes on {collection_name}: {', '.join(names)}")
+
+
+def _plan_stages(plan: dict):
+    yield plan["stage"]
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            yield from _plan_stages(plan[key])
+    for input_stage in plan.get("inputStages", []):
+        yield from _plan_stages(input_stage)
+
+
+async def check_query_plans(db):
+    """Raises RuntimeError if any of QUERIES is executed with a COLLSCAN."""
+    collscans = []
+    for collection_name, query in QUERIES:
+        explanation = await db[collection_name].find(query).explain()
+        winning_plan = explanation["queryPlanner"]["winningPlan"]
+        if "COLLSCAN" in _plan_stages(winning_plan):
+            collscans.append(f"{collection_name}.find({query})")
+
+    if len(collscans) > 0:
+        raise RuntimeError("Queries without index:\n" + "\n".join(collscans))
+
+
+async def main():
+    from storage.mongo import MongoStorage
+
+    storage = MongoStorage()
+    await ensure_indexes(storage.db)
+    await check_query_plans(storage.db)
+    print(f"OK: {len(QUERIES)} queries use indexes")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    asyncio.run(main())
@@ -0,0 +1,62 @@
+import asyncio
+import logging
+
+import config
+from cache import TTLCache
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+RESTART_DELAY = 1.0  # seconds before re-opening a failed change stream
+
+
+class CacheInvalidator:
+    """
+    Evicts cached user documents that were changed by another bot process or a
+    payment webhook, using the backend's change feed (Mongo change streams).
+
+    If the backend can't watch changes (standalone mongod, SQLite), falls back
+    to polling: cached documents then live only `user_cache_poll_ttl` seconds.
+    """
+
+    def __init__(self, storage: Storage, user_cache: TTLCache):
+        self.storage = storage
+        self.user_cache = user_cache
+
+        self.polling = False
+        self.n_invalidations = 0
+        self._task = None
+
+    def _fall_back_to_polling(self):
+        self.polling = True
+        self.user_cache.ttl = min(self.user_cache.ttl, config.user_cache_poll_ttl)
+        self.user_cache.clear()  # drop entries stored with the long ttl
+
+    async def _run(self):
+        while True:
+            try:
+                async for user_id in self.storage.watch_user_changes():
+                    self.user_cache.pop(user_id)
+                    self.n_invalidations += 1
+            except NotImplementedError as e:
+                logger.warning(f"Change streams are unavailable ({e}), polling with a {config.user_cache_poll_ttl}s cache ttl")
+                self._fall_back_to_polling()
+                return
+            except Exception:
+                logger.exception("Change stream failed, restarting")
+                self.user_cache.clear()  # changes may have been missed
+
+            await asyncio.sleep(RESTART_DELAY)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
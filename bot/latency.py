@@ -0,0 +1,63 @@
+"""
+Time to first token (TTFT) of replies, broken down into the steps before it.
+
+Message handlers start a `ReplyTimer` when an update arrives and mark each
+step as it completes: the placeholder is sent, the model request starts, the
+first token arrives, the first token is shown to the user. `stats()` has
+recent percentiles of every step, measured from the update's arrival.
+"""
+import collections
+import logging
+import math
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+WINDOW_SIZE = 1000
+
+
+class LatencyWindow:
+    """The last `size` latencies, for percentile estimates."""
+
+    def __init__(self, size: int, min_samples: int = 1):
+        self.latencies = collections.deque(maxlen=size)
+        self.min_samples = min_samples
+
+    def observe(self, latency: float):
+        self.latencies.append(latency)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if len(self.latencies) < max(self.min_samples, 1):
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(math.ceil(q / 100 * len(latencies)), len(latencies)) - 1]
+
+
+_step_windows = collections.defaultdict(lambda: LatencyWindow(WINDOW_SIZE))
+
+
+class ReplyTimer:
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.marks = {}
+
+    def mark(self, step: str):
+        """Records when `step` first completed."""
+        if step not in self.marks:
+            self.marks[step] = time.monotonic() - self.started_at
+            _step_windows[step].observe(self.marks[step])
+
+    def __str__(self) -> str:
+        return ", ".join(f"{step} {latency:.2f}s" for step, latency in self.marks.items())
+
+
+def stats() -> dict:
+    return {
+        step: {
+            "count": len(window.latencies),
+            "p50": window.percentile(50),
+            "p95": window.percentile(95),
+        }
+        for step, window in _step_windows.items()
+    }
@@ -0,0 +1,36 @@
+"""
+One-time data migrations of the Mongo database.
+
+Each migration runs once per database: the applied ones are recorded by
+name in the `migrations` collection. `MongoStorage.start` applies the
+pending ones after the indexes are in place. Migrations must be safe to
+repeat, since two instances starting together may both apply one.
+"""
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+async def rename_premiumn_till(db):
+    # update_user_subscription used to write the expiry to a misspelled field
+    await db["user"].update_many(
+        {"premiumn_till": {"$exists": True}}, {"$rename": {"premiumn_till": "premium_till"}}
+    )
+
+
+MIGRATIONS = [
+    ("rename_premiumn_till", rename_premiumn_till),
+]
+
+
+async def migrate(db):
+    """Applies the migrations `db` hasn't had yet, in order."""
+    applied = {migration["_id"] async for migration in db["migrations"].find({}, {"_id": 1})}
+    for name, migration in MIGRATIONS:
+        if name in applied:
+            continue
+
+        logger.info(f"Applying migration {name}")
+        await migration(db)
+        await db["migrations"].update_one({"_id": name}, {"$set": {"applied_at": datetime.now()}}, upsert=True)
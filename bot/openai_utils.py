@@ -1,11 +1,23 @@
 import base64
+import contextlib
+import functools
+import inspect
 from io import BytesIO
+from typing import Optional
 import config
 import logging
 
+import aiohttp
 import tiktoken
 import openai
 
+import compat
+import endpoints
+import failover
+import hedging
+import resilience
+import scheduler
+
 
 # setup openai
 openai.api_key = config.openai_api_key
@@ -13,6 +25,9 @@ if config.openai_api_base is not None:
     openai.api_base = config.openai_api_base
 logger = logging.getLogger(__name__)
 
+# every request passes its own key and base, picked from this pool
+endpoint_pool = endpoints.EndpointPool.from_config()
+
 
 OPENAI_COMPLETION_OPTIONS = {
     "temperature": 0.7,
@@ -20,38 +35,236 @@ OPENAI_COMPLETION_OPTIONS = {
     "top_p": 1,
     "frequency_penalty": 0,
     "presence_penalty": 0,
-    "request_timeout": 60.0,
 }
 
+DIALOG_SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+SUMMARIZE_DIALOG_PROMPT = (
+    "Summarize the conversation below for the assistant to continue it. Keep the facts, names, numbers, "
+    "decisions, open questions and preferences the user stated; drop greetings and filler. Write in the "
+    "language of the conversation, in at most a few short paragraphs."
+)
+
+# worst case for one "detail": "high" image: 85 + 170 tokens per 512px tile, 8 tiles
+N_IMAGE_TOKENS = 1445
+
+
+class ConnectionStats:
+    """Counts new vs. reused connections of the pooled HTTP session."""
+
+    def __init__(self):
+        self.n_created = 0
+        self.n_reused = 0
+
+    async def _on_connection_create_end(self, session, trace_config_ctx, params):
+        self.n_created += 1
+
+    async def _on_connection_reuseconn(self, session, trace_config_ctx, params):
+        self.n_reused += 1
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(self._on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(self._on_connection_reuseconn)
+        return trace_config
+
+    @property
+    def reuse_rate(self) -> float:
+        n_connections = self.n_created + self.n_reused
+        return self.n_reused / n_connections if n_connections > 0 else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "created": self.n_created,
+            "reused": self.n_reused,
+            "reuse_rate": self.reuse_rate,
+        }
+
+
+# without a session openai opens and closes one (and a TCP+TLS connection) per call
+http_session: Optional[aiohttp.ClientSession] = None
+connection_stats = ConnectionStats()
+
+
+async def start_http_session():
+    global http_session
+    if http_session is not None:
+        return
+
+    connector = aiohttp.TCPConnector(
+        limit=config.openai_pool_size,
+        limit_per_host=config.openai_pool_size_per_host,
+        keepalive_timeout=config.openai_keepalive_timeout,
+        ttl_dns_cache=300,
+    )
+    http_session = aiohttp.ClientSession(connector=connector, trace_configs=[connection_stats.trace_config()])
+
+
+async def close_http_session():
+    global http_session
+    if http_session is None:
+        return
+
+    await http_session.close()
+    http_session = None
+    logger.info(f"OpenAI HTTP session closed, connections: {connection_stats.stats()}")
+    logger.info(f"OpenAI endpoints: {endpoint_pool.stats()}")
+
+
+async def _release_after_stream(r_gen, endpoint: endpoints.Endpoint):
+    error = None
+    try:
+        async with compat.aclosing(r_gen):
+            async for r_item in r_gen:
+                yield r_item
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        endpoint.release(error)
+
+
+async def call_openai(api_method, *args, **kwargs):
+    """
+    Calls an async openai method on an endpoint from the pool. A stream keeps
+    its endpoint busy until it is consumed.
+    """
+    endpoint = endpoint_pool.acquire()
+    try:
+        with pooled_http_session():
+            r = await api_method(*args, api_key=endpoint.api_key, api_base=endpoint.api_base, **kwargs)
+    except BaseException as e:
+        endpoint.release(e)
+        raise
+
+    if kwargs.get("stream", False):
+        return _release_after_stream(r, endpoint)
+
+    endpoint.release()
+    return r
+
+
+@contextlib.contextmanager
+def pooled_http_session():
+    """
+    Makes openai calls inside the block use the shared session. openai reads it
+    from a ContextVar, which has to be set in the calling task itself: PTB runs
+    handlers in tasks that don't inherit the context of `post_init`.
+    """
+    if http_session is None:
+        yield
+        return
+
+    token = openai.aiosession.set(http_session)
+    try:
+        yield
+    finally:
+        openai.aiosession.reset(token)
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    # encoding_for_model builds (and for new processes loads) the BPE ranks,
+    # far too slow to repeat for every streamed chunk
+    return tiktoken.encoding_for_model(model)
+
+
+def count_tokens(text: str, model: str) -> int:
+    # special tokens in user text are counted as plain text instead of raising
+    return len(get_encoding(model).encode(text, disallowed_special=()))
+
+
+@functools.lru_cache(maxsize=None)
+def count_prompt_start_tokens(chat_mode: str, model: str) -> int:
+    return count_tokens(config.chat_modes[chat_mode]["prompt_start"], model)
+
+
+class StreamingTokenCounter:
+    """
+    Counts tokens of a streamed answer by encoding only each new delta, so a
+    reply costs O(answer) encoding work in total instead of O(answer^2).
+    OpenAI streams whole tokens per chunk, so the sum matches encoding the
+    full answer up to rare merges across chunk boundaries.
+    """
+
+    def __init__(self, model: str, n_tokens: int = 0):
+        self.model = model
+        self.n_tokens = n_tokens
+
+    def add(self, delta: str) -> int:
+        self.n_tokens += count_tokens(delta, self.model)
+        return self.n_tokens
+
+
+def _get_delta_content(r_item) -> str:
+    return r_item.choices[0].delta.get("content") or ""
+
+
+def _scheduled(method):
+    """Runs a ChatGPT request method, or a whole stream, in one of the model's scheduler slots."""
+    if inspect.isasyncgenfunction(method):
+        @functools.wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            async with self._slot():
+                async with compat.aclosing(method(self, *args, **kwargs)) as gen:
+                    async for item in gen:
+                        yield item
+    else:
+        @functools.wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            async with self._slot():
+                return await method(self, *args, **kwargs)
+
+    return wrapper
+
 
 class ChatGPT:
-    def __init__(self, model="gpt-3.5-turbo"):
+    def __init__(self, model="gpt-3.5-turbo", is_premium=False, on_queued=None):
+        """
+        `is_premium` picks the scheduler lane; `on_queued(position)` is awaited
+        if a request has to wait for a free slot.
+        """
         assert model in {"text-davinci-003", "gpt-3.5-turbo-16k", "gpt-3.5-turbo", "gpt-4", "gpt-4o", "gpt-4-1106-preview", "gpt-4-vision-preview"}, f"Unknown model: {model}"
         self.model = model
+        self.is_premium = is_premium
+        self.on_queued = on_queued
 
-    async def send_message(self, message, dialog_messages=[], chat_mode="assistant"):
+    def _slot(self):
+        return scheduler.get_scheduler(self.model).slot(premium=self.is_premium, on_queued=self.on_queued)
+
+    def _hedge_slot(self):
+        """A slot for a hedged request if one is free right away: hedging must not queue behind other users."""
+        model_scheduler = scheduler.get_scheduler(self.model)
+        if not model_scheduler.has_free_slot:
+            return None
+        return model_scheduler.slot(premium=self.is_premium)
+
+    @_scheduled
+    async def send_message(self, message, dialog_messages=[], chat_mode="assistant", dialog_summary=None):
         if chat_mode not in config.chat_modes.keys():
             raise ValueError(f"Chat mode {chat_mode} is not supported")
 
         n_dialog_messages_before = len(dialog_messages)
+        dialog_messages = self._fit_dialog_messages(message, dialog_messages, chat_mode, dialog_summary=dialog_summary)
         answer = None
         while answer is None:
             try:
                 if self.model in {"gpt-3.5-turbo-16k", "gpt-3.5-turbo", "gpt-4", "gpt-4o", "gpt-4-1106-preview", "gpt-4-vision-preview"}:
-                    messages = self._generate_prompt_messages(message, dialog_messages, chat_mode)
+                    messages = self._generate_prompt_messages(message, dialog_messages, chat_mode, dialog_summary=dialog_summary)
 
-                    r = await openai.ChatCompletion.acreate(
+                    r = await self._acreate(
+                        openai.ChatCompletion,
                         model=self.model,
                         messages=messages,
-                        **OPENAI_COMPLETION_OPTIONS
+                        **self._completion_options()
                     )
                     answer = r.choices[0].message["content"]
                 elif self.model == "text-davinci-003":
-                    prompt = self._generate_prompt(message, dialog_messages, chat_mode)
-                    r = await openai.Completion.acreate(
+                    prompt = self._generate_prompt(message, dialog_messages, chat_mode, dialog_summary=dialog_summary)
+                    r = await self._acreate(
+                        openai.Completion,
                         engine=self.model,
                         prompt=prompt,
-                        **OPENAI_COMPLETION_OPTIONS
+                        **self._completion_options()
                     )
                     answer = r.choices[0].text
                 else:
@@ -70,49 +283,63 @@ class ChatGPT:
 
         return answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
 
-    async def send_message_stream(self, message, dialog_messages=[], chat_mode="assistant"):
+    @_scheduled
+    async def send_message_stream(self, message, dialog_messages=[], chat_mode="assistant", dialog_summary=None):
         if chat_mode not in config.chat_modes.keys():
             raise ValueError(f"Chat mode {chat_mode} is not supported")
 
         n_dialog_messages_before = len(dialog_messages)
+        dialog_messages = self._fit_dialog_messages(message, dialog_messages, chat_mode, dialog_summary=dialog_summary)
         answer = None
         while answer is None:
             try:
                 if self.model in {"gpt-3.5-turbo-16k", "gpt-3.5-turbo", "gpt-4","gpt-4o", "gpt-4-1106-preview"}:
-                    messages = self._generate_prompt_messages(message, dialog_messages, chat_mode)
-
-                    r_gen = await openai.ChatCompletion.acreate(
-                        model=self.model,
-                        messages=messages,
-                        stream=True,
-                        **OPENAI_COMPLETION_OPTIONS
+                    messages = self._generate_prompt_messages(message, dialog_messages, chat_mode, dialog_summary=dialog_summary)
+
+                    n_input_tokens = self._count_input_tokens(message, dialog_messages, chat_mode, dialog_summary=dialog_summary)
+                    # streams that lost a hedging race are billed too
+                    wasted_tokens = hedging.WastedTokens()
+                    deltas = failover.resumable_stream(
+                        lambda stream_messages: self._open_chat_stream(
+                            n_input_tokens,
+                            wasted_tokens,
+                            model=self.model,
+                            messages=stream_messages,
+                            **self._completion_options()
+                        ),
+                        messages,
+                        get_content=_get_delta_content,
                     )
 
                     answer = ""
-                    async for r_item in r_gen:
-                        delta = r_item.choices[0].delta
-
-                        if "content" in delta:
-                            answer += delta.content
-                            n_input_tokens, n_output_tokens = self._count_tokens_from_messages(messages, answer, model=self.model)
-                            n_first_dialog_messages_removed = 0
+                    output_token_counter = StreamingTokenCounter(self.model, n_tokens=1)
+                    n_output_tokens = output_token_counter.n_tokens
+                    n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
+                    async for delta in deltas:
+                        answer += delta
+                        n_output_tokens = output_token_counter.add(delta)
+                        n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
 
-                            yield "not_finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
-                            
+                        yield "not_finished", answer, (n_input_tokens + wasted_tokens.n_input_tokens, n_output_tokens + wasted_tokens.n_output_tokens), n_first_dialog_messages_removed
+                    n_input_tokens += wasted_tokens.n_input_tokens
+                    n_output_tokens += wasted_tokens.n_output_tokens
 
                 elif self.model == "text-davinci-003":
-                    prompt = self._generate_prompt(message, dialog_messages, chat_mode)
-                    r_gen = await openai.Completion.acreate(
+                    prompt = self._generate_prompt(message, dialog_messages, chat_mode, dialog_summary=dialog_summary)
+                    r_gen = await self._acreate(
+                        openai.Completion,
                         engine=self.model,
                         prompt=prompt,
                         stream=True,
-                        **OPENAI_COMPLETION_OPTIONS
+                        **self._completion_options()
                     )
 
                     answer = ""
+                    n_input_tokens = self._count_input_tokens(message, dialog_messages, chat_mode, dialog_summary=dialog_summary)
+                    output_token_counter = StreamingTokenCounter(self.model)
                     async for r_item in r_gen:
                         answer += r_item.choices[0].text
-                        n_input_tokens, n_output_tokens = self._count_tokens_from_prompt(prompt, answer, model=self.model)
+                        n_output_tokens = output_token_counter.add(r_item.choices[0].text)
                         n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
                         yield "not_finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
 
@@ -122,30 +349,38 @@ class ChatGPT:
                 if len(dialog_messages) == 0:
                     raise e
 
+                # the stream is opened lazily, after `answer` was set; retry with a shorter dialog
+                answer = None
                 # forget first message in dialog_messages
                 dialog_messages = dialog_messages[1:]
 
         yield "finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed  # sending final answer
 
+    @_scheduled
     async def send_vision_message(
         self,
         message,
         dialog_messages=[],
         chat_mode="assistant",
         image_buffer: BytesIO = None,
+        dialog_summary=None,
     ):
         n_dialog_messages_before = len(dialog_messages)
+        dialog_messages = self._fit_dialog_messages(
+            message, dialog_messages, chat_mode, image_buffer, dialog_summary
+        )
         answer = None
         while answer is None:
             try:
                 if self.model == "gpt-4-vision-preview" or self.model == "gpt-4o":
                     messages = self._generate_prompt_messages(
-                        message, dialog_messages, chat_mode, image_buffer
+                        message, dialog_messages, chat_mode, image_buffer, dialog_summary
                     )
-                    r = await openai.ChatCompletion.acreate(
+                    r = await self._acreate(
+                        openai.ChatCompletion,
                         model=self.model,
                         messages=messages,
-                        **OPENAI_COMPLETION_OPTIONS
+                        **self._completion_options()
                     )
                     answer = r.choices[0].message.content
                 else:
@@ -175,39 +410,48 @@ class ChatGPT:
             n_first_dialog_messages_removed,
         )
 
+    @_scheduled
     async def send_vision_message_stream(
         self,
         message,
         dialog_messages=[],
         chat_mode="assistant",
         image_buffer: BytesIO = None,
+        dialog_summary=None,
     ):
         n_dialog_messages_before = len(dialog_messages)
+        dialog_messages = self._fit_dialog_messages(
+            message, dialog_messages, chat_mode, image_buffer, dialog_summary
+        )
         answer = None
         while answer is None:
             try:
                 if self.model == "gpt-4-vision-preview" or self.model == "gpt-4o":
                     messages = self._generate_prompt_messages(
-                        message, dialog_messages, chat_mode, image_buffer
+                        message, dialog_messages, chat_mode, image_buffer, dialog_summary
                     )
                     
-                    r_gen = await openai.ChatCompletion.acreate(
+                    r_gen = await self._acreate(
+                        openai.ChatCompletion,
                         model=self.model,
                         messages=messages,
                         stream=True,
-                        **OPENAI_COMPLETION_OPTIONS,
+                        **self._completion_options(),
                     )
 
                     answer = ""
+                    n_input_tokens = self._count_input_tokens(
+                        message, dialog_messages, chat_mode, image_buffer, dialog_summary
+                    )
+                    output_token_counter = StreamingTokenCounter(
+                        self.model, n_tokens=1
+                    )
                     async for r_item in r_gen:
                         delta = r_item.choices[0].delta
                         if "content" in delta:
                             answer += delta.content
-                            (
-                                n_input_tokens,
-                                n_output_tokens,
-                            ) = self._count_tokens_from_messages(
-                                messages, answer, model=self.model
+                            n_output_tokens = output_token_counter.add(
+                                delta.content
                             )
                             n_first_dialog_messages_removed = (
                                 n_dialog_messages_before - len(dialog_messages)
@@ -222,6 +466,7 @@ class ChatGPT:
             except openai.error.InvalidRequestError as e:  # too many tokens
                 if len(dialog_messages) == 0:
                     raise e
+                answer = None
                 # forget first message in dialog_messages
                 dialog_messages = dialog_messages[1:]
 
@@ -230,10 +475,46 @@ class ChatGPT:
             n_output_tokens,
         ), n_first_dialog_messages_removed
 
-    def _generate_prompt(self, message, dialog_messages, chat_mode):
+    @_scheduled
+    async def summarize_dialog(self, dialog_messages, previous_summary=None):
+        """
+        Condenses `dialog_messages`, and the summary of the turns before them,
+        into a new summary. Returns it with (n_input_tokens, n_output_tokens).
+        """
+        transcript = ""
+        if previous_summary is not None:
+            transcript += f"{DIALOG_SUMMARY_PREFIX}{previous_summary}\n\n"
+        for dialog_message in dialog_messages:
+            transcript += f"User: {self._content_to_text(dialog_message['user'])}\n"
+            transcript += f"Assistant: {dialog_message['bot']}\n"
+
+        r = await self._acreate(
+            openai.ChatCompletion,
+            model=self.model,
+            messages=[
+                {"role": "system", "content": SUMMARIZE_DIALOG_PROMPT},
+                {"role": "user", "content": transcript},
+            ],
+            temperature=0,
+            max_tokens=config.dialog_summary_max_tokens,
+        )
+        summary = self._postprocess_answer(r.choices[0].message["content"])
+
+        return summary, (r.usage.prompt_tokens, r.usage.completion_tokens)
+
+    def _content_to_text(self, content):
+        if isinstance(content, str):
+            return content
+        return " ".join(part["text"] if part.get("type") == "text" else "[image]" for part in content)
+
+    def _generate_prompt(self, message, dialog_messages, chat_mode, dialog_summary=None):
         prompt = config.chat_modes[chat_mode]["prompt_start"]
         prompt += "\n\n"
 
+        # earlier turns that were compacted
+        if dialog_summary is not None:
+            prompt += f"{DIALOG_SUMMARY_PREFIX}{dialog_summary}\n\n"
+
         # add chat context
         if len(dialog_messages) > 0:
             prompt += "Chat:\n"
@@ -250,10 +531,12 @@ class ChatGPT:
     def _encode_image(self, image_buffer: BytesIO) -> bytes:
         return base64.b64encode(image_buffer.read()).decode("utf-8")
 
-    def _generate_prompt_messages(self, message, dialog_messages, chat_mode, image_buffer: BytesIO = None):
+    def _generate_prompt_messages(self, message, dialog_messages, chat_mode, image_buffer: BytesIO = None, dialog_summary=None):
         prompt = config.chat_modes[chat_mode]["prompt_start"]
 
         messages = [{"role": "system", "content": prompt}]
+        if dialog_summary is not None:
+            messages.append({"role": "system", "content": f"{DIALOG_SUMMARY_PREFIX}{dialog_summary}"})
         
         for dialog_message in dialog_messages:
             messages.append({"role": "user", "content": dialog_message["user"]})
@@ -289,9 +572,130 @@ class ChatGPT:
         answer = answer.strip()
         return answer
 
-    def _count_tokens_from_messages(self, messages, answer, model="gpt-3.5-turbo"):
-        encoding = tiktoken.encoding_for_model(model)
+    async def _acreate(self, api_resource, **kwargs):
+        """`api_resource.acreate(**kwargs)` with retries, circuit breaking and an adaptive timeout."""
+        async def request(timeout):
+            return await call_openai(api_resource.acreate, request_timeout=timeout, **kwargs)
+
+        return await resilience.get_policy(self.model).call(request, stream=kwargs.get("stream", False))
+
+    async def _open_chat_stream(self, n_input_tokens, wasted_tokens, **kwargs):
+        """
+        Opens a ChatCompletion stream, hedged with a second request if the first
+        token is late. What a losing request cost is added to `wasted_tokens`.
+        """
+        open_stream = functools.partial(self._acreate, openai.ChatCompletion, stream=True, **kwargs)
+        # with a single endpoint the second request would most likely be just as slow
+        if not config.openai_hedge_enabled or len(endpoint_pool.endpoints) < 2:
+            return await open_stream()
+
+        return await hedging.open_hedged_stream(
+            self.model,
+            open_stream,
+            is_token=lambda r_item: len(_get_delta_content(r_item)) > 0,
+            count_output_tokens=lambda r_items: sum(count_tokens(_get_delta_content(r_item), self.model) for r_item in r_items),
+            n_input_tokens=n_input_tokens,
+            get_hedge_slot=self._hedge_slot,
+            wasted_tokens=wasted_tokens,
+        )
+
+    def _completion_options(self):
+        return {
+            **OPENAI_COMPLETION_OPTIONS,
+            "max_tokens": config.models["info"][self.model].get("max_tokens", OPENAI_COMPLETION_OPTIONS["max_tokens"]),
+        }
+
+    def _count_content_tokens(self, content):
+        # user turns are stored either as plain text or as a list of text/image parts
+        if isinstance(content, str):
+            return count_tokens(content, self.model)
+
+        n_tokens = 0
+        for part in content:
+            if part.get("type") == "text":
+                n_tokens += count_tokens(part["text"], self.model)
+            elif part.get("type") in {"image", "image_url"}:
+                n_tokens += N_IMAGE_TOKENS
+        return n_tokens
+
+    def get_dialog_message_n_tokens(self, dialog_message) -> dict:
+        """
+        Returns token counts of a dialog turn to be stored with it, keyed by the
+        encoding name so that they stay valid for every model sharing it:
+        {"cl100k_base": {"user": ..., "bot": ...}}
+        """
+        return {
+            get_encoding(self.model).name: {
+                "user": self._count_content_tokens(dialog_message["user"]),
+                "bot": self._count_content_tokens(dialog_message["bot"]),
+            }
+        }
+
+    def count_dialog_message_tokens(self, dialog_message):
+        encoding_name = get_encoding(self.model).name
+        n_tokens = dialog_message.get("n_tokens", {}).get(encoding_name)
+        if n_tokens is None:  # stored before counts were recorded, or by a model with another encoding
+            n_tokens = self.get_dialog_message_n_tokens(dialog_message)[encoding_name]
+
+        if self.model == "text-davinci-003":
+            n_turn_tokens = count_tokens("User: \nAssistant: \n", self.model)
+        else:
+            tokens_per_message, _ = self._get_tokens_per_message(self.model)
+            n_turn_tokens = 2 * tokens_per_message
+
+        return n_turn_tokens + n_tokens["user"] + n_tokens["bot"]
+
+    def _count_request_tokens(self, message, chat_mode, image_buffer: BytesIO = None, dialog_summary=None):
+        """Tokens of everything sent besides the dialog history."""
+        n_tokens = count_prompt_start_tokens(chat_mode, self.model) + count_tokens(message, self.model)
+        if dialog_summary is not None:
+            n_tokens += count_tokens(f"{DIALOG_SUMMARY_PREFIX}{dialog_summary}", self.model)
+
+        if self.model == "text-davinci-003":
+            if dialog_summary is not None:
+                n_tokens += count_tokens("\n\n", self.model)
+            return n_tokens + count_tokens("\n\nChat:\nUser: \nAssistant: ", self.model) + 1
+
+        tokens_per_message, _ = self._get_tokens_per_message(self.model)
+        n_tokens += 2 * tokens_per_message + 2
+        if dialog_summary is not None:
+            n_tokens += tokens_per_message
+        if image_buffer is not None:
+            n_tokens += N_IMAGE_TOKENS
+
+        return n_tokens
 
+    def _count_input_tokens(self, message, dialog_messages, chat_mode, image_buffer: BytesIO = None, dialog_summary=None):
+        return self._count_request_tokens(message, chat_mode, image_buffer, dialog_summary) + sum(
+            self.count_dialog_message_tokens(dialog_message) for dialog_message in dialog_messages
+        )
+
+    def _fit_dialog_messages(self, message, dialog_messages, chat_mode, image_buffer: BytesIO = None, dialog_summary=None):
+        """
+        Returns the longest suffix of `dialog_messages` that fits into the model's
+        context window together with the request and `max_tokens` of answer,
+        so that a long dialog doesn't cost a failed request per dropped message.
+        """
+        context_window = config.models["info"][self.model].get("context_window")
+        if context_window is None:
+            return dialog_messages
+
+        n_free_tokens = (
+            context_window
+            - self._completion_options()["max_tokens"]
+            - self._count_request_tokens(message, chat_mode, image_buffer, dialog_summary)
+        )
+
+        n_fitting_messages = 0
+        for dialog_message in reversed(dialog_messages):
+            n_free_tokens -= self.count_dialog_message_tokens(dialog_message)
+            if n_free_tokens < 0:
+                break
+            n_fitting_messages += 1
+
+        return dialog_messages[len(dialog_messages) - n_fitting_messages:]
+
+    def _get_tokens_per_message(self, model):
         if model == "gpt-3.5-turbo-16k":
             tokens_per_message = 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
             tokens_per_name = -1  # if there's a name, the role is omitted
@@ -313,52 +717,22 @@ class ChatGPT:
         else:
             raise ValueError(f"Unknown model: {model}")
 
-        # input
-        n_input_tokens = 0
-        for message in messages:
-            n_input_tokens += tokens_per_message
-            if isinstance(message["content"], list):
-                for sub_message in message["content"]:
-                    if "type" in sub_message:
-                        if sub_message["type"] == "text":
-                            n_input_tokens += len(encoding.encode(sub_message["text"]))
-                        elif sub_message["type"] == "image_url":
-                            pass
-            else:
-                if "type" in message:
-                    if message["type"] == "text":
-                        n_input_tokens += len(encoding.encode(message["text"]))
-                    elif message["type"] == "image_url":
-                        pass
-
-
-        n_input_tokens += 2
-
-        # output
-        n_output_tokens = 1 + len(encoding.encode(answer))
-
-        return n_input_tokens, n_output_tokens
-
-    def _count_tokens_from_prompt(self, prompt, answer, model="text-davinci-003"):
-        encoding = tiktoken.encoding_for_model(model)
-
-        n_input_tokens = len(encoding.encode(prompt)) + 1
-        n_output_tokens = len(encoding.encode(answer))
-
-        return n_input_tokens, n_output_tokens
+        return tokens_per_message, tokens_per_name
 
 
 async def transcribe_audio(audio_file) -> str:
-    r = await openai.Audio.atranscribe("whisper-1", audio_file)
+    r = await call_openai(openai.Audio.atranscribe, "whisper-1", audio_file)
     return r["text"] or ""
 
 
 async def generate_images(prompt, n_images=4, size="512x512"):
-    r = await openai.Image.acreate(prompt=prompt, n=n_images, size=size)
+    r = await call_openai(openai.Image.acreate, prompt=prompt, n=n_images, size=size)
     image_urls = [item.url for item in r.data]
     return image_urls
 
 
 async def is_content_acceptable(prompt):
-    r = await openai.Moderation.acreate(input=prompt)
+    # Moderation.acreate takes no api_base, so it stays on the default endpoint
+    with pooled_http_session():
+        r = await openai.Moderation.acreate(input=prompt)
     return not all(r.results[0].categories.values())
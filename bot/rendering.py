@@ -0,0 +1,252 @@
+"""
+Incremental rendering of streamed model output into Telegram HTML.
+
+Telegram rejects an edit whose markup doesn't parse, and a partial answer
+often ends inside a tag, a code block or a bold span. Renderers turn the
+answer so far into HTML that always parses: `MarkdownRenderer` converts the
+Markdown the model writes in `parse_mode: markdown` chat modes, and
+`HTMLRenderer` keeps the tags Telegram supports in `parse_mode: html` ones,
+escapes everything else and closes whatever is still open. The HTML of
+complete lines is kept, so each update only renders the lines added since
+the last one.
+"""
+import html
+import re
+from typing import Tuple
+
+CODE_FENCE_RE = re.compile(r"\s*```\s*([\w+#.-]*)\s*$")
+PARTIAL_CODE_FENCE_RE = re.compile(r"\s*`{1,3}\s*[\w+#.-]*$")
+HEADER_RE = re.compile(r"#{1,6}\s+(.*)$")
+BULLET_RE = re.compile(r"(\s*)[*+-]\s+(.*)$")
+LINK_RE = re.compile(r"\[([^\[\]]+)\]\((https?://[^\s()]+)\)")
+EMPHASIS_TAGS = {"**": "b", "__": "b", "~~": "s", "*": "i", "_": "i"}
+
+TAG_RE = re.compile(r"<(/?)([a-zA-Z][\w-]*)([^<>]*)>")
+HREF_RE = re.compile(r"""\shref\s*=\s*["']([^"']*)["']""")
+ENTITY_RE = re.compile(r"&(lt|gt|amp|quot|#\d+|#x[0-9a-fA-F]+);")
+# what a partial line may end with that could still become a tag or an entity
+PARTIAL_TAG_RE = re.compile(r"</?([\w-]+(\s[^<>]*)?)?$")
+PARTIAL_ENTITY_RE = re.compile(r"&#?\w*$")
+CODE_CLASS_RE = re.compile(r"""\sclass\s*=\s*["'](language-[\w+#.-]+)["']""")
+SUPPORTED_TAGS = {"b", "strong", "i", "em", "u", "ins", "s", "strike", "del", "a", "code", "pre", "tg-spoiler", "blockquote"}
+# nothing inside these is markup, except a <code> right inside a <pre>
+VERBATIM_TAGS = {"code", "pre"}
+
+
+def escape(text: str) -> str:
+    return html.escape(text, quote=False)
+
+
+class Renderer:
+    """
+    `render(text)` returns HTML for the answer so far. Subclasses render one
+    line at a time, carrying a state (what's open) from line to line.
+    """
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        self._source = ""  # the complete lines rendered so far
+        self._html = ""
+        self._state = self.INITIAL_STATE
+
+    def render(self, text: str, is_final: bool = False) -> str:
+        """`is_final`: `text` won't grow anymore, so nothing at its end is left unfinished."""
+        if not text.startswith(self._source):
+            self._reset()  # not a continuation, e.g. the answer got stripped
+
+        end = text.rfind("\n") + 1
+        for line in text[len(self._source):end].split("\n")[:-1]:
+            line_html, self._state = self._render_line(line, self._state, is_partial=False)
+            self._html += line_html
+        self._source = text[:end]
+
+        line_html, state = self._render_line(text[end:], self._state, is_partial=not is_final)
+        line_html = line_html[:-1] if line_html.endswith("\n") else line_html  # the last line has no line break
+        return self._html + line_html + self._close(state)
+
+    def _render_line(self, line: str, state, is_partial: bool) -> Tuple[str, object]:
+        """HTML of `line`, ending with its line break unless it's partial, and the state after it."""
+        raise NotImplementedError
+
+    def _close(self, state) -> str:
+        """Closing tags for everything `state` has open."""
+        raise NotImplementedError
+
+
+class MarkdownRenderer(Renderer):
+    # language of the code block the line is in, None outside of code blocks
+    INITIAL_STATE = None
+
+    def _render_line(self, line: str, state, is_partial: bool) -> Tuple[str, object]:
+        line_break = "" if is_partial else "\n"
+
+        if is_partial and PARTIAL_CODE_FENCE_RE.match(line) is not None:
+            return "", state  # probably a code fence that's still being written
+
+        fence_match = CODE_FENCE_RE.match(line)
+        if fence_match is not None and not is_partial:
+            if state is not None:
+                return self._close(state) + line_break, None
+            # the code starts right after the tag, not on a line of its own
+            language = fence_match.group(1)
+            if len(language) > 0:
+                return f'<pre><code class="language-{escape(language)}">', language
+            return "<pre>", ""
+
+        if state is not None:
+            return escape(line) + line_break, state
+
+        header_match = HEADER_RE.match(line)
+        if header_match is not None:
+            return f"<b>{self._render_inline(header_match.group(1), is_partial)}</b>{line_break}", state
+
+        bullet_match = BULLET_RE.match(line)
+        if bullet_match is not None:
+            indent, item = bullet_match.groups()
+            return f"{indent}• {self._render_inline(item, is_partial)}{line_break}", state
+
+        return self._render_inline(line, is_partial) + line_break, state
+
+    def _close(self, state) -> str:
+        if state is None:
+            return ""
+        return "</code></pre>" if len(state) > 0 else "</pre>"
+
+    def _render_inline(self, line: str, is_partial: bool) -> str:
+        """
+        Inline code, links and emphasis. An emphasis marker opens only before
+        a non-space and closes only after one, and underscores inside words
+        are literal. What is still open at the end is closed if the line is
+        partial, and shown as it was written otherwise.
+        """
+        parts = []
+        open_markers = []  # (marker, index of its tag in parts)
+        i = 0
+        while i < len(line):
+            if line[i] == "`":
+                end = line.find("`", i + 1)
+                if end == -1:
+                    if is_partial:
+                        parts.append(f"<code>{escape(line[i + 1:])}</code>")
+                        break
+                    parts.append("`")
+                    i += 1
+                    continue
+                parts.append(f"<code>{escape(line[i + 1:end])}</code>")
+                i = end + 1
+                continue
+
+            link_match = LINK_RE.match(line, i) if line[i] == "[" else None
+            if link_match is not None:
+                text, url = link_match.groups()
+                parts.append(f'<a href="{html.escape(url)}">{escape(text)}</a>')
+                i = link_match.end()
+                continue
+
+            marker = line[i:i + 2] if line[i:i + 2] in EMPHASIS_TAGS else line[i]
+            if marker in EMPHASIS_TAGS:
+                before = line[i - 1] if i > 0 else " "
+                after = line[i + len(marker)] if i + len(marker) < len(line) else " "
+                is_underscore = marker[0] == "_"
+                tag = EMPHASIS_TAGS[marker]
+
+                if (
+                    len(open_markers) > 0
+                    and open_markers[-1][0] == marker
+                    and not before.isspace()
+                    and not (is_underscore and after.isalnum())
+                ):
+                    open_markers.pop()
+                    parts.append(f"</{tag}>")
+                elif (
+                    not after.isspace()
+                    and not (is_underscore and before.isalnum())
+                    and marker not in (open_marker for open_marker, _ in open_markers)
+                ):
+                    open_markers.append((marker, len(parts)))
+                    parts.append(f"<{tag}>")
+                else:
+                    parts.append(escape(marker))
+                i += len(marker)
+                continue
+
+            parts.append(escape(line[i]))
+            i += 1
+
+        for marker, index in reversed(open_markers):
+            if is_partial:
+                parts.append(f"</{EMPHASIS_TAGS[marker]}>")
+            else:
+                parts[index] = escape(marker)
+        return "".join(parts)
+
+
+class HTMLRenderer(Renderer):
+    # tags open so far, outermost first
+    INITIAL_STATE = ()
+
+    def _render_line(self, line: str, state, is_partial: bool) -> Tuple[str, object]:
+        parts = []
+        open_tags = list(state)
+        i = 0
+        while i < len(line):
+            is_verbatim = len(open_tags) > 0 and open_tags[-1] in VERBATIM_TAGS
+
+            if line[i] == "<":
+                tag_match = TAG_RE.match(line, i)
+                if tag_match is None:
+                    if is_partial and PARTIAL_TAG_RE.match(line, i) is not None:
+                        break  # a tag that's still being written
+                    parts.append("&lt;")
+                    i += 1
+                    continue
+
+                is_closing, tag, attributes = tag_match.group(1) == "/", tag_match.group(2).lower(), tag_match.group(3)
+                # in <pre><code>, a </pre> closes both
+                closes_verbatim = is_verbatim and (tag == open_tags[-1] or open_tags[-2:] == ["pre", "code"] and tag == "pre")
+                if is_closing and tag in open_tags and (not is_verbatim or closes_verbatim):
+                    # close the tags opened inside it too
+                    while True:
+                        open_tag = open_tags.pop()
+                        parts.append(f"</{open_tag}>")
+                        if open_tag == tag:
+                            break
+                elif not is_closing and tag in SUPPORTED_TAGS and (not is_verbatim or open_tags[-1:] == ["pre"] and tag == "code"):
+                    if tag == "a":
+                        href_match = HREF_RE.search(attributes)
+                        href = href_match.group(1) if href_match is not None else ""
+                        parts.append(f'<a href="{html.escape(html.unescape(href))}">')
+                    elif tag == "code" and CODE_CLASS_RE.search(attributes) is not None:
+                        parts.append(f'<code class="{escape(CODE_CLASS_RE.search(attributes).group(1))}">')
+                    else:
+                        parts.append(f"<{tag}>")
+                    open_tags.append(tag)
+                elif is_verbatim or tag not in SUPPORTED_TAGS:
+                    parts.append(escape(tag_match.group(0)))
+                # a closing tag of something that isn't open is dropped
+                i = tag_match.end()
+                continue
+
+            if line[i] == "&":
+                entity_match = ENTITY_RE.match(line, i)
+                if entity_match is not None:
+                    parts.append(entity_match.group(0))
+                    i = entity_match.end()
+                    continue
+                if is_partial and PARTIAL_ENTITY_RE.match(line, i) is not None:
+                    break  # an entity that's still being written
+                parts.append("&amp;")
+                i += 1
+                continue
+
+            parts.append(escape(line[i]))
+            i += 1
+
+        if not is_partial:
+            parts.append("\n")
+        return "".join(parts), tuple(open_tags)
+
+    def _close(self, state) -> str:
+        return "".join(f"</{tag}>" for tag in reversed(state))
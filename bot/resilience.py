@@ -0,0 +1,211 @@
+"""
+Retries, circuit breaking and adaptive timeouts for upstream model calls.
+
+Every model gets an `UpstreamPolicy`. Transient errors (rate limits, timeouts,
+connection errors, 5xx) are retried with exponential backoff and full jitter,
+honouring `Retry-After`. Consecutive failures open the model's circuit, and
+calls then fail fast with `CircuitOpenError` until a cooldown has passed.
+Request timeouts follow the observed latency like TCP's retransmission
+timeout: smoothed latency plus four deviations, clamped to configured bounds.
+For streams the adaptive timeout bounds opening the stream (time to the first
+byte); the stream as a whole is bounded by `openai_timeout_max`.
+"""
+import asyncio
+import logging
+import random
+import time
+from typing import Awaitable, Callable, Optional, TypeVar
+
+import openai
+
+import config
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, (
+        openai.error.RateLimitError,
+        openai.error.Timeout,
+        openai.error.APIConnectionError,
+        openai.error.ServiceUnavailableError,
+        openai.error.TryAgain,
+    )):
+        return True
+    if isinstance(error, openai.error.APIError):
+        return error.http_status is None or error.http_status >= 500
+    return isinstance(error, asyncio.TimeoutError)
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    headers = getattr(error, "headers", None) or {}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass  # an HTTP date, fall back to our own backoff
+    return None
+
+
+class CircuitBreaker:
+    """
+    Closed: calls pass. After `failure_threshold` consecutive failures: open,
+    calls fail fast for `cooldown` seconds. Then half-open: one trial call
+    passes, and its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, cooldown: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+
+        self.n_consecutive_failures = 0
+        self.opened_at = None
+        self._trial_in_progress = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return "open"
+        return "half_open"
+
+    def before_call(self) -> bool:
+        """Raises CircuitOpenError if the call can't pass, returns whether it is the trial call."""
+        state = self.state
+        if state == "open" or (state == "half_open" and self._trial_in_progress):
+            retry_in = max(self.cooldown - (time.monotonic() - self.opened_at), 0)
+            raise CircuitOpenError(f"{self.name} is unavailable, retry in {retry_in:.0f}s")
+        if state == "half_open":
+            self._trial_in_progress = True
+            return True
+        return False
+
+    def abandon_trial(self):
+        """The trial call ended without an outcome (cancelled), the next call becomes the trial."""
+        self._trial_in_progress = False
+
+    def record_success(self):
+        self.n_consecutive_failures = 0
+        self.opened_at = None
+        self._trial_in_progress = False
+
+    def record_failure(self):
+        self.n_consecutive_failures += 1
+        if self._trial_in_progress or self.n_consecutive_failures >= self.failure_threshold:
+            if self.opened_at is None or self._trial_in_progress:
+                logger.warning(f"Circuit for {self.name} opened after {self.n_consecutive_failures} failures")
+            self.opened_at = time.monotonic()
+        self._trial_in_progress = False
+
+
+class AdaptiveTimeout:
+    """Request timeout of srtt + 4 * rttvar (RFC 6298), clamped to [min_timeout, max_timeout]."""
+
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+
+    def __init__(self, min_timeout: float, max_timeout: float):
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+
+        self.srtt = None
+        self.rttvar = None
+
+    def observe(self, latency: float):
+        if self.srtt is None:
+            self.srtt, self.rttvar = latency, latency / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - latency)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * latency
+
+    def backoff(self):
+        # like RFC 6298 5.5: a request that timed out doubles the next timeout
+        if self.srtt is not None:
+            self.srtt = min(2 * self.srtt, self.max_timeout)
+
+    @property
+    def timeout(self) -> float:
+        if self.srtt is None:
+            return self.max_timeout
+        return min(max(self.srtt + 4 * self.rttvar, self.min_timeout), self.max_timeout)
+
+
+class UpstreamPolicy:
+    def __init__(self, name: str):
+        self.name = name
+        self.breaker = CircuitBreaker(
+            name,
+            failure_threshold=config.openai_circuit_failure_threshold,
+            cooldown=config.openai_circuit_cooldown,
+        )
+        # opening a stream and getting a complete answer take very different times
+        self.timeouts = {
+            stream: AdaptiveTimeout(config.openai_timeout_min, config.openai_timeout_max)
+            for stream in (False, True)
+        }
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, config.openai_retry_max_delay)
+        return random.uniform(0, min(config.openai_retry_base_delay * 2 ** attempt, config.openai_retry_max_delay))
+
+    async def call(self, request: Callable[[float], Awaitable[T]], stream: bool = False) -> T:
+        """
+        Runs `request(timeout)` with retries. For streams `request` should open
+        the stream; only that part is timed and retried.
+        """
+        timeout = self.timeouts[stream]
+        for attempt in range(config.openai_max_attempts):
+            is_trial = self.breaker.before_call()
+
+            started_at = time.monotonic()
+            try:
+                if stream:
+                    result = await asyncio.wait_for(request(config.openai_timeout_max), timeout.timeout)
+                else:
+                    result = await request(timeout.timeout)
+            except Exception as e:
+                if isinstance(e, (openai.error.Timeout, asyncio.TimeoutError)):
+                    timeout.backoff()
+                if not is_retryable(e):
+                    # the upstream answered, it's just our request it didn't like
+                    self.breaker.record_success()
+                    raise
+
+                self.breaker.record_failure()
+                if attempt + 1 == config.openai_max_attempts:
+                    raise
+
+                delay = self._backoff(attempt, e)
+                logger.warning(f"{self.name} request failed ({type(e).__name__}: {e}), retry {attempt + 1} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # cancelled: says nothing about the upstream, but must not block it forever
+                if is_trial:
+                    self.breaker.abandon_trial()
+                raise
+
+            self.breaker.record_success()
+            timeout.observe(time.monotonic() - started_at)
+            return result
+
+
+_policies = {}
+
+
+def get_policy(name: str) -> UpstreamPolicy:
+    if name not in _policies:
+        _policies[name] = UpstreamPolicy(name)
+    return _policies[name]
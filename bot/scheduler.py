@@ -0,0 +1,151 @@
+"""
+Bounds concurrent upstream requests per model and queues the rest.
+
+Waiting requests are split into a premium and a free lane and dispatched by
+weighted fair queuing (stride scheduling): with weights 3 and 1, premium
+users get three slots for every one of free users while both lanes are
+backlogged, and neither lane can starve.
+"""
+import asyncio
+import collections
+import contextlib
+import logging
+import time
+from typing import Awaitable, Callable, Optional
+
+import config
+
+logger = logging.getLogger(__name__)
+
+LANES = ("premium", "free")
+
+
+class _Waiter:
+    def __init__(self, future: asyncio.Future):
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+
+class ModelScheduler:
+    # weight of the latest request in the smoothed queue wait time
+    WAIT_TIME_ALPHA = 0.1
+
+    def __init__(self, model: str, max_concurrent_requests: int, lane_weights: dict):
+        self.model = model
+        self.max_concurrent_requests = max_concurrent_requests
+        self.lane_weights = lane_weights
+
+        self.n_running = 0
+        self.queues = {lane: collections.deque() for lane in LANES}
+        # virtual time of each lane, advanced by 1 / weight per dispatched request
+        self.passes = {lane: 0.0 for lane in LANES}
+
+        self.n_queued_total = 0
+        self.avg_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    @property
+    def has_free_slot(self) -> bool:
+        """Whether a request would get a slot right away."""
+        return self.n_running < self.max_concurrent_requests and self.queue_depth == 0
+
+    def _pick_lane(self) -> Optional[str]:
+        backlogged_lanes = [lane for lane in LANES if len(self.queues[lane]) > 0]
+        if len(backlogged_lanes) == 0:
+            return None
+        return min(backlogged_lanes, key=lambda lane: self.passes[lane])
+
+    def _advance(self, lane: str):
+        self.passes[lane] += 1 / self.lane_weights[lane]
+
+        # a lane that was idle must not bank credit for a burst later
+        for other_lane in LANES:
+            if other_lane != lane and len(self.queues[other_lane]) == 0:
+                self.passes[other_lane] = max(self.passes[other_lane], self.passes[lane] - 1 / self.lane_weights[lane])
+
+    def _dispatch(self):
+        while self.n_running < self.max_concurrent_requests:
+            lane = self._pick_lane()
+            if lane is None:
+                return
+
+            waiter = self.queues[lane].popleft()
+            self._advance(lane)
+            self.n_running += 1
+            waiter.future.set_result(None)
+
+            wait_time = time.monotonic() - waiter.enqueued_at
+            self.avg_wait_time += self.WAIT_TIME_ALPHA * (wait_time - self.avg_wait_time)
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, premium: bool = False, on_queued: Optional[Callable[[int], Awaitable]] = None):
+        """
+        Holds one of the model's request slots for the duration of the block.
+        If all are busy, waits in the caller's lane; `on_queued(position)` is
+        awaited once with the caller's 1-based position in that lane.
+        """
+        lane = "premium" if premium else "free"
+
+        if self.has_free_slot:
+            self._advance(lane)
+            self.n_running += 1
+        else:
+            waiter = _Waiter(asyncio.get_running_loop().create_future())
+            self.queues[lane].append(waiter)
+            self.n_queued_total += 1
+            self._dispatch()
+
+            try:
+                if on_queued is not None and not waiter.future.done():
+                    try:
+                        await on_queued(len(self.queues[lane]))
+                    except Exception:
+                        logger.exception("Failed to report queue position")
+
+                await waiter.future
+            except asyncio.CancelledError:
+                if not waiter.future.done() or waiter.future.cancelled():
+                    self.queues[lane].remove(waiter)
+                else:
+                    # the slot was handed to us right as we got cancelled
+                    self.n_running -= 1
+                    self._dispatch()
+                raise
+
+        try:
+            yield
+        finally:
+            self.n_running -= 1
+            self._dispatch()
+
+    def stats(self) -> dict:
+        return {
+            "running": self.n_running,
+            "queued": {lane: len(queue) for lane, queue in self.queues.items()},
+            "queued_total": self.n_queued_total,
+            "avg_wait_time": self.avg_wait_time,
+            "max_wait_time": self.max_wait_time,
+        }
+
+
+_schedulers = {}
+
+
+def get_scheduler(model: str) -> ModelScheduler:
+    if model not in _schedulers:
+        model_info = config.models["info"].get(model, {})
+        _schedulers[model] = ModelScheduler(
+            model,
+            max_concurrent_requests=model_info.get("max_concurrent_requests", config.openai_max_concurrent_requests),
+            lane_weights={"premium": config.premium_lane_weight, "free": 1},
+        )
+    return _schedulers[model]
+
+
+def stats() -> dict:
+    return {model: scheduler.stats() for model, scheduler in _schedulers.items()}
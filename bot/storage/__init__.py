@@ -0,0 +1,18 @@
+from storage.base import Storage
+
+
+def create_storage(backend: str) -> Storage:
+    """Returns the storage backend named by `storage_backend` in config.yml."""
+    # backends are imported lazily so that e.g. the SQLite backend works
+    # without motor installed
+    if backend == "mongo":
+        from storage.mongo import MongoStorage
+        return MongoStorage()
+    elif backend == "sqlite":
+        from storage.sqlite import SQLiteStorage
+        return SQLiteStorage()
+    elif backend == "memory":
+        from storage.memory import MemoryStorage
+        return MemoryStorage()
+    else:
+        raise ValueError(f"Unknown storage backend: {backend}")
@@ -0,0 +1,121 @@
+from typing import Any, AsyncIterator, Optional
+
+
+class Storage:
+    """
+    Persistence backend behind `database.Database`.
+
+    Documents are plain dicts keyed by "_id", shaped like the MongoDB documents
+    the bot has always stored. Keys passed to `update_user` and
+    `increment_users` may be dotted paths into nested dicts.
+    """
+
+    async def start(self):
+        """Prepares the backend (tables, indexes, background jobs)."""
+
+    async def close(self):
+        """Stops background jobs and releases connections."""
+
+    async def watch_user_changes(self) -> AsyncIterator[int]:
+        """
+        Yields ids of users whose document, current dialog or payments were
+        changed by other processes. Changes made through this instance may be
+        left out, `Database` updates its cache for them itself. Raises
+        NotImplementedError if the backend can't watch changes.
+        """
+        raise NotImplementedError(f"{type(self).__name__} can't watch changes")
+        yield
+
+    # users
+
+    async def get_user(self, user_id: int) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def insert_user(self, user_dict: dict):
+        raise NotImplementedError
+
+    async def upsert_user(self, user_id: int, defaults: dict, fields: dict) -> dict:
+        """
+        Atomically creates the user from `defaults` if it doesn't exist, otherwise
+        fills keys that are missing or None from `defaults`. Then sets `fields`.
+        Returns the resulting document.
+        """
+        raise NotImplementedError
+
+    async def update_user(self, user_id: int, fields: dict) -> bool:
+        """Sets `fields`, returns False if there is no such user."""
+        raise NotImplementedError
+
+    async def increment_users(self, increments: dict):
+        """Applies {user_id: {path: value}} increments in one batch."""
+        raise NotImplementedError
+
+    # dialogs
+
+    async def insert_dialog(self, dialog_dict: dict):
+        raise NotImplementedError
+
+    async def get_dialog_messages(self, user_id: int, dialog_id: str, last_n: Optional[int] = None) -> Optional[list]:
+        """Returns messages oldest first (only the last `last_n` if given), or None if there is no such dialog."""
+        raise NotImplementedError
+
+    async def count_dialog_messages(self, user_id: int, dialog_id: str) -> Optional[int]:
+        """Returns the number of messages, or None if there is no such dialog."""
+        raise NotImplementedError
+
+    async def set_dialog_messages(self, user_id: int, dialog_id: str, messages: list) -> bool:
+        raise NotImplementedError
+
+    async def push_dialog_message(self, user_id: int, dialog_id: str, message: dict) -> bool:
+        raise NotImplementedError
+
+    async def pop_dialog_message(self, user_id: int, dialog_id: str) -> Optional[dict]:
+        """Removes and returns the last message, or None if the dialog is empty or missing."""
+        raise NotImplementedError
+
+    async def get_dialog_summary(self, user_id: int, dialog_id: str) -> Optional[dict]:
+        """Returns the summary of the dialog's oldest messages, or None if it has none."""
+        raise NotImplementedError
+
+    async def set_dialog_summary(self, user_id: int, dialog_id: str, summary: dict) -> bool:
+        """Sets the summary without touching `updated_at`, so it doesn't delay archiving."""
+        raise NotImplementedError
+
+    # payments
+
+    async def insert_payment(self, payment_dict: dict):
+        raise NotImplementedError
+
+    async def find_payment(self, key: str, value: Any) -> Optional[dict]:
+        """Returns the first payment whose (dotted) `key` equals `value`."""
+        raise NotImplementedError
+
+    async def update_payment(self, pay_id: str, fields: dict) -> bool:
+        raise NotImplementedError
+
+
+def get_path(doc: dict, path: str, default: Any = None) -> Any:
+    node = doc
+    for key in path.split("."):
+        if not isinstance(node, dict) or key not in node:
+            return default
+        node = node[key]
+    return node
+
+
+def set_path(doc: dict, path: str, value: Any):
+    *parents, key = path.split(".")
+    node = doc
+    for parent in parents:
+        node = node.setdefault(parent, {})
+    node[key] = value
+
+
+def inc_path(doc: dict, path: str, value: float):
+    set_path(doc, path, (get_path(doc, path) or 0) + value)
+
+
+def fill_defaults(doc: dict, defaults: dict):
+    for key, value in defaults.items():
+        if doc.get(key) is None:
+            doc[key] = value
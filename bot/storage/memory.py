@@ -0,0 +1,149 @@
+import asyncio
+import copy
+from datetime import datetime
+from typing import Any, AsyncIterator, Optional
+
+from storage.base import Storage, fill_defaults, get_path, inc_path, set_path
+
+
+class MemoryStorage(Storage):
+    """
+    Keeps everything in process memory. Nothing survives a restart; meant for
+    local runs, tests and benchmarks without external services.
+
+    Every method runs without awaiting, so each one is atomic on the event loop.
+    Documents are copied on the way in and out, like a real database would.
+    """
+
+    def __init__(self):
+        self.users = {}
+        self.dialogs = {}
+        self.payments = {}
+
+    async def watch_user_changes(self) -> AsyncIterator[int]:
+        # nothing outside this process can write here
+        await asyncio.Event().wait()
+        yield
+
+    # users
+
+    async def get_user(self, user_id: int) -> Optional[dict]:
+        return copy.deepcopy(self.users.get(user_id))
+
+    async def insert_user(self, user_dict: dict):
+        if user_dict["_id"] in self.users:
+            raise ValueError(f"User {user_dict['_id']} already exists")
+        self.users[user_dict["_id"]] = copy.deepcopy(user_dict)
+
+    async def upsert_user(self, user_id: int, defaults: dict, fields: dict) -> dict:
+        user_dict = self.users.setdefault(user_id, {"_id": user_id})
+        fill_defaults(user_dict, copy.deepcopy(defaults))
+        user_dict.update(copy.deepcopy(fields))
+        return copy.deepcopy(user_dict)
+
+    async def update_user(self, user_id: int, fields: dict) -> bool:
+        user_dict = self.users.get(user_id)
+        if user_dict is None:
+            return False
+
+        for path, value in copy.deepcopy(fields).items():
+            set_path(user_dict, path, value)
+        return True
+
+    async def increment_users(self, increments: dict):
+        for user_id, user_increments in increments.items():
+            user_dict = self.users.get(user_id)
+            if user_dict is None:
+                continue
+
+            for path, value in user_increments.items():
+                inc_path(user_dict, path, value)
+
+    # dialogs
+
+    def _get_dialog(self, user_id: int, dialog_id: str) -> Optional[dict]:
+        dialog_dict = self.dialogs.get(dialog_id)
+        if dialog_dict is None or dialog_dict["user_id"] != user_id:
+            return None
+        return dialog_dict
+
+    async def insert_dialog(self, dialog_dict: dict):
+        if dialog_dict["_id"] in self.dialogs:
+            raise ValueError(f"Dialog {dialog_dict['_id']} already exists")
+        self.dialogs[dialog_dict["_id"]] = copy.deepcopy(dialog_dict)
+
+    async def get_dialog_messages(self, user_id: int, dialog_id: str, last_n: Optional[int] = None) -> Optional[list]:
+        dialog_dict = self._get_dialog(user_id, dialog_id)
+        if dialog_dict is None:
+            return None
+
+        messages = dialog_dict["messages"]
+        return copy.deepcopy(messages[-last_n:] if last_n is not None else messages)
+
+    async def count_dialog_messages(self, user_id: int, dialog_id: str) -> Optional[int]:
+        dialog_dict = self._get_dialog(user_id, dialog_id)
+        if dialog_dict is None:
+            return None
+        return len(dialog_dict["messages"])
+
+    async def set_dialog_messages(self, user_id: int, dialog_id: str, messages: list) -> bool:
+        dialog_dict = self._get_dialog(user_id, dialog_id)
+        if dialog_dict is None:
+            return False
+
+        dialog_dict["messages"] = copy.deepcopy(messages)
+        dialog_dict["updated_at"] = datetime.now()
+        return True
+
+    async def push_dialog_message(self, user_id: int, dialog_id: str, message: dict) -> bool:
+        dialog_dict = self._get_dialog(user_id, dialog_id)
+        if dialog_dict is None:
+            return False
+
+        dialog_dict["messages"].append(copy.deepcopy(message))
+        dialog_dict["updated_at"] = datetime.now()
+        return True
+
+    async def pop_dialog_message(self, user_id: int, dialog_id: str) -> Optional[dict]:
+        dialog_dict = self._get_dialog(user_id, dialog_id)
+        if dialog_dict is None or len(dialog_dict["messages"]) == 0:
+            return None
+
+        dialog_dict["updated_at"] = datetime.now()
+        return dialog_dict["messages"].pop()
+
+    async def get_dialog_summary(self, user_id: int, dialog_id: str) -> Optional[dict]:
+        dialog_dict = self._get_dialog(user_id, dialog_id)
+        if dialog_dict is None:
+            return None
+        return copy.deepcopy(dialog_dict.get("summary"))
+
+    async def set_dialog_summary(self, user_id: int, dialog_id: str, summary: dict) -> bool:
+        dialog_dict = self._get_dialog(user_id, dialog_id)
+        if dialog_dict is None:
+            return False
+
+        dialog_dict["summary"] = copy.deepcopy(summary)
+        return True
+
+    # payments
+
+    async def insert_payment(self, payment_dict: dict):
+        if payment_dict["_id"] in self.payments:
+            raise ValueError(f"Payment {payment_dict['_id']} already exists")
+        self.payments[payment_dict["_id"]] = copy.deepcopy(payment_dict)
+
+    async def find_payment(self, key: str, value: Any) -> Optional[dict]:
+        for payment_dict in self.payments.values():
+            if get_path(payment_dict, key) == value:
+                return copy.deepcopy(payment_dict)
+        return None
+
+    async def update_payment(self, pay_id: str, fields: dict) -> bool:
+        payment_dict = self.payments.get(pay_id)
+        if payment_dict is None:
+            return False
+
+        for path, value in copy.deepcopy(fields).items():
+            set_path(payment_dict, path, value)
+        return True
@@ -0,0 +1,238 @@
+import itertools
+import uuid
+from datetime import datetime
+from typing import Any, AsyncIterator, Optional
+
+import motor.motor_asyncio
+import pymongo
+
+import archive
+import config
+import indexes
+import migrations
+from storage.base import Storage
+
+# tags every write with the process that made it, see MongoStorage.watch_user_changes
+ORIGIN_FIELD = "_origin"
+WITHOUT_ORIGIN = {ORIGIN_FIELD: 0}
+
+
+class MongoStorage(Storage):
+    def __init__(self, uri: Optional[str] = None, db_name: str = "chatgpt_telegram_bot"):
+        # motor client is lazy: no connection is made until the first awaited
+        # operation, so it is safe to create it before the event loop runs
+        self.client = motor.motor_asyncio.AsyncIOMotorClient(uri or config.mongodb_uri)
+        self.db = self.client[db_name]
+
+        self.user_collection = self.db["user"]
+        self.dialog_collection = self.db["dialog"]
+        self.payment_collection = self.db["payments"]
+        self.dialog_archive_collection = self.db["dialog_archive"]
+        self.archiver = archive.DialogArchiver(self.dialog_collection, self.dialog_archive_collection)
+
+        self._resume_token = None
+        self.origin = uuid.uuid4().hex
+        self._write_seq = itertools.count()
+
+    async def start(self):
+        await indexes.ensure_indexes(self.db)
+        await migrations.migrate(self.db)
+        if config.dialog_archive_after_days is not None:
+            self.archiver.start()
+
+    async def close(self):
+        await self.archiver.stop()
+
+    def _origin_tag(self) -> str:
+        # unique per write: a field set to its current value is left out of change events
+        return f"{self.origin}:{next(self._write_seq)}"
+
+    def _is_own_change(self, change: dict) -> bool:
+        if change["operationType"] == "insert":
+            origin = change["fullDocument"].get(ORIGIN_FIELD)
+        elif change["operationType"] == "update":
+            origin = change["updateDescription"]["updatedFields"].get(ORIGIN_FIELD)
+        else:
+            return False
+        return isinstance(origin, str) and origin.startswith(f"{self.origin}:")
+
+    # dialog updates are left out: they are frequent and never touch cached state
+    CHANGE_STREAM_PIPELINE = [
+        {"$match": {"$or": [
+            {"ns.coll": {"$in": ["user", "payments"]}},
+            {"ns.coll": "dialog", "operationType": "insert"},
+        ]}},
+        {"$project": {
+            "ns": 1,
+            "operationType": 1,
+            "documentKey": 1,
+            "fullDocument.user_id": 1,
+            f"fullDocument.{ORIGIN_FIELD}": 1,
+            f"updateDescription.updatedFields.{ORIGIN_FIELD}": 1,
+        }},
+    ]
+
+    async def watch_user_changes(self) -> AsyncIterator[int]:
+        try:
+            async with self.db.watch(
+                self.CHANGE_STREAM_PIPELINE,
+                full_document="updateLookup",
+                resume_after=self._resume_token,
+            ) as stream:
+                async for change in stream:
+                    self._resume_token = stream.resume_token
+
+                    if self._is_own_change(change):
+                        continue  # Database has updated its cache already
+                    if change["ns"]["coll"] == "user":
+                        yield change["documentKey"]["_id"]
+                    elif change.get("fullDocument") is not None:
+                        yield change["fullDocument"]["user_id"]
+        except pymongo.errors.OperationFailure as e:
+            if e.code in (20, 40573):  # IllegalOperation, not a replica set
+                raise NotImplementedError(str(e)) from e
+            if e.code == 286:  # ChangeStreamHistoryLost, the resume token is too old
+                self._resume_token = None
+            raise
+
+    # users
+
+    async def get_user(self, user_id: int) -> Optional[dict]:
+        return await self.user_collection.find_one({"_id": user_id}, WITHOUT_ORIGIN)
+
+    async def insert_user(self, user_dict: dict):
+        await self.user_collection.insert_one({**user_dict, ORIGIN_FIELD: self._origin_tag()})
+
+    async def upsert_user(self, user_id: int, defaults: dict, fields: dict) -> dict:
+        update = {key: {"$ifNull": [f"${key}", {"$literal": value}]} for key, value in defaults.items()}
+        update.update({key: {"$literal": value} for key, value in fields.items()})
+        update[ORIGIN_FIELD] = {"$literal": self._origin_tag()}
+
+        return await self.user_collection.find_one_and_update(
+            {"_id": user_id},
+            [{"$set": update}],
+            projection=WITHOUT_ORIGIN,
+            upsert=True,
+            return_document=pymongo.ReturnDocument.AFTER,
+        )
+
+    async def update_user(self, user_id: int, fields: dict) -> bool:
+        result = await self.user_collection.update_one(
+            {"_id": user_id}, {"$set": {**fields, ORIGIN_FIELD: self._origin_tag()}}
+        )
+        return result.matched_count > 0
+
+    async def increment_users(self, increments: dict):
+        await self.user_collection.bulk_write([
+            pymongo.UpdateOne({"_id": user_id}, {"$inc": user_increments, "$set": {ORIGIN_FIELD: self._origin_tag()}})
+            for user_id, user_increments in increments.items()
+        ], ordered=False)
+
+    # dialogs
+
+    async def insert_dialog(self, dialog_dict: dict):
+        await self.dialog_collection.insert_one({**dialog_dict, ORIGIN_FIELD: self._origin_tag()})
+
+    async def _restore_archived_dialog(self, user_id: int, dialog_id: str) -> bool:
+        """Moves an archived dialog back to the live collection, returns False if there is none."""
+        archived_dialog_dict = await self.dialog_archive_collection.find_one({"_id": dialog_id, "user_id": user_id})
+        if archived_dialog_dict is None:
+            return False
+
+        dialog_dict = archive.unarchive_dialog_dict(archived_dialog_dict)
+        dialog_dict["updated_at"] = datetime.now()
+        dialog_dict[ORIGIN_FIELD] = self._origin_tag()
+        try:
+            await self.dialog_collection.insert_one(dialog_dict)
+        except pymongo.errors.DuplicateKeyError:
+            pass  # restored concurrently
+        await self.dialog_archive_collection.delete_one({"_id": dialog_id})
+        return True
+
+    async def _update_dialog(self, user_id: int, dialog_id: str, update: dict) -> bool:
+        update.setdefault("$set", {})["updated_at"] = datetime.now()
+
+        result = await self.dialog_collection.update_one({"_id": dialog_id, "user_id": user_id}, update)
+        if result.matched_count == 0 and await self._restore_archived_dialog(user_id, dialog_id):
+            result = await self.dialog_collection.update_one({"_id": dialog_id, "user_id": user_id}, update)
+
+        return result.matched_count > 0
+
+    async def get_dialog_messages(self, user_id: int, dialog_id: str, last_n: Optional[int] = None) -> Optional[list]:
+        projection = {"messages": {"$slice": -last_n}} if last_n is not None else {"messages": 1}
+        dialog_dict = await self.dialog_collection.find_one({"_id": dialog_id, "user_id": user_id}, projection)
+        if dialog_dict is not None:
+            return dialog_dict["messages"]
+
+        # slow path: the dialog was archived
+        archived_dialog_dict = await self.dialog_archive_collection.find_one({"_id": dialog_id, "user_id": user_id})
+        if archived_dialog_dict is None:
+            return None
+
+        messages = archive.decompress_messages(archived_dialog_dict["messages_zlib"])
+        return messages[-last_n:] if last_n is not None else messages
+
+    async def count_dialog_messages(self, user_id: int, dialog_id: str) -> Optional[int]:
+        query = {"_id": dialog_id, "user_id": user_id}
+        results = await self.dialog_collection.aggregate([
+            {"$match": query},
+            {"$project": {"n_messages": {"$size": "$messages"}}},
+        ]).to_list(1)
+        if len(results) > 0:
+            return results[0]["n_messages"]
+
+        archived_dialog_dict = await self.dialog_archive_collection.find_one(query, {"n_messages": 1})
+        if archived_dialog_dict is None:
+            return None
+        return archived_dialog_dict["n_messages"]
+
+    async def set_dialog_messages(self, user_id: int, dialog_id: str, messages: list) -> bool:
+        return await self._update_dialog(user_id, dialog_id, {"$set": {"messages": messages}})
+
+    async def push_dialog_message(self, user_id: int, dialog_id: str, message: dict) -> bool:
+        return await self._update_dialog(user_id, dialog_id, {"$push": {"messages": message}})
+
+    async def pop_dialog_message(self, user_id: int, dialog_id: str) -> Optional[dict]:
+        for _ in range(2):
+            dialog_dict = await self.dialog_collection.find_one_and_update(
+                {"_id": dialog_id, "user_id": user_id, "messages.0": {"$exists": True}},
+                {"$pop": {"messages": 1}, "$set": {"updated_at": datetime.now()}},
+                projection={"messages": {"$slice": -1}},
+                return_document=pymongo.ReturnDocument.BEFORE,
+            )
+            if dialog_dict is not None:
+                return dialog_dict["messages"][0]
+
+            if not await self._restore_archived_dialog(user_id, dialog_id):
+                return None
+
+        return None
+
+    async def get_dialog_summary(self, user_id: int, dialog_id: str) -> Optional[dict]:
+        query = {"_id": dialog_id, "user_id": user_id}
+        dialog_dict = (
+            await self.dialog_collection.find_one(query, {"summary": 1})
+            or await self.dialog_archive_collection.find_one(query, {"summary": 1})
+        )
+        if dialog_dict is None:
+            return None
+        return dialog_dict.get("summary")
+
+    async def set_dialog_summary(self, user_id: int, dialog_id: str, summary: dict) -> bool:
+        # an archived dialog is not being talked to, so there is nothing to summarize
+        result = await self.dialog_collection.update_one({"_id": dialog_id, "user_id": user_id}, {"$set": {"summary": summary}})
+        return result.matched_count > 0
+
+    # payments
+
+    async def insert_payment(self, payment_dict: dict):
+        await self.payment_collection.insert_one({**payment_dict, ORIGIN_FIELD: self._origin_tag()})
+
+    async def find_payment(self, key: str, value: Any) -> Optional[dict]:
+        return await self.payment_collection.find_one({key: value}, WITHOUT_ORIGIN)
+
+    async def update_payment(self, pay_id: str, fields: dict) -> bool:
+        result = await self.payment_collection.update_one(
+            {"_id": pay_id}, {"$set": {**fields, ORIGIN_FIELD: self._origin_tag()}}
+        )
+        return result.matched_count > 0
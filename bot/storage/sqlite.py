@@ -0,0 +1,320 @@
+import asyncio
+import json
+import re
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Optional
+
+import config
+from storage.base import Storage, fill_defaults, inc_path, set_path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user (
+    id INTEGER PRIMARY KEY,
+    doc TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS dialog (
+    id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    updated_at TEXT NOT NULL,
+    doc TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS dialog_user_id ON dialog (user_id);
+CREATE TABLE IF NOT EXISTS dialog_message (
+    dialog_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    message TEXT NOT NULL,
+    PRIMARY KEY (dialog_id, seq)
+);
+CREATE TABLE IF NOT EXISTS payment (
+    id TEXT PRIMARY KEY,
+    doc TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS payment_payment_id ON payment (json_extract(doc, '$.payment_id'));
+CREATE INDEX IF NOT EXISTS payment_additional_data_uuid ON payment (json_extract(doc, '$.additional_data.uuid'));
+"""
+
+
+def _json_default(value: Any):
+    if isinstance(value, datetime):
+        return {"$date": value.isoformat()}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _json_object_hook(value: dict):
+    if len(value) == 1 and "$date" in value:
+        return datetime.fromisoformat(value["$date"])
+    return value
+
+
+def dumps(doc: Any) -> str:
+    return json.dumps(doc, default=_json_default, ensure_ascii=False)
+
+
+def loads(data: str) -> Any:
+    return json.loads(data, object_hook=_json_object_hook)
+
+
+class SQLiteStorage(Storage):
+    """
+    Embedded single-file backend for small deployments and local benchmarks.
+
+    The database runs in WAL mode. All statements go through one worker thread,
+    so each method is a single serialized transaction and the event loop never
+    blocks on disk.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or config.sqlite_path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._conn = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            if self.path != ":memory:":
+                Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+
+            self._conn = sqlite3.connect(self.path)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+        return self._conn
+
+    async def _run(self, fn, *args):
+        def run_in_transaction():
+            conn = self._connect()
+            with conn:
+                return fn(conn, *args)
+
+        return await asyncio.get_running_loop().run_in_executor(self._executor, run_in_transaction)
+
+    async def start(self):
+        await self._run(self._rename_premiumn_till)
+
+    @classmethod
+    def _rename_premiumn_till(cls, conn: sqlite3.Connection):
+        # update_user_subscription used to write the expiry to a misspelled field
+        rows = conn.execute("SELECT doc FROM user WHERE json_type(doc, '$.premiumn_till') IS NOT NULL").fetchall()
+        for (doc,) in rows:
+            user_dict = loads(doc)
+            user_dict["premium_till"] = user_dict.pop("premiumn_till")
+            cls._save_user(conn, user_dict)
+
+    async def close(self):
+        def close_connection():
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+        await asyncio.get_running_loop().run_in_executor(self._executor, close_connection)
+        self._executor.shutdown(wait=True)
+
+    # users
+
+    @staticmethod
+    def _get_user(conn: sqlite3.Connection, user_id: int) -> Optional[dict]:
+        row = conn.execute("SELECT doc FROM user WHERE id = ?", (user_id,)).fetchone()
+        return loads(row[0]) if row is not None else None
+
+    @staticmethod
+    def _save_user(conn: sqlite3.Connection, user_dict: dict):
+        conn.execute(
+            "INSERT INTO user (id, doc) VALUES (?, ?) ON CONFLICT (id) DO UPDATE SET doc = excluded.doc",
+            (user_dict["_id"], dumps(user_dict))
+        )
+
+    async def get_user(self, user_id: int) -> Optional[dict]:
+        return await self._run(self._get_user, user_id)
+
+    async def insert_user(self, user_dict: dict):
+        await self._run(
+            lambda conn: conn.execute("INSERT INTO user (id, doc) VALUES (?, ?)", (user_dict["_id"], dumps(user_dict)))
+        )
+
+    async def upsert_user(self, user_id: int, defaults: dict, fields: dict) -> dict:
+        def upsert(conn):
+            user_dict = self._get_user(conn, user_id) or {"_id": user_id}
+            fill_defaults(user_dict, defaults)
+            user_dict.update(fields)
+            self._save_user(conn, user_dict)
+            return user_dict
+
+        return loads(dumps(await self._run(upsert)))  # don't hand out the caller's defaults
+
+    async def update_user(self, user_id: int, fields: dict) -> bool:
+        def update(conn):
+            user_dict = self._get_user(conn, user_id)
+            if user_dict is None:
+                return False
+
+            for path, value in fields.items():
+                set_path(user_dict, path, value)
+            self._save_user(conn, user_dict)
+            return True
+
+        return await self._run(update)
+
+    async def increment_users(self, increments: dict):
+        def increment(conn):
+            for user_id, user_increments in increments.items():
+                user_dict = self._get_user(conn, user_id)
+                if user_dict is None:
+                    continue
+
+                for path, value in user_increments.items():
+                    inc_path(user_dict, path, value)
+                self._save_user(conn, user_dict)
+
+        await self._run(increment)
+
+    # dialogs
+
+    @staticmethod
+    def _touch_dialog(conn: sqlite3.Connection, user_id: int, dialog_id: str) -> bool:
+        cursor = conn.execute(
+            "UPDATE dialog SET updated_at = ? WHERE id = ? AND user_id = ?",
+            (datetime.now().isoformat(), dialog_id, user_id)
+        )
+        return cursor.rowcount > 0
+
+    async def insert_dialog(self, dialog_dict: dict):
+        def insert(conn):
+            doc = {key: value for key, value in dialog_dict.items() if key not in {"messages", "updated_at"}}
+            conn.execute(
+                "INSERT INTO dialog (id, user_id, updated_at, doc) VALUES (?, ?, ?, ?)",
+                (dialog_dict["_id"], dialog_dict["user_id"], datetime.now().isoformat(), dumps(doc))
+            )
+            conn.executemany(
+                "INSERT INTO dialog_message (dialog_id, seq, message) VALUES (?, ?, ?)",
+                [(dialog_dict["_id"], seq, dumps(message)) for seq, message in enumerate(dialog_dict["messages"])]
+            )
+
+        await self._run(insert)
+
+    async def get_dialog_messages(self, user_id: int, dialog_id: str, last_n: Optional[int] = None) -> Optional[list]:
+        def get(conn):
+            row = conn.execute("SELECT 1 FROM dialog WHERE id = ? AND user_id = ?", (dialog_id, user_id)).fetchone()
+            if row is None:
+                return None
+
+            rows = conn.execute(
+                "SELECT message FROM dialog_message WHERE dialog_id = ? ORDER BY seq DESC LIMIT ?",
+                (dialog_id, last_n if last_n is not None else -1)
+            ).fetchall()
+            return [loads(message) for (message,) in reversed(rows)]
+
+        return await self._run(get)
+
+    async def count_dialog_messages(self, user_id: int, dialog_id: str) -> Optional[int]:
+        def count(conn):
+            row = conn.execute("SELECT 1 FROM dialog WHERE id = ? AND user_id = ?", (dialog_id, user_id)).fetchone()
+            if row is None:
+                return None
+            return conn.execute("SELECT COUNT(*) FROM dialog_message WHERE dialog_id = ?", (dialog_id,)).fetchone()[0]
+
+        return await self._run(count)
+
+    async def set_dialog_messages(self, user_id: int, dialog_id: str, messages: list) -> bool:
+        def set_messages(conn):
+            if not self._touch_dialog(conn, user_id, dialog_id):
+                return False
+
+            conn.execute("DELETE FROM dialog_message WHERE dialog_id = ?", (dialog_id,))
+            conn.executemany(
+                "INSERT INTO dialog_message (dialog_id, seq, message) VALUES (?, ?, ?)",
+                [(dialog_id, seq, dumps(message)) for seq, message in enumerate(messages)]
+            )
+            return True
+
+        return await self._run(set_messages)
+
+    async def push_dialog_message(self, user_id: int, dialog_id: str, message: dict) -> bool:
+        def push(conn):
+            if not self._touch_dialog(conn, user_id, dialog_id):
+                return False
+
+            conn.execute(
+                "INSERT INTO dialog_message (dialog_id, seq, message) "
+                "SELECT ?, COALESCE(MAX(seq), -1) + 1, ? FROM dialog_message WHERE dialog_id = ?",
+                (dialog_id, dumps(message), dialog_id)
+            )
+            return True
+
+        return await self._run(push)
+
+    async def pop_dialog_message(self, user_id: int, dialog_id: str) -> Optional[dict]:
+        def pop(conn):
+            if not self._touch_dialog(conn, user_id, dialog_id):
+                return None
+
+            row = conn.execute(
+                "SELECT seq, message FROM dialog_message WHERE dialog_id = ? ORDER BY seq DESC LIMIT 1",
+                (dialog_id,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            conn.execute("DELETE FROM dialog_message WHERE dialog_id = ? AND seq = ?", (dialog_id, row[0]))
+            return loads(row[1])
+
+        return await self._run(pop)
+
+    async def get_dialog_summary(self, user_id: int, dialog_id: str) -> Optional[dict]:
+        row = await self._run(
+            lambda conn: conn.execute(
+                "SELECT json_extract(doc, '$.summary') FROM dialog WHERE id = ? AND user_id = ?", (dialog_id, user_id)
+            ).fetchone()
+        )
+        if row is None or row[0] is None:
+            return None
+        return loads(row[0])
+
+    async def set_dialog_summary(self, user_id: int, dialog_id: str, summary: dict) -> bool:
+        def set_summary(conn):
+            cursor = conn.execute(
+                "UPDATE dialog SET doc = json_set(doc, '$.summary', json(?)) WHERE id = ? AND user_id = ?",
+                (dumps(summary), dialog_id, user_id)
+            )
+            return cursor.rowcount > 0
+
+        return await self._run(set_summary)
+
+    # payments
+
+    async def insert_payment(self, payment_dict: dict):
+        await self._run(
+            lambda conn: conn.execute(
+                "INSERT INTO payment (id, doc) VALUES (?, ?)", (payment_dict["_id"], dumps(payment_dict))
+            )
+        )
+
+    async def find_payment(self, key: str, value: Any) -> Optional[dict]:
+        def find(conn):
+            if key == "_id":
+                row = conn.execute("SELECT doc FROM payment WHERE id = ?", (value,)).fetchone()
+            else:
+                # the path is inlined so that expression indexes can be used
+                if re.fullmatch(r"\w+(\.\w+)*", key) is None:
+                    raise ValueError(f"Invalid payment key: {key}")
+                row = conn.execute(
+                    f"SELECT doc FROM payment WHERE json_extract(doc, '$.{key}') = ? LIMIT 1", (value,)
+                ).fetchone()
+            return loads(row[0]) if row is not None else None
+
+        return await self._run(find)
+
+    async def update_payment(self, pay_id: str, fields: dict) -> bool:
+        def update(conn):
+            row = conn.execute("SELECT doc FROM payment WHERE id = ?", (pay_id,)).fetchone()
+            if row is None:
+                return False
+
+            payment_dict = loads(row[0])
+            for path, value in fields.items():
+                set_path(payment_dict, path, value)
+            conn.execute("UPDATE payment SET doc = ? WHERE id = ?", (dumps(payment_dict), pay_id))
+            return True
+
+        return await self._run(update)
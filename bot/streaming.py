@@ -0,0 +1,350 @@
+"""
+Delivery of streamed answers to Telegram.
+
+An answer is shown by editing a message over and over. `AnswerEditor`
+sends those edits from a background task so that reading the model stream
+never waits on Telegram, and always sends only the newest text. Once the
+answer outgrows a message, the message is completed at a paragraph or code
+block boundary and the answer goes on in a new one, so that an edit never
+carries more than one message worth of text. Edits of a
+chat are paced by its `ChatPacer`: at most one per interval, and only once
+`telegram_edit_min_chars` new characters arrived (or `telegram_edit_max_wait`
+passed). The interval follows Telegram's latency for the chat and backs off
+on 429s. The final edit skips the interval and goes out right away, unless
+Telegram told us to wait. Edits before it yield to replies in the egress
+queue, and may be dropped there (see `egress`). Every message is rendered into HTML that parses
+even halfway through the answer (see `rendering`); if Telegram still rejects
+it, the raw text is sent as plain text instead.
+"""
+import asyncio
+import functools
+import logging
+import time
+from typing import Awaitable, Callable, Optional
+
+import telegram
+from telegram.constants import ParseMode
+
+import config
+import egress
+import latency
+import rendering
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_LIMIT = 4096
+CODE_FENCE = "```"
+RENDERERS = {ParseMode.HTML: rendering.HTMLRenderer, ParseMode.MARKDOWN: rendering.MarkdownRenderer}
+# shown instead of an empty answer, which Telegram wouldn't take as a message text
+EMPTY_ANSWER_TEXT = "🤷 The model returned an empty answer. Try to rephrase the question or /retry."
+
+
+class ChatPacer:
+    # the interval is kept above this many edit round trips
+    LATENCY_FACTOR = 2
+    # weight of the latest edit in the smoothed edit latency
+    LATENCY_ALPHA = 0.2
+    # a 429 doubles the interval, every successful edit takes back this share of it
+    BACKOFF_RECOVERY = 0.1
+
+    def __init__(self, base_interval: float):
+        self.base_interval = base_interval
+
+        self.last_edit_at = 0.0
+        self.blocked_until = 0.0
+        self.avg_latency = None
+        self.backoff = 1.0
+
+    @property
+    def interval(self) -> float:
+        interval = self.base_interval
+        if self.avg_latency is not None:
+            interval = max(interval, self.LATENCY_FACTOR * self.avg_latency)
+        return min(interval * self.backoff, config.telegram_edit_max_interval)
+
+    def record_edit(self, started_at: float):
+        now = time.monotonic()
+        edit_latency = now - started_at
+        if self.avg_latency is None:
+            self.avg_latency = edit_latency
+        else:
+            self.avg_latency += self.LATENCY_ALPHA * (edit_latency - self.avg_latency)
+
+        self.backoff = max(self.backoff * (1 - self.BACKOFF_RECOVERY), 1.0)
+        self.last_edit_at = now
+
+    def record_rate_limit(self, retry_after: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+        self.backoff = min(self.backoff * 2, config.telegram_edit_max_interval / self.base_interval)
+
+
+_pacers = TTLCache(maxsize=10000, ttl=600)
+
+
+def get_pacer(chat_id: int, is_group: bool) -> ChatPacer:
+    pacer = _pacers.get(chat_id)
+    if pacer is None:
+        pacer = ChatPacer(config.telegram_group_edit_interval if is_group else config.telegram_edit_interval)
+    # refreshed on every answer, so that an active chat keeps what it learned
+    _pacers.set(chat_id, pacer)
+    return pacer
+
+
+class EditStats:
+    def __init__(self):
+        self.n_answers = 0
+        self.n_edits = 0
+        self.n_rate_limited = 0
+        # edits Telegram couldn't parse, sent again as plain text
+        self.n_fallbacks = 0
+        # from the final token to the final edit
+        self.final_edit_latencies = latency.LatencyWindow(latency.WINDOW_SIZE)
+
+    def stats(self) -> dict:
+        return {
+            "answers": self.n_answers,
+            "edits": self.n_edits,
+            "edits_per_answer": self.n_edits / self.n_answers if self.n_answers > 0 else 0.0,
+            "rate_limited": self.n_rate_limited,
+            "fallbacks": self.n_fallbacks,
+            "fallback_rate": self.n_fallbacks / self.n_edits if self.n_edits > 0 else 0.0,
+            "final_edit_latency_p50": self.final_edit_latencies.percentile(50),
+            "final_edit_latency_p95": self.final_edit_latencies.percentile(95),
+        }
+
+
+edit_stats = EditStats()
+
+
+def split_message(text: str, limit: int = MESSAGE_LIMIT) -> tuple:
+    """
+    Splits the first message off a `text` longer than `limit`. Prefers to
+    end it at a paragraph break or next to a code block, then at a line
+    break (closing the code block and reopening it in the next message),
+    then at a space. Returns the first message, the text the rest has to
+    start with to reopen a code block ("" if none), and how many characters
+    of `text` the first message covers.
+    """
+    window = text[:limit - len(CODE_FENCE)]
+    min_split = len(window) // 2  # don't leave a message mostly empty
+
+    paragraph_split, line_split, open_fence = None, None, None
+    lines = window.split("\n")[:-1]  # the last one may be cut off
+    offset = 0
+    for i, line in enumerate(lines):
+        offset += len(line) + 1
+        is_fence = line.startswith(CODE_FENCE)
+        if is_fence:
+            open_fence = line if open_fence is None else None
+        if offset < min_split:
+            continue
+
+        opens_code_block = i + 1 < len(lines) and lines[i + 1].startswith(CODE_FENCE)
+        if open_fence is None and (line.strip() == "" or is_fence or opens_code_block):
+            paragraph_split = offset
+        line_split = (offset, open_fence)
+
+    if paragraph_split is not None:
+        return text[:paragraph_split], "", paragraph_split
+    if line_split is not None:
+        split, open_fence = line_split
+    else:
+        split = window.rfind(" ") + 1
+        if split < min_split:
+            split = len(window)
+
+    if open_fence is not None:
+        return text[:split].rstrip("\n") + "\n" + CODE_FENCE, open_fence + "\n", split
+    return text[:split], "", split
+
+
+class AnswerEditor:
+    """
+    Async context manager that shows a streamed answer in `first_message`,
+    rolling over to new messages as it outgrows Telegram's limit. Call
+    `update(text)` with the answer so far; the last text is delivered when
+    the block exits normally, and pending edits are dropped otherwise.
+    `on_shown()` is called after every delivered edit.
+    """
+
+    def __init__(
+        self,
+        bot: telegram.Bot,
+        chat_id: int,
+        first_message: Awaitable[telegram.Message],
+        parse_mode: Optional[str] = None,
+        is_group: bool = False,
+        on_shown: Optional[Callable[[], None]] = None,
+    ):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.first_message = first_message
+        self.renderer_class = RENDERERS.get(parse_mode)
+        self.renderer = self.renderer_class() if self.renderer_class is not None else None
+        self.pacer = get_pacer(chat_id, is_group)
+        self.on_shown = on_shown
+
+        self.text = ""
+        self.shown_text = ""
+        self.is_final = False
+        self.n_edits = 0
+
+        # messages sent so far; only the last one is still edited
+        self.messages = []
+        # where the last message starts in `text`, what it is prefixed with, and its HTML as shown
+        self.offset = 0
+        self.prefix = ""
+        self.shown_html = ""
+        # the last message is complete, the rest of the text goes into a new one
+        self._is_message_full = False
+
+        self._changed = asyncio.Event()
+        self._task = None
+
+    async def __aenter__(self) -> "AnswerEditor":
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.finish()
+            return
+
+        self._task.cancel()
+        try:
+            await self._task
+        except BaseException:
+            pass
+
+    def update(self, text: str):
+        if self._task.done():
+            self._task.result()  # raises what the last edit failed with
+
+        self.text = text
+        self._changed.set()
+
+    async def finish(self):
+        if self._task.done():
+            await self._task  # raises what the last edit failed with
+            return
+
+        final_token_at = time.monotonic()
+        if len(self.text.strip()) == 0:
+            # the placeholder must not stay up
+            self.text = EMPTY_ANSWER_TEXT
+        self.is_final = True
+        self._changed.set()
+        await self._task
+
+        edit_stats.n_answers += 1
+        edit_stats.n_edits += self.n_edits
+        edit_stats.final_edit_latencies.observe(time.monotonic() - final_token_at)
+
+    def _get_delay(self) -> float:
+        now = time.monotonic()
+        delay = self.pacer.blocked_until - now
+        if not self.is_final:
+            interval = self.pacer.interval
+            if len(self.text) - len(self.shown_text) < config.telegram_edit_min_chars:
+                interval = max(interval, config.telegram_edit_max_wait)
+            delay = max(delay, self.pacer.last_edit_at + interval - now)
+        return max(delay, 0.0)
+
+    async def _call(self, method, text: str, html: str, **kwargs) -> Optional[telegram.Message]:
+        """Sends `html`, or `text` as plain text if Telegram can't parse it."""
+        if self.renderer is None:
+            return await method(text, **kwargs)
+
+        try:
+            return await method(html, parse_mode=ParseMode.HTML, **kwargs)
+        except telegram.error.BadRequest as e:
+            if str(e).startswith("Message is not modified"):
+                return None
+            edit_stats.n_fallbacks += 1
+            logger.warning(f"Telegram couldn't parse a rendered answer, sending it as plain text: {e}")
+            return await method(text, **kwargs)
+
+    async def _show(self, text: str, is_final: bool):
+        """Edits the last message, sending new ones for whatever doesn't fit into it."""
+        if len(self.messages) == 0:
+            self.messages.append(await self.first_message)
+
+        while True:
+            tail = self.prefix + text[self.offset:]
+            next_prefix = None
+            if len(tail) > MESSAGE_LIMIT:
+                tail, next_prefix, n_tail_chars = split_message(tail)
+
+            html = tail
+            if self.renderer is not None:
+                html = self.renderer.render(tail, is_final=is_final or next_prefix is not None)
+
+            if self._is_message_full:
+                self.messages.append(
+                    await self._call(functools.partial(self.bot.send_message, self.chat_id), tail, html)
+                )
+                self._is_message_full = False
+                self.n_edits += 1
+            elif html != self.shown_html and len(html.strip()) > 0:
+                # only the last text of a message has to get through
+                is_intermediate = not is_final and next_prefix is None
+                await self._call(
+                    self.bot.edit_message_text,
+                    tail,
+                    html,
+                    chat_id=self.chat_id,
+                    message_id=self.messages[-1].message_id,
+                    rate_limit_args=egress.Priority.EDIT if is_intermediate else egress.Priority.REPLY,
+                )
+                self.n_edits += 1
+            self.shown_html = html
+
+            if next_prefix is None:
+                return
+
+            # the last message keeps `tail` for good
+            self.offset += n_tail_chars - len(self.prefix)
+            self.prefix = next_prefix
+            self.shown_html = ""
+            if self.renderer_class is not None:
+                self.renderer = self.renderer_class()
+            self._is_message_full = True
+
+    async def _send(self):
+        text, is_final = self.text, self.is_final
+        started_at = time.monotonic()
+        try:
+            await self._show(text, is_final)
+        except egress.EditDropped:
+            # Telegram's budget is taken by replies; the newest text is sent next time instead
+            return
+        except telegram.error.RetryAfter as e:
+            # intermediate edits aren't retried; the newest text is sent once we may
+            edit_stats.n_rate_limited += 1
+            self.pacer.record_rate_limit(e.retry_after)
+            logger.warning(f"Edits are rate limited, waiting {e.retry_after}s")
+            return
+
+        self.pacer.record_edit(started_at)
+        self.shown_text = text
+        if self.on_shown is not None:
+            self.on_shown()
+
+    async def _run(self):
+        while True:
+            self._changed.clear()
+
+            timeout = None
+            if self.text != self.shown_text:
+                timeout = self._get_delay()
+                if timeout == 0:
+                    await self._send()
+                    continue
+            elif self.is_final:
+                return
+
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,226 @@
+"""
+Background compaction of long dialogs.
+
+After every answer the part of the dialog that isn't summarized yet is
+measured. Once it passes `dialog_summary_threshold_tokens`, its oldest turns
+(all but the last `dialog_summary_keep_messages`) are folded into the
+dialog's summary by the cheap `dialog_summary_model`. The summary is stored
+on the dialog document and sent in place of the turns it covers. Turns older
+than the last `max_context_dialog_messages`, which requests are sent
+without, are read back from the database to be summarized too.
+
+The summary dict:
+    text: the summary itself
+    until: date of the last turn it covers
+    n_messages: how many turns it covers
+    n_tokens, n_replaced_tokens: its size, and the size of the turns it covers
+    n_requests, n_saved_tokens: requests sent with it, and the input tokens it saved them
+    n_spent_tokens: tokens spent writing it (and the summaries it replaced)
+"""
+import asyncio
+import logging
+from datetime import datetime
+from typing import Optional
+
+import config
+import openai_utils
+
+logger = logging.getLogger(__name__)
+
+
+class SummaryStats:
+    def __init__(self):
+        self.n_summaries = 0
+        self.n_failures = 0
+        self.n_spent_tokens = 0
+        self.n_requests = 0
+        self.n_saved_tokens = 0
+
+    def stats(self) -> dict:
+        return {
+            "summaries": self.n_summaries,
+            "failures": self.n_failures,
+            "spent_tokens": self.n_spent_tokens,
+            "requests": self.n_requests,
+            "saved_tokens": self.n_saved_tokens,
+        }
+
+
+summary_stats = SummaryStats()
+
+
+def get_unsummarized_messages(dialog_messages: list, dialog_summary: Optional[dict]) -> list:
+    if dialog_summary is None:
+        return dialog_messages
+    return [
+        dialog_message for dialog_message in dialog_messages
+        if dialog_message.get("date") is None or dialog_message["date"] > dialog_summary["until"]
+    ]
+
+
+class _Job:
+    def __init__(self, user_id: int, dialog_id: str):
+        self.user_id = user_id
+        self.dialog_id = dialog_id
+        self.dialog_messages = []
+        # whether there are unsummarized turns older than dialog_messages
+        self.is_truncated = False
+        # requests sent with a summary since the last job
+        self.n_requests = 0
+        self.n_saved_tokens = 0
+
+
+class DialogSummarizer:
+    def __init__(self, db):
+        self.db = db
+
+        # jobs of one dialog are merged until the worker gets to it
+        self._jobs = {}
+        self._queue = None
+        self._task = None
+
+    async def load_dialog(self, user_id: int, dialog_id: str, last_n: Optional[int] = None) -> tuple:
+        """
+        Returns the dialog's summary, the messages it doesn't cover (of the last
+        `last_n`) and the number of older messages it doesn't cover either.
+        """
+        get_dialog_messages = self.db.get_dialog_messages(user_id, dialog_id=dialog_id, last_n=last_n)
+        if not config.dialog_summary_enabled:
+            dialog_summary, dialog_messages = None, await get_dialog_messages
+        else:
+            dialog_summary, dialog_messages = await asyncio.gather(
+                self.db.get_dialog_summary(user_id, dialog_id=dialog_id), get_dialog_messages
+            )
+
+        n_dropped_messages = 0
+        if last_n is not None and len(dialog_messages) == last_n:
+            # there may be more messages before the loaded ones
+            n_messages = await self.db.count_dialog_messages(user_id, dialog_id=dialog_id) or 0
+            n_summarized_messages = dialog_summary["n_messages"] if dialog_summary is not None else 0
+            n_dropped_messages = max(n_messages - n_summarized_messages - last_n, 0)
+
+        return dialog_summary, get_unsummarized_messages(dialog_messages, dialog_summary), n_dropped_messages
+
+    def submit(
+        self,
+        user_id: int,
+        dialog_id: str,
+        dialog_summary: Optional[dict],
+        dialog_messages: list,
+        n_dropped_messages: int = 0,
+    ):
+        """
+        Called after an answer with the summary the request was sent with, the
+        messages after it, including the new one, and the number of messages
+        between the two that the request was sent without.
+        """
+        if not config.dialog_summary_enabled or self._queue is None:
+            return
+
+        job = self._jobs.get(dialog_id)
+        if job is None:
+            job = self._jobs[dialog_id] = _Job(user_id, dialog_id)
+            self._queue.put_nowait(dialog_id)
+
+        job.dialog_messages = dialog_messages
+        job.is_truncated = n_dropped_messages > 0
+        if dialog_summary is not None:
+            n_saved_tokens = dialog_summary["n_replaced_tokens"] - dialog_summary["n_tokens"]
+            job.n_requests += 1
+            job.n_saved_tokens += n_saved_tokens
+            summary_stats.n_requests += 1
+            summary_stats.n_saved_tokens += n_saved_tokens
+
+    def _take_oldest(self, chatgpt_instance: openai_utils.ChatGPT, dialog_messages: list) -> tuple:
+        """Returns the oldest messages to summarize and their size in tokens, or ([], 0) if it's not time yet."""
+        n_tokens = [chatgpt_instance.count_dialog_message_tokens(dialog_message) for dialog_message in dialog_messages]
+        if sum(n_tokens) <= config.dialog_summary_threshold_tokens:
+            return [], 0
+
+        n_oldest_messages, n_oldest_tokens = 0, 0
+        for n_message_tokens in n_tokens[:len(n_tokens) - config.dialog_summary_keep_messages]:
+            # a long backlog is summarized over several answers
+            if n_oldest_messages > 0 and n_oldest_tokens + n_message_tokens > config.dialog_summary_batch_tokens:
+                break
+            n_oldest_messages += 1
+            n_oldest_tokens += n_message_tokens
+
+        return dialog_messages[:n_oldest_messages], n_oldest_tokens
+
+    async def _process(self, job: _Job):
+        # the job's messages may predate a summary written since
+        dialog_summary = await self.db.get_dialog_summary(job.user_id, dialog_id=job.dialog_id)
+        if job.is_truncated:
+            job.dialog_messages = await self.db.get_dialog_messages(job.user_id, dialog_id=job.dialog_id)
+        dialog_messages = get_unsummarized_messages(job.dialog_messages, dialog_summary)
+        is_changed = False
+
+        if dialog_summary is not None and job.n_requests > 0:
+            dialog_summary["n_requests"] += job.n_requests
+            dialog_summary["n_saved_tokens"] += job.n_saved_tokens
+            is_changed = True
+
+        chatgpt_instance = openai_utils.ChatGPT(model=config.dialog_summary_model)
+        oldest_messages, n_oldest_tokens = self._take_oldest(chatgpt_instance, dialog_messages)
+        if len(oldest_messages) > 0:
+            previous_summary = dialog_summary or {
+                "text": None,
+                "n_messages": 0,
+                "n_replaced_tokens": 0,
+                "n_requests": 0,
+                "n_saved_tokens": 0,
+                "n_spent_tokens": 0,
+            }
+            text, (n_input_tokens, n_output_tokens) = await chatgpt_instance.summarize_dialog(
+                oldest_messages, previous_summary=previous_summary["text"]
+            )
+
+            dialog_summary = {
+                **previous_summary,
+                "text": text,
+                "until": oldest_messages[-1]["date"],
+                "n_messages": previous_summary["n_messages"] + len(oldest_messages),
+                "n_tokens": openai_utils.count_tokens(text, config.dialog_summary_model),
+                "n_replaced_tokens": previous_summary["n_replaced_tokens"] + n_oldest_tokens,
+                "n_spent_tokens": previous_summary["n_spent_tokens"] + n_input_tokens + n_output_tokens,
+                "updated_at": datetime.now(),
+            }
+            is_changed = True
+
+            summary_stats.n_summaries += 1
+            summary_stats.n_spent_tokens += n_input_tokens + n_output_tokens
+            logger.info(
+                f"Dialog {job.dialog_id}: {dialog_summary['n_messages']} messages "
+                f"({dialog_summary['n_replaced_tokens']} tokens) summarized in {dialog_summary['n_tokens']} tokens"
+            )
+
+        if is_changed:
+            await self.db.set_dialog_summary(job.user_id, dialog_summary, dialog_id=job.dialog_id)
+
+    async def _run(self):
+        while True:
+            dialog_id = await self._queue.get()
+            job = self._jobs.pop(dialog_id)
+            try:
+                await self._process(job)
+            except Exception:
+                summary_stats.n_failures += 1
+                logger.exception(f"Summarizing dialog {dialog_id} failed")
+
+    def start(self):
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._queue = None
+            self._jobs.clear()
+
+            logger.info(f"Dialog summaries: {summary_stats.stats()}")
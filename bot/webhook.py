@@ -0,0 +1,228 @@
+"""
+Webhook ingestion of updates.
+
+With `telegram_webhook_url` set, Telegram POSTs updates to the bot instead
+of the bot long polling for them. A starlette app served by uvicorn checks
+Telegram's secret token header, hands the update to the application's
+update queue and answers right away, so that Telegram can go on with the
+next one. The webhook only asks for the update types the bot handles.
+
+With `telegram_webhook_workers` above 1, the updates are processed by that
+many forked worker processes. Each builds its own application, and with it
+its database connection, after the fork: neither motor's client nor an
+event loop survives one. The main process serves the webhook and routes
+every update by its chat, so that a chat always lands on the same worker:
+the in-process per-user state (the task /cancel stops, the "previous
+message not answered yet" guard) and the per-chat egress budgets stay
+whole. Limitation: a user who talks to the bot in several chats, e.g. a
+private chat and a group, may be served by several workers, which then
+don't see each other's in-flight requests. Otherwise the workers share
+state the way several bot instances do: cached users are invalidated
+through the storage backend (see `invalidation`), and the global egress
+budget is split between them.
+"""
+import asyncio
+import contextlib
+import hashlib
+import hmac
+import logging
+import multiprocessing
+import signal
+from typing import Awaitable, Callable, List, Optional
+from urllib.parse import urlsplit
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Route
+from telegram import Bot, Update
+from telegram.ext import Application
+from telegram.request import HTTPXRequest
+
+import config
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def get_secret_token() -> str:
+    """`telegram_webhook_secret`, or a secret derived from the bot token, so that every process agrees on it."""
+    if config.telegram_webhook_secret is not None:
+        return config.telegram_webhook_secret
+    return hashlib.sha256(f"webhook:{config.telegram_token}".encode()).hexdigest()
+
+
+class WebhookStats:
+    def __init__(self):
+        self.n_updates = 0
+        # wrong secret token or not an update
+        self.n_rejected = 0
+        # update types the bot doesn't handle
+        self.n_ignored = 0
+
+    def stats(self) -> dict:
+        return {
+            "updates": self.n_updates,
+            "rejected": self.n_rejected,
+            "ignored": self.n_ignored,
+        }
+
+
+webhook_stats = WebhookStats()
+
+
+def get_chat_id(update_dict: dict) -> int:
+    """The chat an update belongs to, or its sender if it has none."""
+    for value in update_dict.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat is not None:
+            return chat["id"]
+        if "from" in value:
+            return value["from"]["id"]
+    return 0
+
+
+@contextlib.asynccontextmanager
+async def running(application: Application):
+    """What run_polling does around polling."""
+    await application.initialize()
+    if application.post_init is not None:
+        await application.post_init(application)
+    await application.start()
+    try:
+        yield
+    finally:
+        await application.stop()
+        await application.shutdown()
+        if application.post_shutdown is not None:
+            await application.post_shutdown(application)
+
+
+def create_app(
+    dispatch: Callable[[dict], Awaitable],
+    allowed_updates: List[str],
+    lifespan: Optional[Callable[[Starlette], contextlib.AbstractAsyncContextManager]] = None,
+) -> Starlette:
+    """Serves the webhook, passing every accepted update to `dispatch(update_dict)`."""
+    secret_token = get_secret_token()
+
+    async def handle_update(request: Request) -> Response:
+        if not hmac.compare_digest(request.headers.get(SECRET_TOKEN_HEADER, ""), secret_token):
+            webhook_stats.n_rejected += 1
+            return Response(status_code=403)
+
+        try:
+            update_dict = await request.json()
+        except ValueError:
+            update_dict = None
+        if not isinstance(update_dict, dict):
+            webhook_stats.n_rejected += 1
+            return Response(status_code=400)
+
+        if not any(update_type in update_dict for update_type in allowed_updates):
+            webhook_stats.n_ignored += 1
+            return Response()
+
+        webhook_stats.n_updates += 1
+        await dispatch(update_dict)
+        return Response()
+
+    path = urlsplit(config.telegram_webhook_url).path or "/"
+    return Starlette(routes=[Route(path, handle_update, methods=["POST"])], lifespan=lifespan)
+
+
+async def set_webhook(allowed_updates: List[str]):
+    request = HTTPXRequest(http_version="1.1")
+    async with Bot(config.telegram_token, base_url=config.telegram_api_base_url, request=request) as bot:
+        await bot.set_webhook(
+            config.telegram_webhook_url, allowed_updates=allowed_updates, secret_token=get_secret_token()
+        )
+
+
+def _serve(app: Starlette, loop: asyncio.AbstractEventLoop):
+    server = uvicorn.Server(uvicorn.Config(
+        app, host=config.telegram_webhook_host, port=config.telegram_webhook_port, lifespan="on", access_log=False
+    ))
+    loop.run_until_complete(server.serve())
+    loop.close()
+    logger.info(f"Webhook: {webhook_stats.stats()}")
+
+
+def _serve_application(build_application: Callable[[], Application], allowed_updates: List[str]):
+    # PTB binds its queues to the current event loop when the application is
+    # built (on Python 3.8), so the loop comes first
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    application = build_application()
+
+    async def dispatch(update_dict: dict):
+        await application.update_queue.put(Update.de_json(update_dict, application.bot))
+
+    _serve(create_app(dispatch, allowed_updates, lifespan=lambda app: running(application)), loop)
+
+
+async def _process_updates(application: Application, update_queue: multiprocessing.Queue):
+    async with running(application):
+        loop = asyncio.get_running_loop()
+        while True:
+            update_dict = await loop.run_in_executor(None, update_queue.get)
+            if update_dict is None:
+                return
+            await application.update_queue.put(Update.de_json(update_dict, application.bot))
+
+
+def _work(build_application: Callable[[], Application], update_queue: multiprocessing.Queue):
+    # the main process stops the workers once it stopped taking updates
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(_process_updates(build_application(), update_queue))
+    loop.close()
+
+
+def run_webhook(build_application: Callable[[], Application], allowed_updates: List[str]):
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(set_webhook(allowed_updates))
+    loop.close()
+
+    n_workers = config.telegram_webhook_workers
+    logger.info(
+        f"Serving {config.telegram_webhook_url} on {config.telegram_webhook_host}:{config.telegram_webhook_port} "
+        f"with {n_workers} worker(s)"
+    )
+    if n_workers <= 1:
+        _serve_application(build_application, allowed_updates)
+        return
+
+    # forked rather than spawned, so that workers don't import the bot again;
+    # nothing that holds connections or a loop exists yet
+    context = multiprocessing.get_context("fork")
+    update_queues = [context.Queue() for _ in range(n_workers)]
+    workers = [
+        context.Process(target=_work, args=(build_application, update_queue))
+        for update_queue in update_queues
+    ]
+    for worker in workers:
+        worker.start()
+
+    async def dispatch(update_dict: dict):
+        update_queues[get_chat_id(update_dict) % n_workers].put(update_dict)
+
+    # uvicorn re-raises the signal it stopped on, which must not kill this
+    # process before it stopped the workers
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        _serve(create_app(dispatch, allowed_updates), asyncio.new_event_loop())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for update_queue in update_queues:
+            update_queue.put(None)
+        for worker in workers:
+            worker.join()
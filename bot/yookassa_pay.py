@@ -31,7 +31,7 @@ response = Webhook.add({
 
 logger = logging.getLogger(__name__)
 
-def payment(db, user_id: int, price: int, description: str):
+async def payment(db, user_id: int, price: int, description: str):
     """
         Cоздание платежа с помощью Yookassa.
 
@@ -75,7 +75,7 @@ def payment(db, user_id: int, price: int, description: str):
 
         payment_data = json.loads(p.json())
 
-        db.add_new_payment(
+        await db.add_new_payment(
             user_id=user_id,
             amount=float(payment_data["amount"]["value"]),
             currency=payment_data["amount"]["currency"],
@@ -121,17 +121,17 @@ async def check_payment(db,  payment_id: str):
                 await asyncio.sleep(wait_time)
                 n += 1
 
-            pay_doc = db.payment_collection.find_one({"payment_id": payment_id})
+            pay_doc = await db.get_payment_by_external_id(payment_id)
             if pay_doc:
                 if payment['status'] == 'succeeded':
-                    db.update_payment_status(pay_doc["_id"], "paid")
+                    await db.update_payment_status(pay_doc["_id"], "paid")
                     logger.info(f'Покупка успешна: {payment["description"]}')
                     return {
                         "success": True,
                         "message": "Оплата прошла успешно"
                     }
                 else:
-                    db.update_payment_status(pay_doc["_id"], payment['status'])
+                    await db.update_payment_status(pay_doc["_id"], payment['status'])
                     return {
                         "success": False,
                         "message": 'Срок действия ссылки истек или произошла другая ошибка.'
@@ -148,7 +148,7 @@ async def check_payment(db,  payment_id: str):
 
 
 
-def yookassa_webhook_handler(request, db):
+async def yookassa_webhook_handler(request, db):
     """
         Обработчик вебхуков от YooKassa.
 
@@ -190,18 +190,18 @@ def yookassa_webhook_handler(request, db):
             logger.warning(f"Неизвестный тип события вебхука: {notification_object.event}")
             return HttpResponse(status=400)
 
-        pay_doc = db.payment_collection.find_one({"payment_id": payment_id})
+        pay_doc = await db.get_payment_by_external_id(payment_id)
         if not pay_doc:
             logger.error(f"Платеж с ID {payment_id} не найден в базе данных.")
             return HttpResponse(status=400)
 
         # Обновляем статус платежа в базе данных
-        db.update_payment_status(pay_doc["_id"], new_status)
+        await db.update_payment_status(pay_doc["_id"], new_status)
         logger.info(f"Статус платежа {payment_id} обновлен на {new_status}.")
         # Активируем подписку пользователю на основании telegram_id
         telegram_id = pay_doc.get("telegram_id")
         if telegram_id:
-            db.update_user_subscription(telegram_id, duration_days=30)
+            await db.update_user_subscription(telegram_id, duration_days=30)
             logger.info(f"Подписка для пользователя с telegram_id={telegram_id} активирована на 30 дней.")
         else:
             logger.warning(f"Для платежа {payment_id} не указан telegram_id, невозможно активировать подписку.")
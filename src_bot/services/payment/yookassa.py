@@ -83,7 +83,7 @@ async def process_payment(client_id: int, payment: Payment):
         raise
 
 
-def yookassa_webhook_handler(request, db):
+async def yookassa_webhook_handler(request, db):
     """
         Обработчик вебхуков от YooKassa.
 
@@ -125,18 +125,18 @@ def yookassa_webhook_handler(request, db):
             logger.warning(f"Неизвестный тип события вебхука: {notification_object.event}")
             return Response(status_code=400)
 
-        pay_doc = db.payment_collection.find_one({"payment_id": payment_id})
+        pay_doc = await db.get_payment_by_external_id(payment_id)
         if not pay_doc:
             logger.error(f"Платеж с ID {payment_id} не найден в базе данных.")
             return Response(status_code=400)
 
         # Обновляем статус платежа в базе данных
-        db.update_payment_status(pay_doc["_id"], new_status)
+        await db.update_payment_status(pay_doc["_id"], new_status)
         logger.info(f"Статус платежа {payment_id} обновлен на {new_status}.")
         # Активируем подписку пользователю на основании telegram_id
         telegram_id = pay_doc.get("telegram_id")
         if telegram_id:
-            db.update_user_subscription(telegram_id, duration_days=30)
+            await db.update_user_subscription(telegram_id, duration_days=30)
             logger.info(f"Подписка для пользователя с telegram_id={telegram_id} активирована на 30 дней.")
         else:
             logger.warning(f"Для платежа {payment_id} не указан telegram_id, невозможно активировать подписку.")
@@ -0,0 +1,27 @@
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).parent.parent.resolve()
+
+# the bot's modules import each other as top-level modules
+sys.path.insert(0, str(ROOT_DIR / 'bot'))
+
+# config.yml and config.env aren't committed, so the tests run on the
+# example config (config.py reads it on import)
+_config_dir = Path(tempfile.mkdtemp(prefix='bot-test-config-'))
+shutil.copy(
+    ROOT_DIR / 'config' / 'config.example.yml', _config_dir / 'config.yml'
+)
+shutil.copy(
+    ROOT_DIR / 'config' / 'config.example.env', _config_dir / 'config.env'
+)
+for name in ('chat_modes.yml', 'models.yml'):
+    shutil.copy(ROOT_DIR / 'config' / name, _config_dir / name)
+os.environ['BOT_CONFIG_DIR'] = str(_config_dir)
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(_config_dir, ignore_errors=True)
@@ -0,0 +1,52 @@
+from cache import TTLCache
+
+
+def test_load_is_stored():
+    cache = TTLCache()
+
+    generation = cache.begin_load('key')
+    assert cache.end_load('key', generation, 'value')
+    assert cache.get('key') == 'value'
+
+
+def test_load_of_changed_key_is_dropped():
+    for change in (
+        lambda cache: cache.set('key', 'newer'),
+        lambda cache: cache.pop('key'),
+        lambda cache: cache.clear(),
+        lambda cache: cache.mark_stale('key'),
+    ):
+        cache = TTLCache()
+        generation = cache.begin_load('key')
+        change(cache)
+
+        assert not cache.end_load('key', generation, 'stale')
+        assert cache.get('key') != 'stale'
+
+
+def test_loads_of_other_keys_are_unaffected():
+    cache = TTLCache()
+    generation = cache.begin_load('key')
+    cache.pop('other')
+
+    assert cache.end_load('key', generation, 'value')
+
+
+def test_concurrent_loads():
+    cache = TTLCache()
+    first = cache.begin_load('key')
+    second = cache.begin_load('key')
+
+    assert cache.end_load('key', first, 'first')
+    # the first load stored a value meanwhile
+    assert not cache.end_load('key', second, 'second')
+    assert cache.get('key') == 'first'
+    assert cache._loads == {}
+
+
+def test_missing_value_isnt_stored():
+    cache = TTLCache()
+    generation = cache.begin_load('key')
+
+    assert not cache.end_load('key', generation, None)
+    assert 'key' not in cache
@@ -0,0 +1,193 @@
+import asyncio
+from datetime import datetime
+
+from database import Database
+from storage.memory import MemoryStorage
+from storage.sqlite import SQLiteStorage
+
+
+class FlakyStorage(MemoryStorage):
+    def __init__(self, n_failures: int):
+        super().__init__()
+        self.n_failures = n_failures
+
+    async def increment_users(self, increments: dict):
+        if self.n_failures > 0:
+            self.n_failures -= 1
+            raise ConnectionError('storage is down')
+        await super().increment_users(increments)
+
+
+def test_increments_are_written_through_without_flusher():
+    async def run():
+        storage = MemoryStorage()
+        db = Database(storage)
+        await db.register_user(1, 1)
+
+        await db.inc_user_attribute(1, 'n_generated_images', 2)
+        assert len(db._write_through_tasks) == 1
+        await asyncio.gather(*db._write_through_tasks)
+
+        assert len(db._write_through_tasks) == 0
+        assert (await storage.get_user(1))['n_generated_images'] == 2
+
+    asyncio.run(run())
+
+
+def test_failed_write_through_is_retried_on_close():
+    async def run():
+        storage = FlakyStorage(n_failures=1)
+        db = Database(storage)
+        await db.register_user(1, 1)
+
+        await db.inc_user_attribute(1, 'n_generated_images', 2)
+        # the write-through fails, then its done callback runs
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        assert len(db._write_through_tasks) == 0
+
+        await db.close()
+        assert (await storage.get_user(1))['n_generated_images'] == 2
+
+    asyncio.run(run())
+
+
+def test_close_waits_for_write_through():
+    async def run():
+        storage = MemoryStorage()
+        db = Database(storage)
+        await db.register_user(1, 1)
+
+        await db.update_n_used_tokens(1, 'gpt-3.5-turbo', 10, 20)
+        await db.close()
+
+        n_used_tokens = (await storage.get_user(1))['n_used_tokens']
+        assert n_used_tokens == {
+            'gpt-3_5-turbo': {'n_input_tokens': 10, 'n_output_tokens': 20}
+        }
+
+    asyncio.run(run())
+
+
+def test_subscription_sets_premium_till():
+    async def run():
+        storage = MemoryStorage()
+        db = Database(storage)
+        await db.register_user(1, 1)
+
+        await db.update_user_subscription(1, duration_days=30)
+
+        for user_dict in (await storage.get_user(1), await db._get_user(1)):
+            assert user_dict['is_premium']
+            assert user_dict['premium_till'] > datetime.now()
+            assert 'premiumn_till' not in user_dict
+
+    asyncio.run(run())
+
+
+def test_sqlite_start_renames_misspelled_premium_till(tmp_path):
+    async def run():
+        premium_till = datetime(2030, 1, 1)
+        storage = SQLiteStorage(str(tmp_path / 'bot.sqlite3'))
+        await storage.insert_user(
+            {'_id': 1, 'premium_till': None, 'premiumn_till': premium_till}
+        )
+        await storage.insert_user({'_id': 2, 'premium_till': None})
+
+        await storage.start()
+
+        assert await storage.get_user(1) == {
+            '_id': 1, 'premium_till': premium_till
+        }
+        assert await storage.get_user(2) == {'_id': 2, 'premium_till': None}
+        await storage.close()
+
+    asyncio.run(run())
+
+
+class BlockingStorage(MemoryStorage):
+    """Holds get_user until `release` is set, after reading the document."""
+
+    def __init__(self):
+        super().__init__()
+        self.reading = asyncio.Event()
+        self.release = asyncio.Event()
+
+    async def get_user(self, user_id: int):
+        user_dict = await super().get_user(user_id)
+        self.reading.set()
+        await self.release.wait()
+        return user_dict
+
+
+def test_read_overlapping_an_update_isnt_cached():
+    async def run():
+        storage = BlockingStorage()
+        await storage.insert_user({'_id': 1, 'current_model': 'old'})
+        db = Database(storage)
+
+        read = asyncio.create_task(db.get_user_attribute(1, 'current_model'))
+        await storage.reading.wait()
+        await db.set_user_attribute(1, 'current_model', 'new')
+        storage.release.set()
+
+        assert await read == 'old'
+        assert 1 not in db.user_cache
+        assert await db.get_user_attribute(1, 'current_model') == 'new'
+
+    asyncio.run(run())
+
+
+def test_read_overlapping_an_invalidation_isnt_cached():
+    async def run():
+        storage = BlockingStorage()
+        await storage.insert_user({'_id': 1, 'current_model': 'old'})
+        db = Database(storage)
+
+        read = asyncio.create_task(db.get_user_attribute(1, 'current_model'))
+        await storage.reading.wait()
+        # another process changes the user, the change stream evicts it
+        storage.users[1]['current_model'] = 'new'
+        db.user_cache.pop(1)
+        storage.release.set()
+
+        await read
+        assert 1 not in db.user_cache
+
+    asyncio.run(run())
+
+
+def test_read_overlapping_a_flush_isnt_cached():
+    async def run():
+        storage = BlockingStorage()
+        await storage.insert_user({'_id': 1, 'n_generated_images': 0})
+        db = Database(storage)
+        db._flush_task = object()  # no write-through, flushed below
+
+        await db.inc_user_attribute(1, 'n_generated_images', 1)
+        read = asyncio.create_task(db._get_user(1))
+        await storage.reading.wait()
+        await db.flush()
+        storage.release.set()
+
+        # read before the flush, applied the increments pending after it
+        await read
+        assert 1 not in db.user_cache
+        user_dict = await db._get_user(1)
+        assert user_dict['n_generated_images'] == 1
+        db._flush_task = None
+
+    asyncio.run(run())
+
+
+def test_read_is_cached():
+    async def run():
+        storage = MemoryStorage()
+        await storage.insert_user({'_id': 1, 'current_model': 'old'})
+        db = Database(storage)
+
+        assert await db.get_user_attribute(1, 'current_model') == 'old'
+        assert 1 in db.user_cache
+        assert db.user_cache._loads == {}
+
+    asyncio.run(run())
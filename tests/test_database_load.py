@@ -0,0 +1,121 @@
+"""
+Load test of `Database`: concurrent handlers must not take turns on the
+database. Each simulated handler makes the calls a text message makes. With
+a storage round trip of ROUND_TRIP seconds, handlers that waited for each
+other would need N_HANDLERS times as long as one handler does.
+
+Set MONGODB_TEST_URI (e.g. mongodb://localhost:27017) to also run it
+against a real mongod. That run uses a database of its own and drops it.
+"""
+import asyncio
+import os
+import time
+import uuid
+
+import pytest
+
+import config
+from database import Database
+from storage.memory import MemoryStorage
+
+N_HANDLERS = 100
+ROUND_TRIP = 0.02
+
+
+class SlowStorage(MemoryStorage):
+    """In-memory storage where every call waits like a network round trip."""
+
+    def __getattribute__(self, name):
+        attribute = super().__getattribute__(name)
+        if name.startswith('_') or name == 'watch_user_changes':
+            return attribute
+        if not asyncio.iscoroutinefunction(attribute):
+            return attribute
+
+        async def call(*args, **kwargs):
+            await asyncio.sleep(ROUND_TRIP)
+            return await attribute(*args, **kwargs)
+
+        return call
+
+
+async def handle_message(db: Database, user_id: int):
+    await db.register_user(user_id, user_id)
+    dialog_id = await db.get_user_attribute(user_id, 'current_dialog_id')
+    await db.get_dialog_messages(
+        user_id, dialog_id, last_n=config.max_context_dialog_messages
+    )
+    await db.add_dialog_message(
+        user_id, {'user': 'hi', 'bot': 'hello'}, dialog_id=dialog_id
+    )
+    await db.update_n_used_tokens(user_id, 'gpt-3.5-turbo', 10, 20)
+
+
+async def measure(db: Database) -> dict:
+    """
+    Seconds one handler and N_HANDLERS concurrent ones take, and the longest
+    event loop stall meanwhile.
+    """
+    await db.start()
+    max_stall = 0.0
+
+    async def heartbeat():
+        nonlocal max_stall
+        while True:
+            started_at = time.monotonic()
+            await asyncio.sleep(0.001)
+            max_stall = max(max_stall, time.monotonic() - started_at)
+
+    heartbeat_task = asyncio.create_task(heartbeat())
+    try:
+        started_at = time.monotonic()
+        await handle_message(db, 1)
+        one_handler = time.monotonic() - started_at
+
+        started_at = time.monotonic()
+        await asyncio.gather(*(
+            handle_message(db, user_id)
+            for user_id in range(2, N_HANDLERS + 2)
+        ))
+        all_handlers = time.monotonic() - started_at
+    finally:
+        heartbeat_task.cancel()
+        await db.close()
+
+    return {
+        'one_handler': one_handler,
+        'all_handlers': all_handlers,
+        'max_stall': max_stall,
+    }
+
+
+def test_concurrent_handlers_overlap_on_storage_calls():
+    result = asyncio.run(measure(Database(SlowStorage())))
+
+    # one after another they'd take N_HANDLERS * one_handler
+    assert result['all_handlers'] < 5 * result['one_handler'], result
+    assert result['max_stall'] < 5 * ROUND_TRIP, result
+
+
+@pytest.mark.skipif(
+    'MONGODB_TEST_URI' not in os.environ, reason='MONGODB_TEST_URI not set'
+)
+def test_concurrent_handlers_overlap_on_mongo_calls(monkeypatch):
+    from storage.mongo import MongoStorage
+
+    monkeypatch.setattr(config, 'dialog_archive_after_days', None)
+
+    async def measure_on_test_database():
+        # the client binds to the event loop, so it's created in this one
+        db_name = f'chatgpt_telegram_bot_test_{uuid.uuid4().hex}'
+        storage = MongoStorage(os.environ['MONGODB_TEST_URI'], db_name)
+        try:
+            return await measure(Database(storage))
+        finally:
+            await storage.client.drop_database(db_name)
+
+    result = asyncio.run(measure_on_test_database())
+
+    assert (
+        result['all_handlers'] < N_HANDLERS / 5 * result['one_handler']
+    ), result
@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+from telegram.error import RetryAfter
+
+import config
+import egress
+
+
+@pytest.fixture(autouse=True)
+def roomy_budgets(monkeypatch):
+    monkeypatch.setattr(config, 'telegram_global_rate', 1000)
+    monkeypatch.setattr(config, 'telegram_chat_rate', 1000)
+    monkeypatch.setattr(config, 'telegram_chat_burst', 1000)
+    monkeypatch.setattr(config, 'telegram_edit_max_queue_time', 10)
+
+
+async def send(scheduler, chat_id, priority, callback=None):
+    async def ok():
+        return 'sent'
+
+    return await scheduler.process_request(
+        callback or ok, (), {}, 'editMessageText', {'chat_id': chat_id},
+        priority,
+    )
+
+
+async def hit_retry_after(scheduler, chat_id, retry_after):
+    async def rate_limited():
+        raise RetryAfter(retry_after)
+
+    with pytest.raises(RetryAfter):
+        await send(scheduler, chat_id, egress.Priority.EDIT, rate_limited)
+
+
+def test_retry_after_holds_back_edits_to_other_chats():
+    async def run():
+        scheduler = egress.EgressScheduler()
+        await scheduler.initialize()
+        try:
+            await hit_retry_after(scheduler, 1, retry_after=1)
+
+            edit = asyncio.create_task(
+                send(scheduler, 2, egress.Priority.EDIT)
+            )
+            # replies to other chats go on
+            assert await asyncio.wait_for(
+                send(scheduler, 2, egress.Priority.REPLY), 0.1
+            ) == 'sent'
+
+            await asyncio.sleep(0.5)
+            assert not edit.done()
+            assert await asyncio.wait_for(edit, 1) == 'sent'
+        finally:
+            await scheduler.shutdown()
+
+    asyncio.run(run())
+
+
+def test_retry_after_holds_back_replies_to_its_chat():
+    async def run():
+        scheduler = egress.EgressScheduler()
+        await scheduler.initialize()
+        try:
+            await hit_retry_after(scheduler, 1, retry_after=1)
+
+            reply = asyncio.create_task(
+                send(scheduler, 1, egress.Priority.REPLY)
+            )
+            await asyncio.sleep(0.5)
+            assert not reply.done()
+            assert await asyncio.wait_for(reply, 1) == 'sent'
+        finally:
+            await scheduler.shutdown()
+
+    asyncio.run(run())
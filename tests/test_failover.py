@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+
+import config
+import failover
+
+
+@pytest.fixture(autouse=True)
+def short_stall_timeout(monkeypatch):
+    monkeypatch.setattr(config, 'openai_stream_stall_timeout', 0.05)
+    monkeypatch.setattr(config, 'openai_stream_max_resumes', 2)
+
+
+def make_open_stream(streams: list):
+    """`open_stream` returning the chunk lists in turn; a None stalls."""
+    opened_messages = []
+
+    async def open_stream(messages):
+        opened_messages.append(messages)
+        chunks = streams[len(opened_messages) - 1]
+
+        async def stream():
+            for chunk in chunks:
+                if chunk is None:
+                    await asyncio.sleep(60)
+                yield chunk
+
+        return stream()
+
+    return open_stream, opened_messages
+
+
+async def read(open_stream) -> list:
+    return [
+        content
+        async for content in failover.resumable_stream(
+            open_stream, [{'role': 'user', 'content': 'Hi'}], lambda x: x
+        )
+    ]
+
+
+def test_stall_before_the_first_token_streams_the_retry():
+    chunks = [f'{i:09d} ' for i in range(30)]
+    open_stream, opened_messages = make_open_stream([[None], chunks])
+
+    contents = asyncio.run(read(open_stream))
+
+    # nothing to cut off, so nothing is held back
+    assert contents == chunks
+    assert opened_messages[1] == opened_messages[0]
+
+
+def test_resumed_stream_drops_repeated_text():
+    answer = 'The answer starts like this, '
+    repeated = 'like this, and goes on ' + 'x' * 200
+    open_stream, opened_messages = make_open_stream(
+        [[answer, None], [repeated]]
+    )
+
+    contents = asyncio.run(read(open_stream))
+
+    assert ''.join(contents) == answer + 'and goes on ' + 'x' * 200
+    assert opened_messages[1][-2] == {
+        'role': 'assistant', 'content': answer
+    }
@@ -0,0 +1,124 @@
+import asyncio
+import collections
+
+import pytest
+
+import compat
+import config
+import endpoints
+import fake_openai
+import hedging
+import latency
+import openai_utils
+import scheduler
+
+MESSAGES = [{'role': 'user', 'content': 'Hello!'}]
+
+
+class FirstRequestStalls(fake_openai.FakeOpenAI):
+    def _get_first_token_latency(self) -> float:
+        if self.n_requests == 1:
+            self.n_stalled += 1
+            return self.stall_time
+        return self.first_token_latency
+
+
+@pytest.fixture
+def run_on_fake_openai(monkeypatch):
+    """
+    Runs `test(server, chatgpt)` against a fake OpenAI whose first request
+    stalls, served as `n_endpoints` endpoints.
+    """
+    monkeypatch.setattr(config, 'openai_hedge_enabled', True)
+    monkeypatch.setattr(config, 'openai_hedge_default_delay', 0.1)
+    monkeypatch.setattr(config, 'openai_hedge_min_delay', 0.1)
+    monkeypatch.setattr(
+        hedging,
+        'ttft_windows',
+        collections.defaultdict(lambda: latency.LatencyWindow(10)),
+    )
+    monkeypatch.setattr(hedging, 'hedge_stats', hedging.HedgeStats())
+
+    def run(test, n_endpoints=2, max_concurrent_requests=2):
+        monkeypatch.setattr(scheduler, '_schedulers', {
+            'gpt-3.5-turbo': scheduler.ModelScheduler(
+                'gpt-3.5-turbo',
+                max_concurrent_requests=max_concurrent_requests,
+                lane_weights={'premium': 3, 'free': 1},
+            )
+        })
+
+        async def run_test():
+            server = FirstRequestStalls(n_answer_tokens=5, stall_time=1.0)
+            async with fake_openai.serving(server, port=0) as api_base:
+                monkeypatch.setattr(
+                    openai_utils,
+                    'endpoint_pool',
+                    endpoints.EndpointPool([
+                        endpoints.Endpoint(f'fake-{i}', 'sk-fake', api_base)
+                        for i in range(n_endpoints)
+                    ]),
+                )
+                await test(server, openai_utils.ChatGPT('gpt-3.5-turbo'))
+
+        asyncio.run(run_test())
+
+    return run
+
+
+async def read_answer(chatgpt, wasted_tokens) -> str:
+    """Reads a stream opened like send_message_stream does, in its slot."""
+    async with chatgpt._slot():
+        stream = await chatgpt._open_chat_stream(
+            10,
+            wasted_tokens,
+            model=chatgpt.model,
+            messages=MESSAGES,
+            **chatgpt._completion_options(),
+        )
+        async with compat.aclosing(stream):
+            return ''.join([
+                openai_utils._get_delta_content(r_item)
+                async for r_item in stream
+            ])
+
+
+def test_late_stream_is_hedged(run_on_fake_openai):
+    async def test(server, chatgpt):
+        wasted_tokens = hedging.WastedTokens()
+        assert await read_answer(chatgpt, wasted_tokens) == 'token ' * 5
+
+        assert server.n_requests == 2
+        assert hedging.hedge_stats.n_hedged == 1
+        assert hedging.hedge_stats.n_hedge_won == 1
+        # the stalled request is billed too
+        assert wasted_tokens.n_input_tokens == 10
+        assert wasted_tokens.n_output_tokens == 0
+        # the hedge gave its slot back once the race was decided
+        assert scheduler.get_scheduler(chatgpt.model).n_running == 0
+
+    run_on_fake_openai(test)
+
+
+def test_single_endpoint_isnt_hedged(run_on_fake_openai):
+    async def test(server, chatgpt):
+        wasted_tokens = hedging.WastedTokens()
+        assert await read_answer(chatgpt, wasted_tokens) == 'token ' * 5
+
+        assert server.n_requests == 1
+        assert hedging.hedge_stats.n_streams == 0
+        assert wasted_tokens.n_input_tokens == 0
+
+    run_on_fake_openai(test, n_endpoints=1)
+
+
+def test_hedge_needs_a_free_slot(run_on_fake_openai):
+    async def test(server, chatgpt):
+        wasted_tokens = hedging.WastedTokens()
+        assert await read_answer(chatgpt, wasted_tokens) == 'token ' * 5
+
+        assert server.n_requests == 1
+        assert hedging.hedge_stats.n_skipped_busy == 1
+        assert wasted_tokens.n_input_tokens == 0
+
+    run_on_fake_openai(test, max_concurrent_requests=1)
@@ -0,0 +1,66 @@
+import asyncio
+
+import openai
+import pytest
+
+import endpoints
+import fake_openai
+import openai_utils
+
+
+@pytest.fixture
+def run_on_fake_openai(monkeypatch):
+    """Runs `test(server)` with every endpoint pointing to a fake OpenAI."""
+
+    def run(test):
+        async def run_test():
+            server = fake_openai.FakeOpenAI(n_answer_tokens=5)
+            async with fake_openai.serving(server, port=0) as api_base:
+                monkeypatch.setattr(
+                    openai_utils,
+                    'endpoint_pool',
+                    endpoints.EndpointPool(
+                        [endpoints.Endpoint('fake', 'sk-fake', api_base)]
+                    ),
+                )
+                try:
+                    await test(server)
+                finally:
+                    await openai_utils.close_http_session()
+
+        asyncio.run(run_test())
+
+    return run
+
+
+async def call():
+    return await openai_utils.call_openai(
+        openai.ChatCompletion.acreate,
+        model='gpt-3.5-turbo',
+        messages=[{'role': 'user', 'content': 'Hello!'}],
+    )
+
+
+def test_pooled_session_reuses_connections(run_on_fake_openai):
+    async def test(server):
+        await openai_utils.start_http_session()
+        n_reused_before = openai_utils.connection_stats.n_reused
+
+        for _ in range(10):
+            r = await call()
+            assert r.choices[0].message['content'] == 'token ' * 5
+
+        assert server.n_connections == 1
+        assert openai_utils.connection_stats.n_reused - n_reused_before == 9
+
+    run_on_fake_openai(test)
+
+
+def test_without_session_every_call_connects(run_on_fake_openai):
+    async def test(server):
+        for _ in range(3):
+            await call()
+
+        assert server.n_connections == 3
+
+    run_on_fake_openai(test)
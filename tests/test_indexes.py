@@ -0,0 +1,31 @@
+import asyncio
+import os
+import uuid
+
+import pytest
+
+import indexes
+
+pytestmark = pytest.mark.skipif(
+    'MONGODB_TEST_URI' not in os.environ, reason='MONGODB_TEST_URI not set'
+)
+
+
+def test_queries_use_indexes():
+    from storage.mongo import MongoStorage
+
+    async def run():
+        storage = MongoStorage(
+            os.environ['MONGODB_TEST_URI'], f'test_{uuid.uuid4().hex}'
+        )
+        try:
+            await indexes.ensure_indexes(storage.db)
+            # an empty collection is answered without a plan worth checking
+            for collection_name in indexes.INDEXES:
+                await storage.db[collection_name].insert_one({})
+
+            await indexes.check_query_plans(storage.db)
+        finally:
+            await storage.client.drop_database(storage.db.name)
+
+    asyncio.run(run())
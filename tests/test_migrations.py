@@ -0,0 +1,42 @@
+import asyncio
+import os
+import uuid
+
+import pytest
+
+import migrations
+
+pytestmark = pytest.mark.skipif(
+    'MONGODB_TEST_URI' not in os.environ, reason='MONGODB_TEST_URI not set'
+)
+
+
+def test_migrations_run_once():
+    from storage.mongo import MongoStorage
+
+    async def run():
+        storage = MongoStorage(
+            os.environ['MONGODB_TEST_URI'], f'test_{uuid.uuid4().hex}'
+        )
+        user_collection = storage.db['user']
+        try:
+            await user_collection.insert_one(
+                {'_id': 1, 'premiumn_till': 'till'}
+            )
+            await migrations.migrate(storage.db)
+            assert await user_collection.find_one({'_id': 1}) == {
+                '_id': 1, 'premium_till': 'till'
+            }
+
+            # applied already, so a misspelled field written since stays
+            await user_collection.insert_one(
+                {'_id': 2, 'premiumn_till': 'till'}
+            )
+            await migrations.migrate(storage.db)
+            assert 'premiumn_till' in await user_collection.find_one(
+                {'_id': 2}
+            )
+        finally:
+            await storage.client.drop_database(storage.db.name)
+
+    asyncio.run(run())
@@ -0,0 +1,85 @@
+import asyncio
+
+import openai
+import pytest
+
+import openai_utils
+
+
+class WordEncoding:
+    """A word per token, so these tests don't need tiktoken's BPE ranks."""
+
+    name = 'words'
+
+    def encode(self, text, disallowed_special=()):
+        return text.split()
+
+
+@pytest.fixture
+def chatgpt(monkeypatch):
+    monkeypatch.setattr(
+        openai_utils, 'get_encoding', lambda model: WordEncoding()
+    )
+    openai_utils.count_prompt_start_tokens.cache_clear()
+    yield openai_utils.ChatGPT('gpt-3.5-turbo')
+    openai_utils.count_prompt_start_tokens.cache_clear()
+
+
+def make_chunk(content: str):
+    return openai.util.convert_to_openai_object(
+        {'choices': [{'index': 0, 'delta': {'content': content}}]}
+    )
+
+
+async def read_stream(gen) -> list:
+    return [item async for item in gen]
+
+
+def test_stream_drops_a_message_when_the_request_is_too_long(
+    chatgpt, monkeypatch
+):
+    open_calls = []
+
+    async def open_chat_stream(n_input_tokens, wasted_tokens, **kwargs):
+        open_calls.append(kwargs['messages'])
+        if len(open_calls) == 1:
+            raise openai.error.InvalidRequestError('too many tokens', None)
+
+        async def stream():
+            for content in ('Hello', ' there'):
+                yield make_chunk(content)
+
+        return stream()
+
+    monkeypatch.setattr(chatgpt, '_open_chat_stream', open_chat_stream)
+    dialog_messages = [
+        {'user': 'first question', 'bot': 'first answer'},
+        {'user': 'second question', 'bot': 'second answer'},
+    ]
+
+    items = asyncio.run(read_stream(
+        chatgpt.send_message_stream('Hi', dialog_messages=dialog_messages)
+    ))
+
+    assert len(open_calls) == 2
+    assert len(open_calls[1]) == len(open_calls[0]) - 2
+    status, answer, (n_input_tokens, n_output_tokens), n_removed = items[-1]
+    assert status == 'finished'
+    assert answer == 'Hello there'
+    assert n_input_tokens > 0
+    assert n_output_tokens == 1 + 2
+    assert n_removed == 1
+
+
+def test_stream_of_an_empty_answer_finishes(chatgpt, monkeypatch):
+    async def open_chat_stream(n_input_tokens, wasted_tokens, **kwargs):
+        async def stream():
+            yield make_chunk('')
+
+        return stream()
+
+    monkeypatch.setattr(chatgpt, '_open_chat_stream', open_chat_stream)
+
+    items = asyncio.run(read_stream(chatgpt.send_message_stream('Hi')))
+
+    assert items == [('finished', '', (items[0][2][0], 1), 0)]
@@ -0,0 +1,143 @@
+from html.parser import HTMLParser
+
+import pytest
+
+from rendering import HTMLRenderer, MarkdownRenderer
+
+MARKDOWN_ANSWER = (
+    '# Sorting\n'
+    'Use **sorted()** for a _new_ list, or `list.sort()` in place:\n'
+    '```python\n'
+    'items = sorted(items, key=lambda item: item < 0)\n'
+    '```\n'
+    '- keeps the *original* order of equal items\n'
+    '- see [the docs](https://docs.python.org/3/howto/sorting.html)\n'
+    'snake_case_names stay as they are & so does 2 * 3.'
+)
+HTML_ANSWER = (
+    '<b>Sorting</b>\n'
+    'Use <code>sorted()</code> for a <i>new <u>list</u></i> &amp; more:\n'
+    '<pre><code class="language-python">if a < b and c > d:\n'
+    '    pass</code></pre>\n'
+    '<a href="https://example.com/?a=1&amp;b=2">docs</a> '
+    '<script>alert(1)</script> 1 < 2 &#169; <tg-spoiler>end</tg-spoiler>'
+)
+
+
+class TagBalanceChecker(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.open_tags = []
+
+    def handle_starttag(self, tag, attrs):
+        self.open_tags.append(tag)
+
+    def handle_endtag(self, tag):
+        assert self.open_tags.pop() == tag
+
+
+def assert_balanced(html: str):
+    checker = TagBalanceChecker()
+    checker.feed(html)
+    checker.close()
+    assert checker.open_tags == []
+    assert '<' not in checker.rawdata
+
+
+@pytest.mark.parametrize(
+    'renderer_class, answer',
+    [(MarkdownRenderer, MARKDOWN_ANSWER), (HTMLRenderer, HTML_ANSWER)],
+)
+def test_every_prefix_renders_balanced(renderer_class, answer):
+    renderer = renderer_class()
+    for end in range(1, len(answer) + 1):
+        html = renderer.render(answer[:end])
+        assert_balanced(html)
+        # rendering only the new lines gives what rendering it all would
+        assert html == renderer_class().render(answer[:end])
+
+    assert_balanced(renderer.render(answer, is_final=True))
+
+
+@pytest.mark.parametrize('text, partial_html, final_html', [
+    (
+        '# Title\n**bold** and _it_ x',
+        '<b>Title</b>\n<b>bold</b> and <i>it</i> x',
+        '<b>Title</b>\n<b>bold</b> and <i>it</i> x',
+    ),
+    ('**unclosed', '<b>unclosed</b>', '**unclosed'),
+    ('`code <b>', '<code>code &lt;b&gt;</code>', '`code &lt;b&gt;'),
+    ('snake_case_name', 'snake_case_name', 'snake_case_name'),
+    ('- item *one*\n- two', '• item <i>one</i>\n• two', None),
+    (
+        '[link](https://example.com?a=1&b=2)',
+        '<a href="https://example.com?a=1&amp;b=2">link</a>',
+        None,
+    ),
+    (
+        '```python\nprint(1 < 2)\n',
+        '<pre><code class="language-python">print(1 &lt; 2)\n</code></pre>',
+        None,
+    ),
+    ('```\nx\n```\ndone', '<pre>x\n</pre>\ndone', None),
+    # a code fence that is still being written isn't shown yet
+    (
+        'text\n```py',
+        'text\n',
+        'text\n<pre><code class="language-py"></code></pre>',
+    ),
+])
+def test_markdown(text, partial_html, final_html):
+    assert MarkdownRenderer().render(text) == partial_html
+    assert MarkdownRenderer().render(text, is_final=True) == (
+        final_html or partial_html
+    )
+
+
+@pytest.mark.parametrize('text, partial_html, final_html', [
+    ('<b>bold <i>it', '<b>bold <i>it</i></b>', None),
+    ('<b>bold</i> x</b>', '<b>bold x</b>', None),
+    ('<B>upper</B>', '<b>upper</b>', None),
+    (
+        '<script>x</script>',
+        '&lt;script&gt;x&lt;/script&gt;',
+        None,
+    ),
+    (
+        '<code><b>not bold</b></code>',
+        '<code>&lt;b&gt;not bold&lt;/b&gt;</code>',
+        None,
+    ),
+    (
+        '<a href="https://e.com/?a=1&amp;b=2" onclick="x">l</a>',
+        '<a href="https://e.com/?a=1&amp;b=2">l</a>',
+        None,
+    ),
+    (
+        '<pre><code>x</pre> after',
+        '<pre><code>x</code></pre> after',
+        None,
+    ),
+    (
+        '<pre><code><b>x</b></code></pre>',
+        '<pre><code>&lt;b&gt;x&lt;/b&gt;</code></pre>',
+        None,
+    ),
+    ('<code>a</pre>b</code>', '<code>a&lt;/pre&gt;b</code>', None),
+    ('1 < 2 &amp; 3 & 4', '1 &lt; 2 &amp; 3 &amp; 4', None),
+    # a tag or an entity that is still being written isn't shown yet
+    ('text <b', 'text ', 'text &lt;b'),
+    ('a &am', 'a ', 'a &amp;am'),
+])
+def test_html(text, partial_html, final_html):
+    assert HTMLRenderer().render(text) == partial_html
+    assert HTMLRenderer().render(text, is_final=True) == (
+        final_html or partial_html
+    )
+
+
+def test_text_that_isnt_a_continuation_is_rendered_anew():
+    renderer = MarkdownRenderer()
+    renderer.render('```\ncode\n')
+
+    assert renderer.render('plain\ntext') == 'plain\ntext'
@@ -0,0 +1,156 @@
+import asyncio
+import time
+
+import openai
+import pytest
+
+import config
+from resilience import (
+    AdaptiveTimeout,
+    CircuitBreaker,
+    CircuitOpenError,
+    UpstreamPolicy,
+)
+
+
+@pytest.fixture
+def policy(monkeypatch):
+    monkeypatch.setattr(config, 'openai_max_attempts', 3)
+    monkeypatch.setattr(config, 'openai_retry_base_delay', 0)
+    monkeypatch.setattr(config, 'openai_retry_max_delay', 0)
+    monkeypatch.setattr(config, 'openai_circuit_failure_threshold', 5)
+    monkeypatch.setattr(config, 'openai_circuit_cooldown', 60.0)
+    return UpstreamPolicy('model')
+
+
+def open_circuit(breaker: CircuitBreaker, cooldown_passed: bool):
+    breaker.opened_at = time.monotonic()
+    if cooldown_passed:
+        breaker.opened_at -= breaker.cooldown
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker('model', failure_threshold=2, cooldown=60.0)
+
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == 'closed'
+    breaker.record_failure()
+    assert breaker.state == 'open'
+
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_breaker_lets_one_trial_through_when_half_open():
+    breaker = CircuitBreaker('model', failure_threshold=2, cooldown=60.0)
+    open_circuit(breaker, cooldown_passed=True)
+    assert breaker.state == 'half_open'
+
+    assert breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    breaker.record_failure()
+    assert breaker.state == 'open'
+
+    open_circuit(breaker, cooldown_passed=True)
+    assert breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    assert not breaker.before_call()
+
+
+def test_transient_errors_are_retried(policy):
+    n_calls = 0
+
+    async def request(timeout):
+        nonlocal n_calls
+        n_calls += 1
+        if n_calls < 3:
+            raise openai.error.ServiceUnavailableError('overloaded')
+        return 'answer'
+
+    assert asyncio.run(policy.call(request)) == 'answer'
+    assert n_calls == 3
+    assert policy.breaker.state == 'closed'
+
+
+def test_invalid_request_isnt_retried(policy):
+    n_calls = 0
+
+    async def request(timeout):
+        nonlocal n_calls
+        n_calls += 1
+        raise openai.error.InvalidRequestError('too long', None)
+
+    with pytest.raises(openai.error.InvalidRequestError):
+        asyncio.run(policy.call(request))
+    assert n_calls == 1
+    assert policy.breaker.n_consecutive_failures == 0
+
+
+def test_cancelled_trial_lets_the_next_call_through(policy):
+    open_circuit(policy.breaker, cooldown_passed=True)
+
+    async def run():
+        started = asyncio.Event()
+
+        async def hanging_request(timeout):
+            started.set()
+            await asyncio.sleep(60)
+
+        trial = asyncio.create_task(policy.call(hanging_request))
+        await started.wait()
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+
+        async def request(timeout):
+            return 'answer'
+
+        return await policy.call(request)
+
+    assert asyncio.run(run()) == 'answer'
+    assert policy.breaker.state == 'closed'
+
+
+def test_cancelled_call_doesnt_end_anothers_trial(policy):
+    async def run():
+        started = asyncio.Event()
+
+        async def hanging_request(timeout):
+            started.set()
+            await asyncio.sleep(60)
+
+        # started while closed, the circuit opens and half-opens meanwhile
+        call = asyncio.create_task(policy.call(hanging_request))
+        await started.wait()
+        open_circuit(policy.breaker, cooldown_passed=True)
+        assert policy.breaker.before_call()
+
+        call.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await call
+
+        with pytest.raises(CircuitOpenError):
+            policy.breaker.before_call()
+
+    asyncio.run(run())
+
+
+def test_adaptive_timeout_follows_latency():
+    timeout = AdaptiveTimeout(min_timeout=1.0, max_timeout=60.0)
+    assert timeout.timeout == 60.0
+
+    for _ in range(50):
+        timeout.observe(2.0)
+    assert 2.0 <= timeout.timeout < 3.0
+
+    timeout.backoff()
+    assert timeout.timeout >= 4.0
+
+    for _ in range(50):
+        timeout.observe(0.01)
+    assert timeout.timeout == 1.0
@@ -0,0 +1,166 @@
+import asyncio
+
+import pytest
+
+from scheduler import ModelScheduler
+
+
+def new_scheduler(max_concurrent_requests: int = 1) -> ModelScheduler:
+    return ModelScheduler(
+        'gpt-3.5-turbo',
+        max_concurrent_requests=max_concurrent_requests,
+        lane_weights={'premium': 3, 'free': 1},
+    )
+
+
+async def hold_slot(
+    scheduler, premium, order, name, release, on_queued=None
+):
+    async with scheduler.slot(premium=premium, on_queued=on_queued):
+        order.append(name)
+        await release.wait()
+
+
+def test_concurrency_is_bounded():
+    async def run():
+        scheduler = new_scheduler(max_concurrent_requests=2)
+        order, release = [], asyncio.Event()
+        tasks = [
+            asyncio.create_task(
+                hold_slot(scheduler, False, order, i, release)
+            )
+            for i in range(5)
+        ]
+        await asyncio.sleep(0)
+
+        assert order == [0, 1]
+        assert scheduler.n_running == 2
+        assert scheduler.queue_depth == 3
+
+        release.set()
+        await asyncio.gather(*tasks)
+        assert order == [0, 1, 2, 3, 4]
+        assert scheduler.n_running == 0
+        assert scheduler.stats()['queued_total'] == 3
+
+    asyncio.run(run())
+
+
+async def dispatch_order(n_premium: int, n_free: int) -> list:
+    """Lanes of the requests in the order they got the only slot."""
+    scheduler = new_scheduler()
+    order, release = [], asyncio.Event()
+    blocker = asyncio.create_task(
+        hold_slot(scheduler, False, [], 'blocker', release)
+    )
+    await asyncio.sleep(0)
+
+    lanes = ['premium'] * n_premium + ['free'] * n_free
+    tasks = []
+    for lane in lanes:
+        lane_release = asyncio.Event()
+        lane_release.set()
+        tasks.append(asyncio.create_task(hold_slot(
+            scheduler, lane == 'premium', order, lane, lane_release
+        )))
+    await asyncio.sleep(0)
+
+    release.set()
+    await asyncio.gather(blocker, *tasks)
+    return order
+
+
+def test_premium_lane_gets_its_weight():
+    order = asyncio.run(dispatch_order(n_premium=12, n_free=12))
+
+    # while both lanes are backlogged: three premium for every free one
+    assert order[:16].count('premium') == 12
+    assert order[:16].count('free') == 4
+
+
+def test_free_lane_isnt_starved():
+    order = asyncio.run(dispatch_order(n_premium=30, n_free=3))
+
+    assert order.index('free') < 5
+    assert order[:13].count('free') == 3
+
+
+def test_on_queued_gets_the_position_in_the_lane():
+    async def run():
+        scheduler = new_scheduler()
+        release = asyncio.Event()
+        positions = []
+
+        async def on_queued(position):
+            positions.append(position)
+
+        tasks = [
+            asyncio.create_task(hold_slot(
+                scheduler, False, [], i, release, on_queued=on_queued
+            ))
+            for i in range(3)
+        ]
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(*tasks)
+
+        # the first one got the slot right away
+        assert positions == [1, 2]
+
+    asyncio.run(run())
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def run():
+        scheduler = new_scheduler()
+        order, release = [], asyncio.Event()
+        running = asyncio.create_task(
+            hold_slot(scheduler, False, order, 'running', release)
+        )
+        waiting = asyncio.create_task(
+            hold_slot(scheduler, False, order, 'cancelled', release)
+        )
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth == 1
+
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert scheduler.queue_depth == 0
+
+        release.set()
+        await running
+        assert order == ['running']
+        assert scheduler.n_running == 0
+
+    asyncio.run(run())
+
+
+def test_slot_handed_to_a_cancelled_waiter_is_passed_on():
+    async def run():
+        scheduler = new_scheduler()
+        order, release = [], asyncio.Event()
+        release.set()
+        running = scheduler.slot()
+        await running.__aenter__()
+        cancelled = asyncio.create_task(
+            hold_slot(scheduler, False, order, 'cancelled', release)
+        )
+        next_waiter = asyncio.create_task(
+            hold_slot(scheduler, False, order, 'next', release)
+        )
+        await asyncio.sleep(0)
+
+        # the slot is handed over, then the waiter is cancelled before it
+        # gets to run
+        await running.__aexit__(None, None, None)
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+
+        await next_waiter
+        assert order == ['next']
+        assert scheduler.n_running == 0
+        assert scheduler.queue_depth == 0
+
+    asyncio.run(run())
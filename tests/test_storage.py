@@ -0,0 +1,342 @@
+"""
+Conformance suite of the storage backends: every backend must pass the same
+tests. The Mongo backend runs too if MONGODB_TEST_URI is set, on a
+database of its own that is dropped afterwards.
+"""
+import asyncio
+import os
+import uuid
+from datetime import datetime
+
+import pytest
+
+import config
+from storage.memory import MemoryStorage
+from storage.sqlite import SQLiteStorage
+
+BACKENDS = [
+    'memory',
+    'sqlite',
+    pytest.param('mongo', marks=pytest.mark.skipif(
+        'MONGODB_TEST_URI' not in os.environ,
+        reason='MONGODB_TEST_URI not set',
+    )),
+]
+
+
+@pytest.fixture(params=BACKENDS)
+def run_with_storage(request, tmp_path, monkeypatch):
+    """Runs `test(storage)` on a started, empty storage of each backend."""
+    monkeypatch.setattr(config, 'dialog_archive_after_days', None)
+
+    def create_storage():
+        if request.param == 'memory':
+            return MemoryStorage()
+        if request.param == 'sqlite':
+            return SQLiteStorage(str(tmp_path / 'bot.sqlite3'))
+
+        from storage.mongo import MongoStorage
+
+        return MongoStorage(
+            os.environ['MONGODB_TEST_URI'], f'test_{uuid.uuid4().hex}'
+        )
+
+    def run(test):
+        async def run_test():
+            storage = create_storage()
+            await storage.start()
+            try:
+                await test(storage)
+            finally:
+                await storage.close()
+                if request.param == 'mongo':
+                    await storage.client.drop_database(storage.db.name)
+
+        asyncio.run(run_test())
+
+    return run
+
+
+def new_dialog(dialog_id: str = 'd1', user_id: int = 1) -> dict:
+    return {
+        '_id': dialog_id,
+        'user_id': user_id,
+        'chat_mode': 'assistant',
+        'start_time': datetime(2024, 1, 1),
+        'updated_at': datetime(2024, 1, 1),
+        'model': 'gpt-3.5-turbo',
+        'messages': [],
+    }
+
+
+# users
+
+
+def test_user_round_trip(run_with_storage):
+    async def test(storage):
+        assert await storage.get_user(1) is None
+
+        user_dict = {
+            '_id': 1,
+            'username': 'user',
+            'last_interaction': datetime(2024, 1, 1, 12, 30),
+            'n_used_tokens': {'gpt-4': {'n_input_tokens': 1}},
+            'premium_till': None,
+        }
+        await storage.insert_user(user_dict)
+        assert await storage.get_user(1) == user_dict
+
+        # a returned document is a copy
+        (await storage.get_user(1))['username'] = 'changed'
+        assert (await storage.get_user(1))['username'] == 'user'
+
+    run_with_storage(test)
+
+
+def test_upsert_creates_user_from_defaults(run_with_storage):
+    async def test(storage):
+        user_dict = await storage.upsert_user(
+            1, {'username': 'user', 'n_generated_images': 0}, {'chat_id': 5}
+        )
+
+        expected = {
+            '_id': 1, 'username': 'user', 'n_generated_images': 0, 'chat_id': 5
+        }
+        assert user_dict == expected
+        assert await storage.get_user(1) == expected
+
+    run_with_storage(test)
+
+
+def test_upsert_fills_only_missing_fields(run_with_storage):
+    async def test(storage):
+        await storage.insert_user(
+            {'_id': 1, 'username': 'old', 'current_model': None}
+        )
+
+        user_dict = await storage.upsert_user(
+            1,
+            {'username': 'new', 'current_model': 'gpt-4', 'n_used_tokens': {}},
+            {'chat_id': 5},
+        )
+
+        assert user_dict == {
+            '_id': 1,
+            'username': 'old',
+            'current_model': 'gpt-4',
+            'n_used_tokens': {},
+            'chat_id': 5,
+        }
+        assert await storage.get_user(1) == user_dict
+
+    run_with_storage(test)
+
+
+def test_update_user(run_with_storage):
+    async def test(storage):
+        assert not await storage.update_user(1, {'username': 'user'})
+
+        await storage.insert_user({'_id': 1, 'username': 'old', 'limits': {}})
+        assert await storage.update_user(
+            1, {'username': 'new', 'limits.daily': 10}
+        )
+
+        assert await storage.get_user(1) == {
+            '_id': 1, 'username': 'new', 'limits': {'daily': 10}
+        }
+
+    run_with_storage(test)
+
+
+def test_increment_users(run_with_storage):
+    async def test(storage):
+        await storage.insert_user(
+            {'_id': 1, 'n_generated_images': 1, 'n_used_tokens': {}}
+        )
+        await storage.insert_user({'_id': 2, 'n_generated_images': 0})
+
+        await storage.increment_users({
+            1: {
+                'n_generated_images': 2,
+                'n_used_tokens.gpt-4.n_input_tokens': 10,
+            },
+            2: {'n_transcribed_seconds': 1.5},
+            3: {'n_generated_images': 1},  # no such user
+        })
+
+        assert await storage.get_user(1) == {
+            '_id': 1,
+            'n_generated_images': 3,
+            'n_used_tokens': {'gpt-4': {'n_input_tokens': 10}},
+        }
+        assert await storage.get_user(2) == {
+            '_id': 2, 'n_generated_images': 0, 'n_transcribed_seconds': 1.5
+        }
+        assert await storage.get_user(3) is None
+
+    run_with_storage(test)
+
+
+# dialogs
+
+
+def test_dialog_messages(run_with_storage):
+    async def test(storage):
+        assert await storage.get_dialog_messages(1, 'd1') is None
+        assert not await storage.push_dialog_message(1, 'd1', {'user': 'a'})
+
+        await storage.insert_dialog(new_dialog())
+        assert await storage.get_dialog_messages(1, 'd1') == []
+
+        for text in ('a', 'b', 'c'):
+            assert await storage.push_dialog_message(
+                1, 'd1', {'user': text, 'bot': text.upper()}
+            )
+
+        messages = await storage.get_dialog_messages(1, 'd1')
+        assert [message['user'] for message in messages] == ['a', 'b', 'c']
+        assert await storage.get_dialog_messages(1, 'd1', last_n=2) == [
+            {'user': 'b', 'bot': 'B'},
+            {'user': 'c', 'bot': 'C'},
+        ]
+
+        assert await storage.set_dialog_messages(1, 'd1', [{'user': 'x'}])
+        assert await storage.get_dialog_messages(1, 'd1') == [{'user': 'x'}]
+        assert not await storage.set_dialog_messages(1, 'd2', [])
+
+    run_with_storage(test)
+
+
+def test_count_dialog_messages(run_with_storage):
+    async def test(storage):
+        assert await storage.count_dialog_messages(1, 'd1') is None
+
+        await storage.insert_dialog(new_dialog())
+        assert await storage.count_dialog_messages(1, 'd1') == 0
+
+        for text in ('a', 'b', 'c'):
+            await storage.push_dialog_message(1, 'd1', {'user': text})
+        await storage.pop_dialog_message(1, 'd1')
+
+        assert await storage.count_dialog_messages(1, 'd1') == 2
+        assert await storage.count_dialog_messages(2, 'd1') is None
+
+    run_with_storage(test)
+
+
+def test_dialog_belongs_to_its_user(run_with_storage):
+    async def test(storage):
+        await storage.insert_dialog(new_dialog(user_id=1))
+
+        assert await storage.get_dialog_messages(2, 'd1') is None
+        assert not await storage.push_dialog_message(2, 'd1', {'user': 'a'})
+        assert await storage.pop_dialog_message(2, 'd1') is None
+        assert await storage.get_dialog_summary(2, 'd1') is None
+        assert not await storage.set_dialog_summary(2, 'd1', {'text': 's'})
+
+    run_with_storage(test)
+
+
+def test_pop_dialog_message(run_with_storage):
+    async def test(storage):
+        assert await storage.pop_dialog_message(1, 'd1') is None
+
+        await storage.insert_dialog(new_dialog())
+        assert await storage.pop_dialog_message(1, 'd1') is None
+
+        await storage.push_dialog_message(1, 'd1', {'user': 'a'})
+        await storage.push_dialog_message(1, 'd1', {'user': 'b'})
+
+        assert await storage.pop_dialog_message(1, 'd1') == {'user': 'b'}
+        assert await storage.get_dialog_messages(1, 'd1') == [{'user': 'a'}]
+
+    run_with_storage(test)
+
+
+def test_dialog_summary(run_with_storage):
+    async def test(storage):
+        assert await storage.get_dialog_summary(1, 'd1') is None
+        assert not await storage.set_dialog_summary(1, 'd1', {'text': 's'})
+
+        await storage.insert_dialog(new_dialog())
+        assert await storage.get_dialog_summary(1, 'd1') is None
+
+        summary = {'text': 'summary', 'n_messages': 4}
+        assert await storage.set_dialog_summary(1, 'd1', summary)
+        assert await storage.get_dialog_summary(1, 'd1') == summary
+
+        # the summary is independent of the messages
+        await storage.push_dialog_message(1, 'd1', {'user': 'a'})
+        assert await storage.get_dialog_summary(1, 'd1') == summary
+
+    run_with_storage(test)
+
+
+# payments
+
+
+def test_payments(run_with_storage):
+    async def test(storage):
+        assert await storage.find_payment('_id', 'p1') is None
+        assert not await storage.update_payment('p1', {'status': 'paid'})
+
+        payment_dict = {
+            '_id': 'p1',
+            'user_id': 1,
+            'payment_id': 'external',
+            'status': 'pending',
+            'additional_data': {'uuid': 'invoice'},
+            'created_at': datetime(2024, 1, 1),
+        }
+        await storage.insert_payment(payment_dict)
+        await storage.insert_payment(
+            {'_id': 'p2', 'user_id': 1, 'payment_id': 'other'}
+        )
+
+        assert await storage.find_payment('_id', 'p1') == payment_dict
+        assert await storage.find_payment('payment_id', 'external') == (
+            payment_dict
+        )
+        assert await storage.find_payment(
+            'additional_data.uuid', 'invoice'
+        ) == payment_dict
+        assert await storage.find_payment('payment_id', 'missing') is None
+
+        assert await storage.update_payment('p1', {'status': 'paid'})
+        assert (await storage.find_payment('_id', 'p1'))['status'] == 'paid'
+
+    run_with_storage(test)
+
+
+def test_mongo_change_stream_skips_own_writes():
+    from storage.mongo import ORIGIN_FIELD, MongoStorage
+
+    # the client connects lazily, nothing is sent here
+    storage = MongoStorage('mongodb://localhost:1')
+    other_storage = MongoStorage('mongodb://localhost:1')
+
+    def insert(tag):
+        return {
+            'operationType': 'insert',
+            'fullDocument': {'user_id': 1, ORIGIN_FIELD: tag},
+        }
+
+    def update(tag):
+        updated_fields = {} if tag is None else {ORIGIN_FIELD: tag}
+        return {
+            'operationType': 'update',
+            'updateDescription': {'updatedFields': updated_fields},
+        }
+
+    own_tag = storage._origin_tag()
+    other_tag = other_storage._origin_tag()
+    assert own_tag != storage._origin_tag()
+
+    assert storage._is_own_change(insert(own_tag))
+    assert storage._is_own_change(update(own_tag))
+    assert not storage._is_own_change(insert(other_tag))
+    assert not storage._is_own_change(update(other_tag))
+    # written by an older version or by hand
+    assert not storage._is_own_change(insert(None))
+    assert not storage._is_own_change(update(None))
+    assert not storage._is_own_change({'operationType': 'delete'})
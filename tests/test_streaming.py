@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+from telegram.constants import ParseMode
+
+import streaming
+
+
+class FakeMessage:
+    def __init__(self, message_id: int):
+        self.message_id = message_id
+
+
+class FakeBot:
+    def __init__(self):
+        self.edits = []
+
+    async def edit_message_text(self, text, **kwargs):
+        self.edits.append(text)
+
+
+async def show_answer(bot, deltas: list, parse_mode=None):
+    async def send_placeholder():
+        return FakeMessage(1)
+
+    async with streaming.AnswerEditor(
+        bot,
+        chat_id=1,
+        first_message=asyncio.ensure_future(send_placeholder()),
+        parse_mode=parse_mode,
+    ) as editor:
+        answer = ''
+        for delta in deltas:
+            answer += delta
+            editor.update(answer)
+
+
+@pytest.mark.parametrize('deltas', [[], [''], [' ', '\n']])
+@pytest.mark.parametrize('parse_mode', [None, ParseMode.HTML])
+def test_empty_answer_replaces_the_placeholder(deltas, parse_mode):
+    bot = FakeBot()
+    asyncio.run(show_answer(bot, deltas, parse_mode))
+
+    assert bot.edits == [streaming.EMPTY_ANSWER_TEXT]
+
+
+def test_answer_is_shown():
+    bot = FakeBot()
+    asyncio.run(show_answer(bot, ['Hello', ', world']))
+
+    assert bot.edits[-1] == 'Hello, world'
@@ -0,0 +1,91 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import config
+from database import Database
+from storage.memory import MemoryStorage
+from summarization import DialogSummarizer
+
+N_MESSAGES = 10
+
+
+@pytest.fixture(params=[False, True], ids=['no_summaries', 'summaries'])
+def summary_enabled(request, monkeypatch):
+    monkeypatch.setattr(config, 'dialog_summary_enabled', request.param)
+    return request.param
+
+
+def load_dialog(last_n, dialog_summary=None):
+    async def run():
+        db = Database(MemoryStorage())
+        await db.register_user(1, 1)
+        started_at = datetime(2024, 1, 1)
+        for i in range(N_MESSAGES):
+            await db.add_dialog_message(1, {
+                'user': f'question {i}',
+                'bot': f'answer {i}',
+                'date': started_at + timedelta(minutes=i),
+            })
+        if dialog_summary is not None:
+            await db.set_dialog_summary(1, dialog_summary)
+
+        dialog_id = await db.get_user_attribute(1, 'current_dialog_id')
+        return await DialogSummarizer(db).load_dialog(
+            1, dialog_id, last_n=last_n
+        )
+
+    return asyncio.run(run())
+
+
+def test_short_dialog_is_loaded_whole(summary_enabled):
+    _, dialog_messages, n_dropped_messages = load_dialog(last_n=20)
+
+    assert len(dialog_messages) == N_MESSAGES
+    assert n_dropped_messages == 0
+
+
+def test_messages_before_last_n_are_counted(summary_enabled):
+    _, dialog_messages, n_dropped_messages = load_dialog(last_n=4)
+
+    assert [message['user'] for message in dialog_messages] == [
+        'question 6', 'question 7', 'question 8', 'question 9'
+    ]
+    assert n_dropped_messages == 6
+
+
+def test_summarized_messages_arent_counted(monkeypatch):
+    monkeypatch.setattr(config, 'dialog_summary_enabled', True)
+    summary = {
+        'text': 'summary',
+        'until': datetime(2024, 1, 1, 0, 1),
+        'n_messages': 2,
+    }
+
+    dialog_summary, dialog_messages, n_dropped_messages = load_dialog(
+        last_n=4, dialog_summary=summary
+    )
+
+    assert dialog_summary == summary
+    assert len(dialog_messages) == 4
+    # messages 2-5 are neither summarized nor sent
+    assert n_dropped_messages == 4
+
+
+def test_truncated_dialog_is_summarized_from_storage(monkeypatch):
+    monkeypatch.setattr(config, 'dialog_summary_enabled', True)
+
+    async def run():
+        summarizer = DialogSummarizer(db=None)
+        summarizer.start()
+        summarizer.submit(1, 'd1', None, [{'user': 'a'}], n_dropped_messages=3)
+        summarizer.submit(2, 'd2', None, [{'user': 'b'}])
+        is_truncated = {
+            dialog_id: job.is_truncated
+            for dialog_id, job in summarizer._jobs.items()
+        }
+        await summarizer.stop()
+        return is_truncated
+
+    assert asyncio.run(run()) == {'d1': True, 'd2': False}
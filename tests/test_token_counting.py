@@ -0,0 +1,29 @@
+import pytest
+
+from openai_utils import StreamingTokenCounter, count_tokens, get_encoding
+
+MODEL = 'gpt-3.5-turbo'
+
+
+@pytest.fixture(scope='module')
+def encoding():
+    # tiktoken downloads the BPE ranks on first use
+    try:
+        return get_encoding(MODEL)
+    except Exception as e:
+        pytest.skip(f"can't load the {MODEL} encoding: {e}")
+
+
+def test_streamed_count_matches_full_count(encoding):
+    answer = 'Streaming answers token by token: 1, 2, 3... done! ' * 20
+    deltas = [encoding.decode([token]) for token in encoding.encode(answer)]
+
+    counter = StreamingTokenCounter(MODEL, n_tokens=1)
+    for delta in deltas:
+        n_tokens = counter.add(delta)
+
+    assert n_tokens == 1 + count_tokens(answer, MODEL)
+
+
+def test_encoding_is_cached(encoding):
+    assert get_encoding(MODEL) is encoding
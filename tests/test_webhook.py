@@ -0,0 +1,88 @@
+import pytest
+from starlette.testclient import TestClient
+
+import config
+import webhook
+
+ALLOWED_UPDATES = ['message', 'edited_message', 'callback_query']
+
+
+def message_update(chat_id: int, user_id: int) -> dict:
+    return {
+        'update_id': 1,
+        'message': {
+            'message_id': 1,
+            'date': 0,
+            'chat': {'id': chat_id, 'type': 'group'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'U'},
+            'text': 'Hi',
+        },
+    }
+
+
+def test_update_is_routed_by_its_chat():
+    assert webhook.get_chat_id(message_update(-100, 5)) == -100
+
+    callback_query = {
+        'update_id': 2,
+        'callback_query': {
+            'id': 'q',
+            'from': {'id': 5},
+            'message': {'message_id': 1, 'chat': {'id': -100}},
+        },
+    }
+    assert webhook.get_chat_id(callback_query) == -100
+
+    # a callback query of an inline message has no chat
+    del callback_query['callback_query']['message']
+    assert webhook.get_chat_id(callback_query) == 5
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(
+        config, 'telegram_webhook_url', 'https://bot.example.com/telegram'
+    )
+    monkeypatch.setattr(config, 'telegram_webhook_secret', 'secret')
+    dispatched = []
+
+    async def dispatch(update_dict):
+        dispatched.append(update_dict)
+
+    with TestClient(webhook.create_app(dispatch, ALLOWED_UPDATES)) as client:
+        client.dispatched = dispatched
+        yield client
+
+
+def test_update_is_dispatched(client):
+    update = message_update(1, 1)
+    r = client.post(
+        '/telegram',
+        json=update,
+        headers={webhook.SECRET_TOKEN_HEADER: 'secret'},
+    )
+
+    assert r.status_code == 200
+    assert client.dispatched == [update]
+
+
+def test_wrong_secret_is_rejected(client):
+    r = client.post(
+        '/telegram',
+        json=message_update(1, 1),
+        headers={webhook.SECRET_TOKEN_HEADER: 'wrong'},
+    )
+
+    assert r.status_code == 403
+    assert client.dispatched == []
+
+
+def test_unhandled_update_type_is_ignored(client):
+    r = client.post(
+        '/telegram',
+        json={'update_id': 1, 'poll': {}},
+        headers={webhook.SECRET_TOKEN_HEADER: 'secret'},
+    )
+
+    assert r.status_code == 200
+    assert client.dispatched == []